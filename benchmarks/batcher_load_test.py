@@ -0,0 +1,91 @@
+"""
+Load test for ``SpanMarkerBatcher``, in which concurrent clients each submit one sentence at a time.
+
+Compares the throughput and latency against the same clients calling ``SpanMarkerModel.predict`` per request,
+and reports the queue depth and batch size metrics of the batcher.
+
+Usage::
+
+    python benchmarks/batcher_load_test.py --num_clients 32 --num_requests 2000 --max_batch_size 32
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerBatcher, SpanMarkerModel
+
+SENTENCES = [
+    "Cleopatra VII, also known as Cleopatra the Great, was the last active ruler of the Ptolemaic Kingdom of Egypt.",
+    "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    "I'm living in the Netherlands, but I work in Spain.",
+    "The 2023 Tour de France was won by Jonas Vingegaard of Team Jumbo-Visma.",
+]
+
+
+def load_test(
+    handle_request: Callable[[str], object], num_clients: int, num_requests: int
+) -> Tuple[float, List[float]]:
+    """Let ``num_clients`` clients send ``num_requests`` requests in total, each waiting for its previous response."""
+    sentences = (SENTENCES * num_requests)[:num_requests]
+    latencies = []
+    lock = threading.Lock()
+
+    def client(sentence: str) -> None:
+        start_time = time.perf_counter()
+        handle_request(sentence)
+        with lock:
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_clients) as executor:
+        list(executor.map(client, sentences))
+    return num_requests / (time.perf_counter() - start_time), latencies
+
+
+def report(name: str, throughput: float, latencies: List[float]) -> None:
+    p99 = statistics.quantiles(latencies, n=100)[-1]
+    print(
+        f"{name}: {throughput:.1f} requests/sec, {statistics.median(latencies) * 1000:.2f}ms p50,"
+        f" {p99 * 1000:.2f}ms p99 latency"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="tomaarsen/span-marker-bert-tiny-conll03")
+    parser.add_argument("--num_clients", type=int, default=32)
+    parser.add_argument("--num_requests", type=int, default=2000)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_num_tokens", type=int, default=None)
+    parser.add_argument("--max_wait_time", type=float, default=0.005)
+    args = parser.parse_args()
+
+    model = SpanMarkerModel.from_pretrained(args.model).try_cuda()
+    # The model is not thread-safe, so the unbatched clients take turns
+    model_lock = threading.Lock()
+
+    def predict_per_request(sentence: str) -> object:
+        with model_lock:
+            return model.predict(sentence)
+
+    report("predict per request", *load_test(predict_per_request, args.num_clients, args.num_requests))
+
+    with SpanMarkerBatcher(
+        model,
+        max_batch_size=args.max_batch_size,
+        max_num_tokens=args.max_num_tokens,
+        max_wait_time=args.max_wait_time,
+    ) as batcher:
+        report("SpanMarkerBatcher", *load_test(batcher.predict, args.num_clients, args.num_requests))
+        for key, value in batcher.metrics().items():
+            print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
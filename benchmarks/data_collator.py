@@ -0,0 +1,115 @@
+"""
+Micro-benchmark comparing the batched SpanMarkerDataCollator against the original per-sample collation loop.
+
+Usage::
+
+    python benchmarks/data_collator.py --batch_size 32 --repeats 20
+"""
+import argparse
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+from torch.nn import functional as F
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerModel
+from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.trainer import Trainer
+
+SENTENCES = [
+    "Cleopatra VII, also known as Cleopatra the Great, was the last active ruler of the Ptolemaic Kingdom of Egypt.",
+    "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    "I'm living in the Netherlands, but I work in Spain.",
+    "The 2023 Tour de France was won by Jonas Vingegaard of Team Jumbo-Visma.",
+]
+
+
+def loop_collate(collator: SpanMarkerDataCollator, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+    """The original per-sample implementation of ``SpanMarkerDataCollator.__call__``, used as the reference."""
+    tokenizer = collator.tokenizer
+    total_size = tokenizer.model_max_length + 2 * collator.marker_max_length
+    batch = defaultdict(list)
+    start_marker_indices = []
+    num_marker_pairs = []
+    for sample in features:
+        input_ids = sample["input_ids"]
+        num_spans = sample["num_spans"]
+        num_tokens = len(input_ids)
+        start_marker_idx = num_tokens + num_tokens % 2
+        end_marker_idx = start_marker_idx + num_spans
+
+        input_ids = torch.tensor(input_ids, dtype=torch.int)
+        input_ids = F.pad(input_ids, (0, total_size - len(input_ids)), value=tokenizer.pad_token_id)
+        input_ids[start_marker_idx : start_marker_idx + num_spans] = tokenizer.start_marker_id
+        input_ids[end_marker_idx : end_marker_idx + num_spans] = tokenizer.end_marker_id
+        batch["input_ids"].append(input_ids)
+
+        position_ids = torch.arange(num_tokens, dtype=torch.int) + 2
+        position_ids = F.pad(position_ids, (0, total_size - len(position_ids)), value=1)
+        position_ids[start_marker_idx : start_marker_idx + num_spans] = torch.tensor(sample["start_position_ids"]) + 2
+        position_ids[end_marker_idx : end_marker_idx + num_spans] = torch.tensor(sample["end_position_ids"]) + 2
+        batch["position_ids"].append(position_ids)
+
+        attention_mask = torch.zeros((total_size, total_size), dtype=torch.bool)
+        attention_mask[:num_tokens, :num_tokens] = 1
+        attention_mask[start_marker_idx : start_marker_idx + num_spans, :num_tokens] = 1
+        attention_mask[end_marker_idx : end_marker_idx + num_spans, :num_tokens] = 1
+        start_index_list = list(range(start_marker_idx, start_marker_idx + num_spans))
+        end_index_list = list(range(end_marker_idx, end_marker_idx + num_spans))
+        attention_mask[start_index_list, start_index_list] = 1
+        attention_mask[start_index_list, end_index_list] = 1
+        attention_mask[end_index_list, start_index_list] = 1
+        attention_mask[end_index_list, end_index_list] = 1
+        batch["attention_mask"].append(attention_mask)
+
+        start_marker_indices.append(start_marker_idx)
+        num_marker_pairs.append(end_marker_idx - start_marker_idx)
+
+    batch = {key: torch.stack(value) for key, value in batch.items()}
+    batch["start_marker_indices"] = torch.tensor(start_marker_indices)
+    batch["num_marker_pairs"] = torch.tensor(num_marker_pairs)
+    return batch
+
+
+def timeit(func, repeats: int) -> float:
+    func()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start_time) / repeats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="tomaarsen/span-marker-bert-tiny-conll03")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    model = SpanMarkerModel.from_pretrained(args.model)
+    tokenized = model.tokenizer({"tokens": (SENTENCES * args.batch_size)[: args.batch_size]})
+    tokenized = Trainer.spread_sample(
+        tokenized, model_max_length=model.tokenizer.model_max_length, marker_max_length=model.config.marker_max_length
+    )
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+    collator = model.data_collator
+
+    reference = loop_collate(collator, features)
+    batched = collator(features)
+    for key, value in reference.items():
+        assert value.dtype == batched[key].dtype, f"dtype mismatch for {key!r}"
+        assert torch.equal(value, batched[key]), f"value mismatch for {key!r}"
+
+    loop_time = timeit(lambda: loop_collate(collator, features), args.repeats)
+    batched_time = timeit(lambda: collator(features), args.repeats)
+    print(f"Samples per batch: {len(features)}")
+    print(f"Per-sample loop:   {loop_time * 1000:.2f}ms per batch")
+    print(f"Batched collator:  {batched_time * 1000:.2f}ms per batch ({loop_time / batched_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Throughput benchmark for CPU inference with ``SpanMarkerInferencePool``, scaling from 1 to N worker processes.
+
+Every configuration uses the same total number of threads, which are partitioned between the workers.
+
+Usage::
+
+    python benchmarks/inference_pool.py --num_sentences 2000 --max_workers 8
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerInferencePool, SpanMarkerModel
+
+SENTENCES = [
+    "Cleopatra VII, also known as Cleopatra the Great, was the last active ruler of the Ptolemaic Kingdom of Egypt.",
+    "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    "I'm living in the Netherlands, but I work in Spain.",
+    "The 2023 Tour de France was won by Jonas Vingegaard of Team Jumbo-Visma.",
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="tomaarsen/span-marker-bert-tiny-conll03")
+    parser.add_argument("--num_sentences", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--num_threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    model = SpanMarkerModel.from_pretrained(args.model)
+    sentences = (SENTENCES * args.num_sentences)[: args.num_sentences]
+
+    torch.set_num_threads(args.num_threads)
+    start_time = time.perf_counter()
+    reference = model.predict(sentences, batch_size=args.batch_size)
+    single_process_throughput = args.num_sentences / (time.perf_counter() - start_time)
+    print(f"Single process, {args.num_threads} thread(s): {single_process_throughput:.1f} sentences/sec")
+
+    num_workers = 1
+    while num_workers <= args.max_workers:
+        num_threads = max(args.num_threads // num_workers, 1)
+        with SpanMarkerInferencePool(model, num_workers=num_workers, num_threads=num_threads) as pool:
+            # Warm up every worker before timing
+            pool.predict(sentences[: num_workers * 4], batch_size=args.batch_size, shard_size=4)
+            start_time = time.perf_counter()
+            all_entities = pool.predict(sentences, batch_size=args.batch_size)
+            throughput = args.num_sentences / (time.perf_counter() - start_time)
+        # Same spans and labels as the single process predictions
+        for entities, reference_entities in zip(all_entities, reference):
+            assert [(entity["span"], entity["label"]) for entity in entities] == [
+                (entity["span"], entity["label"]) for entity in reference_entities
+            ]
+        print(
+            f"{num_workers} worker(s), {num_threads} thread(s) each: {throughput:.1f} sentences/sec"
+            f" ({throughput / single_process_throughput:.2f}x)"
+        )
+        num_workers *= 2
+
+
+if __name__ == "__main__":
+    main()
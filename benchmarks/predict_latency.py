@@ -0,0 +1,119 @@
+"""
+Latency benchmark comparing the in-memory ``SpanMarkerModel.predict`` against the original Dataset-based inference.
+
+Reports the p50 latency of ``predict`` calls with a single sentence and with many sentences.
+
+Usage::
+
+    python benchmarks/predict_latency.py --num_sentences 1 1000 --repeats 20
+"""
+import argparse
+import dataclasses
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Union
+
+import torch
+from datasets import Dataset, disable_progress_bar
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerModel
+from span_marker.decoding import decode_entities
+from span_marker.trainer import Trainer
+
+SENTENCES = [
+    "Cleopatra VII, also known as Cleopatra the Great, was the last active ruler of the Ptolemaic Kingdom of Egypt.",
+    "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    "I'm living in the Netherlands, but I work in Spain.",
+    "The 2023 Tour de France was won by Jonas Vingegaard of Team Jumbo-Visma.",
+]
+
+
+def dataset_predict(
+    model: SpanMarkerModel, sentences: List[str], batch_size: int
+) -> List[List[Dict[str, Union[str, int, float]]]]:
+    """The original Dataset-based ``SpanMarkerModel.predict`` flow, used as the reference."""
+    model.eval()
+    dataset = Dataset.from_dict({"tokens": sentences})
+    dataset = dataset.add_column("id", range(len(dataset)))
+    results = [{"scores": [], "labels": [], "num_words": None} for _ in sentences]
+    tokenizer_dict = model.tokenizer({"tokens": dataset["tokens"]}, return_num_words=True, return_batch_encoding=True)
+    batch_encoding = tokenizer_dict.pop("batch_encoding")
+    dataset = dataset.remove_columns("tokens")
+    for key, value in tokenizer_dict.items():
+        dataset = dataset.add_column(key, value)
+    dataset = dataset.map(
+        Trainer.spread_sample,
+        batched=True,
+        fn_kwargs={
+            "model_max_length": model.tokenizer.model_max_length,
+            "marker_max_length": model.config.marker_max_length,
+        },
+    )
+    data_collator = dataclasses.replace(model.data_collator, dynamic_padding=True, return_attention_mask=False)
+    for batch_start_idx in range(0, len(dataset), batch_size):
+        batch = dataset.select(range(batch_start_idx, min(len(dataset), batch_start_idx + batch_size)))
+        batch = {key: value.to(model.device) for key, value in data_collator(batch).items()}
+        with torch.no_grad():
+            output = model(**batch)
+        scores, labels = output.logits.softmax(-1).max(-1)
+        for iter_idx in range(output.out_num_marker_pairs.size(0)):
+            # Reads the full "id" column for every sample
+            input_id = dataset["id"][batch_start_idx + iter_idx]
+            num_marker_pairs = output.out_num_marker_pairs[iter_idx]
+            results[input_id]["scores"].extend(scores[iter_idx, :num_marker_pairs].tolist())
+            results[input_id]["labels"].extend(labels[iter_idx, :num_marker_pairs].tolist())
+            results[input_id]["num_words"] = int(output.out_num_words[iter_idx])
+    return decode_entities(
+        sentences,
+        [result["scores"] for result in results],
+        [result["labels"] for result in results],
+        [result["num_words"] for result in results],
+        batch_encoding,
+        entity_max_length=model.config.entity_max_length,
+        id2label=model.config.id2label,
+        outside_id=model.config.outside_id,
+    )
+
+
+def p50_latency(func, repeats: int) -> float:
+    func()
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start_time)
+    return statistics.median(latencies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="tomaarsen/span-marker-bert-tiny-conll03")
+    parser.add_argument("--num_sentences", type=int, nargs="+", default=[1, 1000])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    disable_progress_bar()
+    model = SpanMarkerModel.from_pretrained(args.model).try_cuda()
+    for num_sentences in args.num_sentences:
+        sentences = (SENTENCES * num_sentences)[:num_sentences]
+        # Same spans and labels; the scores may differ slightly as the batches are formed differently
+        for entities, reference in zip(
+            model.predict(sentences, batch_size=args.batch_size), dataset_predict(model, sentences, args.batch_size)
+        ):
+            assert [(entity["span"], entity["label"]) for entity in entities] == [
+                (entity["span"], entity["label"]) for entity in reference
+            ]
+
+        dataset_time = p50_latency(lambda: dataset_predict(model, sentences, args.batch_size), args.repeats)
+        in_memory_time = p50_latency(lambda: model.predict(sentences, batch_size=args.batch_size), args.repeats)
+        print(f"{num_sentences} sentence(s):")
+        print(f"  Dataset-based predict: {dataset_time * 1000:.2f}ms p50")
+        print(f"  In-memory predict:     {in_memory_time * 1000:.2f}ms p50 ({dataset_time / in_memory_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
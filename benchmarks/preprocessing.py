@@ -0,0 +1,61 @@
+"""
+Throughput benchmark for ``Trainer.preprocess_dataset`` on a synthetic IOB2 corpus, scaling from 1 to N processes.
+
+Usage::
+
+    python benchmarks/preprocessing.py --num_sentences 100000 --max_num_proc 8
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from datasets import Dataset, disable_caching
+from transformers import TrainingArguments
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerModel, Trainer
+
+LABELS = ["O", "B-PER", "I-PER", "B-ORG", "I-ORG", "B-LOC", "I-LOC", "B-MISC", "I-MISC"]
+WORDS = (
+    "the of and to in a is was for on as with by he at from his an were are which this be or has had not but first"
+    " one their its new after who they have her she two been other when there all during into school time may"
+    " Amsterdam Paris Jonas Vingegaard Cleopatra Ptolemaic Egypt Lockheed Vega Atlantic Netherlands Spain"
+).split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="prajjwal1/bert-tiny")
+    parser.add_argument("--num_sentences", type=int, default=100000)
+    parser.add_argument("--max_num_proc", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    # Every configuration must preprocess the dataset rather than load it from the datasets cache
+    disable_caching()
+    model = SpanMarkerModel.from_pretrained(args.model, labels=LABELS, entity_max_length=4)
+    rng = random.Random(12)
+    sentences = [rng.choices(WORDS, k=rng.randint(5, 40)) for _ in range(args.num_sentences)]
+    ner_tags = [[rng.choice([0, 0, 0, 1, 2, 3, 4, 5, 6]) for _ in sentence] for sentence in sentences]
+    dataset = Dataset.from_dict({"tokens": sentences, "ner_tags": ner_tags})
+    training_args = TrainingArguments(output_dir="models/benchmark", report_to="none")
+
+    num_proc = 1
+    while num_proc <= args.max_num_proc:
+        trainer = Trainer(model, args=training_args, num_proc=num_proc if num_proc > 1 else None)
+        start_time = time.perf_counter()
+        trainer.preprocess_dataset(dataset, trainer.label_normalizer, model.tokenizer)
+        duration = time.perf_counter() - start_time
+        if num_proc == 1:
+            single_process_duration = duration
+        print(
+            f"{num_proc} process(es): {duration:.2f}s ({args.num_sentences / duration:.0f} sentences/sec,"
+            f" {single_process_duration / duration:.2f}x)"
+        )
+        num_proc *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Throughput benchmark for ``SpanMarkerTokenizer`` on a synthetic corpus of labeled, pre-tokenized sentences.
+
+Compares the unpadded tokenization against the previous approach, which padded every sentence to ``model_max_length``
+as a tensor before slicing the padding off again.
+
+Usage::
+
+    python benchmarks/tokenizer.py --num_sentences 50000 --batch_size 1000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from span_marker import SpanMarkerModel
+from span_marker.decoding import get_span_arrays
+from span_marker.tokenizer import SpanMarkerTokenizer
+
+WORDS = (
+    "the of and to in a is was for on as with by he at from his an were are which this be or has had not but first"
+    " one their its new after who they have her she two been other when there all during into school time may"
+    " Amsterdam Paris Jonas Vingegaard Cleopatra Ptolemaic Egypt Lockheed Vega Atlantic Netherlands Spain"
+).split()
+
+
+def padded_tokenize(tokenizer: SpanMarkerTokenizer, batch: Dict[str, List[Any]]) -> Dict[str, List]:
+    """The previous tokenization, which padded to ``model_max_length`` tensors, used as the reference."""
+    batch_encoding = tokenizer.tokenizer(
+        batch["tokens"],
+        is_split_into_words=True,
+        padding="max_length",
+        truncation=True,
+        max_length=tokenizer.model_max_length,
+        return_tensors="pt",
+    )
+    output = {"input_ids": [], "start_position_ids": [], "end_position_ids": []}
+    for sample_idx, input_ids in enumerate(batch_encoding["input_ids"]):
+        num_words, word_start_positions, word_end_positions = tokenizer.get_word_token_positions(
+            batch_encoding, sample_idx
+        )
+        if tokenizer.tokenizer.pad_token_id in input_ids:
+            num_tokens = list(input_ids).index(tokenizer.tokenizer.pad_token_id)
+        else:
+            num_tokens = len(input_ids)
+        span_starts, span_ends = get_span_arrays(num_words, tokenizer.config.entity_max_length)
+        output["input_ids"].append(input_ids[:num_tokens].tolist())
+        output["start_position_ids"].append(word_start_positions[span_starts].tolist())
+        output["end_position_ids"].append(word_end_positions[span_ends - 1].tolist())
+    return output
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="tomaarsen/span-marker-bert-tiny-conll03")
+    parser.add_argument("--num_sentences", type=int, default=50000)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    args = parser.parse_args()
+
+    tokenizer = SpanMarkerModel.from_pretrained(args.model).tokenizer
+    rng = random.Random(12)
+    sentences = [rng.choices(WORDS, k=rng.randint(5, 40)) for _ in range(args.num_sentences)]
+    ner_tags = [[(1, 0, 1), (2, len(sentence) - 2, len(sentence))] for sentence in sentences]
+    batches = [
+        {
+            "tokens": sentences[start_idx : start_idx + args.batch_size],
+            "ner_tags": ner_tags[start_idx : start_idx + args.batch_size],
+        }
+        for start_idx in range(0, args.num_sentences, args.batch_size)
+    ]
+
+    # Both approaches give the same token and span positions
+    for batch in batches[:2]:
+        output = tokenizer(batch, is_split_into_words=True)
+        reference = padded_tokenize(tokenizer, batch)
+        for key, values in reference.items():
+            assert output[key] == values
+
+    start_time = time.perf_counter()
+    for batch in batches:
+        padded_tokenize(tokenizer, {"tokens": batch["tokens"]})
+    padded_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for batch in batches:
+        tokenizer({"tokens": batch["tokens"]}, is_split_into_words=True)
+    unpadded_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for batch in batches:
+        tokenizer(batch, is_split_into_words=True)
+    labeled_time = time.perf_counter() - start_time
+
+    print(f"Tokenizing {args.num_sentences} sentences:")
+    print(f"  Padded to model_max_length: {padded_time:.2f}s ({args.num_sentences / padded_time:.0f} sentences/sec)")
+    print(
+        f"  Unpadded:                   {unpadded_time:.2f}s ({args.num_sentences / unpadded_time:.0f} sentences/sec,"
+        f" {padded_time / unpadded_time:.2f}x)"
+    )
+    print(f"  Unpadded, with labels:      {labeled_time:.2f}s ({args.num_sentences / labeled_time:.0f} sentences/sec)")
+
+
+if __name__ == "__main__":
+    main()
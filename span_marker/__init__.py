@@ -9,13 +9,16 @@ import torch
 from transformers import AutoConfig, AutoModel, TrainingArguments
 from transformers.pipelines import PIPELINE_REGISTRY, pipeline
 
+from span_marker.batching import SpanMarkerBatcher
 from span_marker.configuration import SpanMarkerConfig
+from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.inference_pool import SpanMarkerInferencePool
 from span_marker.model_card import SpanMarkerModelCardData
 from span_marker.modeling import SpanMarkerModel
+from span_marker.onnx import SpanMarkerOnnx
 from span_marker.pipeline_component import SpanMarkerPipeline
-from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.prediction_cache import PredictionCache
 from span_marker.trainer import Trainer
-from span_marker.onnx import SpanMarkerOnnx
 
 # Set up for Transformers
 AutoConfig.register("span-marker", SpanMarkerConfig)
@@ -0,0 +1,420 @@
+import asyncio
+import copy
+import functools
+import itertools
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from datasets import Dataset
+from typing_extensions import Self
+
+if TYPE_CHECKING:
+    from span_marker.modeling import SpanMarkerModel
+    from span_marker.onnx import SpanMarkerOnnx
+
+
+@dataclass
+class _Request:
+    sentence: Union[str, List[str]]
+    arrival_time: float
+    # Only counted by the batcher thread, as the tokenizer must not be used by multiple threads at once
+    num_tokens: Optional[int] = None
+    # The futures of all callers that submitted this sentence while it was queued or being predicted
+    futures: List[Future] = field(default_factory=list)
+    is_running: bool = False
+
+    @property
+    def is_split_into_words(self) -> bool:
+        return not isinstance(self.sentence, str)
+
+    @property
+    def key(self) -> Hashable:
+        return (self.is_split_into_words, self.sentence if isinstance(self.sentence, str) else tuple(self.sentence))
+
+
+class SpanMarkerBatcher:
+    """Queue single-sentence requests and predict them in dynamically formed batches.
+
+    Requests are submitted one sentence at a time, e.g. by the request handlers of a web server, and are resolved
+    through a :class:`~concurrent.futures.Future`. A background thread collects the queued requests into a batch
+    until the batch holds ``max_batch_size`` sentences, until the next sentence would exceed ``max_num_tokens``
+    tokens, or until the oldest request in the batch has waited for ``max_wait_time`` seconds. Each batch is then
+    predicted in one :meth:`~span_marker.modeling.SpanMarkerModel.predict` call.
+
+    If a sentence is submitted while the same sentence is still queued or being predicted, then both callers share
+    one prediction. For asyncio applications, :meth:`SpanMarkerBatcher.apredict` and
+    :meth:`SpanMarkerBatcher.apredict_iter` await the predictions without blocking the event loop, as the model
+    only runs in the background thread of the batcher.
+
+    Example::
+
+        >>> model = SpanMarkerModel.from_pretrained(...)
+        >>> with SpanMarkerBatcher(model, max_batch_size=32, max_wait_time=0.01) as batcher:
+        ...     future = batcher.submit("Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic.")
+        ...     entities = future.result()
+        >>> batcher.metrics()
+        {'queue_depth': 0, 'max_queue_depth': 1, 'num_requests': 1, 'num_batches': 1, 'mean_batch_size': 1.0, ...}
+
+    Args:
+        model (Union[SpanMarkerModel, SpanMarkerOnnx]): The model to predict with.
+        max_batch_size (int): The maximum number of sentences in a batch. Defaults to 32.
+        max_num_tokens (Optional[int]): The maximum total number of tokens of the sentences in a batch. A sentence
+            with more tokens than this forms a batch on its own. Defaults to no token budget.
+        max_wait_time (float): The maximum number of seconds that a request waits for other requests to join its
+            batch. Defaults to 0.005.
+        batch_size (Optional[int]): The ``batch_size`` for the ``predict`` calls, i.e. the number of samples per
+            forward pass. Defaults to ``max_batch_size``, such that each batch is predicted in one forward pass
+            unless its sentences must be spread over multiple samples.
+    """
+
+    def __init__(
+        self,
+        model: Union["SpanMarkerModel", "SpanMarkerOnnx"],
+        max_batch_size: int = 32,
+        max_num_tokens: Optional[int] = None,
+        max_wait_time: float = 0.005,
+        batch_size: Optional[int] = None,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError(f"`max_batch_size` must be at least 1, but got {max_batch_size}.")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_num_tokens = max_num_tokens
+        self.max_wait_time = max_wait_time
+        self.batch_size = batch_size or max_batch_size
+
+        self._queue: Deque[_Request] = deque()
+        # The queued and running requests, such that duplicate sentences can join them
+        self._pending: Dict[Hashable, _Request] = {}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._num_requests = 0
+        self._num_deduplicated = 0
+        self._max_queue_depth = 0
+        self._batch_sizes = Counter()
+        self._total_wait_time = 0.0
+        self._thread = threading.Thread(target=self._run, name="SpanMarkerBatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, sentence: Union[str, List[str]]) -> Future:
+        """Queue a sentence for prediction.
+
+        Args:
+            sentence (Union[str, List[str]]): A string sentence or a pre-tokenized sentence, i.e. a list of words.
+
+        Returns:
+            Future: A future that resolves to the entities of the sentence, like
+                :meth:`~span_marker.modeling.SpanMarkerModel.predict` with a single sentence. Cancelling the future
+                before its batch is formed removes the sentence from the queue, unless other callers still wait
+                for the same sentence.
+        """
+        if not isinstance(sentence, (str, list)):
+            raise ValueError(
+                "`SpanMarkerBatcher.submit` accepts one sentence, i.e. a string sentence or a list of words,"
+                f" but got {type(sentence).__name__!r}."
+            )
+        request = _Request(sentence, time.perf_counter())
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise ValueError("This `SpanMarkerBatcher` has been closed.")
+            self._num_requests += 1
+            duplicate_request = self._pending.get(request.key)
+            if duplicate_request is not None:
+                # Share the prediction of the same sentence that is already queued or being predicted
+                self._num_deduplicated += 1
+                if duplicate_request.is_running:
+                    future.set_running_or_notify_cancel()
+                duplicate_request.futures.append(future)
+                request = duplicate_request
+            else:
+                request.futures.append(future)
+                self._queue.append(request)
+                self._pending[request.key] = request
+                self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+                self._condition.notify()
+        # Cancelled requests are dequeued immediately, such that they do not count toward the batch limits
+        future.add_done_callback(functools.partial(self._dequeue_if_cancelled, request))
+        return future
+
+    def predict(self, sentence: Union[str, List[str]], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Queue a sentence for prediction and wait for its entities.
+
+        Args:
+            sentence (Union[str, List[str]]): A string sentence or a pre-tokenized sentence, i.e. a list of words.
+            timeout (Optional[float]): The maximum number of seconds to wait. Defaults to waiting indefinitely.
+
+        Returns:
+            List[Dict[str, Any]]: The entities of the sentence.
+        """
+        return self.submit(sentence).result(timeout=timeout)
+
+    async def apredict(self, sentence: Union[str, List[str]], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Queue a sentence for prediction and await its entities, without blocking the event loop.
+
+        Concurrent awaiters are predicted in shared batches. If the awaiting task is cancelled or times out before
+        the batch of the sentence is formed, then the sentence is removed from the queue. A batch that is already
+        being predicted always runs to completion, such that the model is never interrupted halfway.
+
+        Args:
+            sentence (Union[str, List[str]]): A string sentence or a pre-tokenized sentence, i.e. a list of words.
+            timeout (Optional[float]): The maximum number of seconds to wait, after which
+                :class:`asyncio.TimeoutError` is raised. Defaults to waiting indefinitely.
+
+        Returns:
+            List[Dict[str, Any]]: The entities of the sentence.
+        """
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(sentence)), timeout)
+
+    async def apredict_iter(
+        self,
+        inputs: Union[Iterable[Union[str, List[str]]], AsyncIterable[Union[str, List[str]]]],
+        max_in_flight: Optional[int] = None,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Predict a stream of sentences, yielding the entities of each sentence in order.
+
+        Example::
+
+            >>> async for entities in batcher.apredict_iter(sentence_stream):
+            ...     print(entities)
+
+        Args:
+            inputs (Union[Iterable[Union[str, List[str]]], AsyncIterable[Union[str, List[str]]]]): An iterable or
+                asynchronous iterable of string sentences or pre-tokenized sentences.
+            max_in_flight (Optional[int]): The maximum number of sentences that are queued or being predicted
+                at once. Defaults to twice ``max_batch_size``, such that the next batch is formed while the current
+                batch is predicted.
+
+        Yields:
+            List[Dict[str, Any]]: The entities of each sentence, in the order of the inputs.
+        """
+        max_in_flight = max_in_flight or 2 * self.max_batch_size
+        in_flight: Deque[asyncio.Future] = deque()
+        try:
+            async for sentence in _as_async_iterator(inputs):
+                in_flight.append(asyncio.wrap_future(self.submit(sentence)))
+                if len(in_flight) >= max_in_flight:
+                    yield await in_flight.popleft()
+            while in_flight:
+                yield await in_flight.popleft()
+        finally:
+            # If the consumer stops early or is cancelled, then the remaining sentences are dequeued
+            for future in in_flight:
+                future.cancel()
+
+    def metrics(self) -> Dict[str, Union[int, float, Dict[int, int]]]:
+        """Report the queue depth and batch size metrics.
+
+        Returns:
+            Dict[str, Union[int, float, Dict[int, int]]]: A dictionary with the following keys:
+
+            * ``queue_depth``: The number of requests that are currently queued.
+            * ``max_queue_depth``: The largest number of requests that were queued at once.
+            * ``num_requests``: The number of submitted requests.
+            * ``num_deduplicated``: The number of requests that shared the prediction of an identical queued or
+              running request.
+            * ``num_batches``: The number of predicted batches.
+            * ``mean_batch_size``: The mean number of unique sentences per batch.
+            * ``batch_sizes``: A mapping of batch sizes to the number of batches with that size.
+            * ``mean_wait_time``: The mean number of seconds that a request was queued before its batch started.
+        """
+        with self._condition:
+            num_batches = sum(self._batch_sizes.values())
+            num_batched_requests = sum(size * count for size, count in self._batch_sizes.items())
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._max_queue_depth,
+                "num_requests": self._num_requests,
+                "num_deduplicated": self._num_deduplicated,
+                "num_batches": num_batches,
+                "mean_batch_size": num_batched_requests / num_batches if num_batches else 0.0,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "mean_wait_time": self._total_wait_time / num_batched_requests if num_batched_requests else 0.0,
+            }
+
+    def close(self) -> None:
+        """Predict the remaining queued requests, and then stop the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _dequeue_if_cancelled(self, request: _Request, future: Future) -> None:
+        if not future.cancelled():
+            return
+        with self._condition:
+            # Requests that are already being predicted, or that other callers still wait for, remain
+            if request.is_running or not all(future.cancelled() for future in request.futures):
+                return
+            if self._pending.get(request.key) is request:
+                del self._pending[request.key]
+                self._queue.remove(request)
+            # The batch that is being formed may now fit more requests
+            self._condition.notify()
+
+    def _count_tokens(self, sentence: Union[str, List[str]]) -> int:
+        encoding = self.model.tokenizer.tokenizer(sentence, is_split_into_words=not isinstance(sentence, str))
+        return len(encoding["input_ids"])
+
+    def _count_queued_tokens(self) -> None:
+        """Count the tokens of the requests that may join the next batch, if that is required for ``max_num_tokens``.
+
+        Must be called while holding ``self._condition``, which is released while tokenizing, such that submitting
+        and cancelling requests is never blocked by the tokenizer. Requests whose sentence cannot be tokenized are
+        dequeued and fail with the exception of the tokenizer.
+        """
+        while self.max_num_tokens is not None:
+            requests = [
+                request for request in itertools.islice(self._queue, self.max_batch_size) if request.num_tokens is None
+            ]
+            if not requests:
+                return
+            failed_requests = []
+            self._condition.release()
+            try:
+                for request in requests:
+                    try:
+                        request.num_tokens = self._count_tokens(request.sentence)
+                    except Exception as exc:
+                        failed_requests.append((request, exc))
+            finally:
+                self._condition.acquire()
+            for request, exception in failed_requests:
+                self._fail_requests([request], exception)
+
+    def _fail_requests(self, requests: List[_Request], exception: Exception) -> None:
+        """Dequeue the requests and set the exception on their futures. Must be called while holding
+        ``self._condition``."""
+        for request in requests:
+            if self._pending.get(request.key) is request:
+                del self._pending[request.key]
+                if not request.is_running:
+                    self._queue.remove(request)
+            for future in request.futures:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(exception)
+
+    def _predict_batch(self, sentences: List[Union[str, List[str]]]) -> List[List[Dict[str, Any]]]:
+        from span_marker.modeling import SpanMarkerModel
+
+        if isinstance(self.model, SpanMarkerModel):
+            # The sentences are already a plain list, so skip the input parsing of `predict`. This also ensures
+            # that a batch with a single pre-tokenized sentence is not mistaken for a list of string sentences
+            self.model.eval()
+            return self.model._predict_sentences(sentences, batch_size=self.batch_size)
+        # SpanMarkerOnnx converts its inputs into a Dataset regardless, which is recognized as a list of sentences
+        # even if the batch consists of a single pre-tokenized sentence
+        return self.model.predict(Dataset.from_dict({"tokens": sentences}), batch_size=self.batch_size)
+
+    def _batch_length(self) -> Tuple[int, bool]:
+        """Compute how many requests from the front of the queue fit in one batch, and whether that batch is full,
+        i.e. whether waiting for more requests cannot grow it. Must be called while holding ``self._condition``."""
+        self._count_queued_tokens()
+        num_tokens = 0
+        for idx, request in enumerate(self._queue):
+            if idx == self.max_batch_size:
+                return idx, True
+            # Pre-tokenized and string sentences are predicted in separate batches
+            if idx > 0 and request.is_split_into_words != self._queue[0].is_split_into_words:
+                return idx, True
+            if self.max_num_tokens is not None:
+                num_tokens += request.num_tokens
+                if idx > 0 and num_tokens > self.max_num_tokens:
+                    return idx, True
+        return len(self._queue), len(self._queue) == self.max_batch_size
+
+    def _next_batch(self) -> Optional[List[_Request]]:
+        with self._condition:
+            while True:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return None
+                # Wait for more requests until the batch is full, or until the oldest request has waited long enough.
+                # The oldest request may change while waiting, as cancelled requests are dequeued
+                batch_length, is_full = self._batch_length()
+                while not is_full and not self._closed and self._queue:
+                    remaining_time = self._queue[0].arrival_time + self.max_wait_time - time.perf_counter()
+                    if remaining_time <= 0:
+                        break
+                    self._condition.wait(remaining_time)
+                    batch_length, is_full = self._batch_length()
+
+                start_time = time.perf_counter()
+                batch = []
+                for _ in range(batch_length):
+                    request = self._queue.popleft()
+                    # Skip the requests for which every caller has cancelled their future
+                    request.futures = [future for future in request.futures if future.set_running_or_notify_cancel()]
+                    if request.futures:
+                        request.is_running = True
+                        batch.append(request)
+                        self._total_wait_time += start_time - request.arrival_time
+                    else:
+                        del self._pending[request.key]
+                if batch:
+                    self._batch_sizes[len(batch)] += 1
+                    return batch
+
+    def _run(self) -> None:
+        while True:
+            try:
+                batch = self._next_batch()
+            except Exception as exc:
+                # Rather than stopping the thread and leaving every caller waiting forever, fail the queued requests
+                with self._condition:
+                    self._fail_requests(list(self._queue), exc)
+                continue
+            if batch is None:
+                return
+            all_entities = None
+            exception = None
+            try:
+                all_entities = self._predict_batch([request.sentence for request in batch])
+            except Exception as exc:
+                exception = exc
+
+            # Duplicate sentences can no longer join these requests once they are no longer pending
+            with self._condition:
+                for request in batch:
+                    del self._pending[request.key]
+            for request_idx, request in enumerate(batch):
+                for future_idx, future in enumerate(request.futures):
+                    if exception is not None:
+                        future.set_exception(exception)
+                    else:
+                        # Every caller gets their own copy of the entities, as they can be modified
+                        entities = all_entities[request_idx]
+                        future.set_result(entities if future_idx == 0 else copy.deepcopy(entities))
+
+
+async def _as_async_iterator(inputs: Union[Iterable[Any], AsyncIterable[Any]]) -> AsyncIterator[Any]:
+    if isinstance(inputs, AsyncIterable):
+        async for element in inputs:
+            yield element
+    else:
+        for element in inputs:
+            yield element
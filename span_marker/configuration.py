@@ -24,6 +24,10 @@ class SpanMarkerConfig(PretrainedConfig):
         max_next_context (`Optional[int]`): The maximum number of next sentences to include as
             context. If `None`, the maximum amount that fits in `model_max_length` is chosen.
             Defaults to `None`.
+        sparse_marker_attention (`bool`): Whether to compute the attention of the text tokens and the
+            markers separately, such that the markers only attend the text, themselves and their partner,
+            rather than computing the dense attention with the SpanMarker attention mask. Only supported for
+            BERT-like encoders with absolute position embeddings. Defaults to `False`.
 
     Example::
 
@@ -52,6 +56,7 @@ class SpanMarkerConfig(PretrainedConfig):
         entity_max_length: int = 8,
         max_prev_context: Optional[int] = None,
         max_next_context: Optional[int] = None,
+        sparse_marker_attention: bool = False,
         **kwargs,
     ) -> None:
         self.encoder = encoder_config
@@ -61,6 +66,7 @@ class SpanMarkerConfig(PretrainedConfig):
         self.entity_max_length = entity_max_length
         self.max_prev_context = max_prev_context
         self.max_next_context = max_next_context
+        self.sparse_marker_attention = sparse_marker_attention
         self.trained_with_document_context = False
         self.span_marker_version = kwargs.pop("span_marker_version", None)
         super().__init__(**kwargs)
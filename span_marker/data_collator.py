@@ -1,9 +1,8 @@
-from collections import defaultdict
+import math
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
-from torch.nn import functional as F
 
 from span_marker.tokenizer import SpanMarkerTokenizer
 
@@ -20,6 +19,18 @@ class SpanMarkerDataCollator:
 
     Lastly, the attention matrix is computed.
 
+    Samples may also consist of multiple packed sentences, as created by
+    :meth:`~span_marker.trainer.Trainer.pack_samples`. For these, ``segment_ids`` denote which sentence each text token and marker belongs to, such that the
+    sentences cannot attend each other, and the position IDs of the text tokens restart for each sentence.
+
+    All of these tensors are computed for the whole batch at once, using broadcasted comparisons between
+    the sequence positions and the per-sample ``num_tokens`` and ``num_spans``.
+
+    By default, every sample is padded to ``tokenizer.model_max_length + 2 * marker_max_length``. If
+    ``dynamic_padding`` is set, then each batch is only padded to the longest text-plus-markers length in
+    that batch instead, rounded up to a multiple of ``pad_to_multiple_of``. As the attention is quadratic
+    in the sequence length, this is considerably faster for batches of short sentences.
+
     The expected usage is something like:
 
     >>> collator = SpanMarkerDataCollator(...)
@@ -30,6 +41,9 @@ class SpanMarkerDataCollator:
 
     tokenizer: SpanMarkerTokenizer
     marker_max_length: int
+    dynamic_padding: bool = False
+    pad_to_multiple_of: Optional[int] = 8
+    return_attention_mask: bool = True
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
         """Convert the minimal tokenizer outputs into inputs ready for :meth:`~span_marker.modeling.SpanMarkerModel.forward`.
@@ -45,86 +59,204 @@ class SpanMarkerDataCollator:
                 * ``labels`` (optional): The labels corresponding to each of the spans in the sample.
                 * ``num_words`` (optional): The number of words in the input sample.
                     Required for some evaluation metrics.
+                * ``packed_num_tokens`` & ``packed_num_spans`` (optional): The number of tokens and spans of each
+                    sentence in a packed sample.
 
         Returns:
             Dict[str, torch.Tensor]: Batch dictionary ready to be fed into :meth:`~span_marker.modeling.SpanMarkerModel.forward`.
         """
-        total_size = self.tokenizer.model_max_length + 2 * self.marker_max_length
-        batch = defaultdict(list)
-        num_words = []
-        document_ids = []
-        sentence_ids = []
-        start_marker_indices = []
-        num_marker_pairs = []
-        for sample in features:
-            input_ids = sample["input_ids"]
-            num_spans = sample["num_spans"]
-            num_tokens = len(input_ids)
-
-            # The start markers start after the input IDs, rounded up to the nearest even number
-            start_marker_idx = num_tokens + num_tokens % 2
-            end_marker_idx = start_marker_idx + num_spans
-
-            # Prepare input_ids by padding and adding start and end markers
-            if not isinstance(input_ids, torch.Tensor):
-                input_ids = torch.tensor(input_ids, dtype=torch.int)
-            else:
-                input_ids.to(torch.int)
-            input_ids = F.pad(input_ids, (0, total_size - len(input_ids)), value=self.tokenizer.pad_token_id)
-            input_ids[start_marker_idx : start_marker_idx + num_spans] = self.tokenizer.start_marker_id
-            input_ids[end_marker_idx : end_marker_idx + num_spans] = self.tokenizer.end_marker_id
-            batch["input_ids"].append(input_ids)
-
-            # Prepare position IDs
-            position_ids = torch.arange(num_tokens, dtype=torch.int) + 2
-            position_ids = F.pad(position_ids, (0, total_size - len(position_ids)), value=1)
-            position_ids[start_marker_idx : start_marker_idx + num_spans] = (
-                torch.tensor(sample["start_position_ids"]) + 2
+        features = list(features)
+        first_sample = features[0]
+
+        all_input_ids = [_to_list(sample["input_ids"]) for sample in features]
+        num_tokens = torch.tensor([len(input_ids) for input_ids in all_input_ids])
+        num_spans = torch.tensor([sample["num_spans"] for sample in features])
+
+        # The start markers start after the input IDs, rounded up to the nearest even number
+        start_marker_indices = num_tokens + num_tokens % 2
+        end_marker_indices = start_marker_indices + num_spans
+
+        total_size = self.get_total_size(end_marker_indices + num_spans)
+
+        # Boolean (batch_size, total_size) masks denoting the text tokens, start markers and end markers
+        is_text, is_start_marker, is_end_marker = get_token_type_masks(
+            num_tokens, start_marker_indices, num_spans, total_size
+        )
+        positions = torch.arange(total_size)
+
+        # Prepare input_ids by padding and adding start and end markers. Boolean mask assignment fills
+        # the masked values in row-major order, i.e. sample by sample, so we can use concatenated lists
+        input_ids = torch.full((len(features), total_size), self.tokenizer.pad_token_id, dtype=torch.int)
+        input_ids[is_text] = torch.tensor(_concat(all_input_ids), dtype=torch.int)
+        input_ids[is_start_marker] = self.tokenizer.start_marker_id
+        input_ids[is_end_marker] = self.tokenizer.end_marker_id
+
+        # Prepare position IDs. Increase the position_ids by 2, inspired by PL-Marker. The intuition is that
+        # these position IDs better match the circumstances under which the underlying encoders are trained.
+        position_ids = torch.where(is_text, positions + 2, torch.ones_like(positions)).to(torch.int)
+        position_ids[is_start_marker] = (
+            torch.tensor(_concat(_to_list(sample["start_position_ids"]) for sample in features), dtype=torch.int) + 2
+        )
+        position_ids[is_end_marker] = (
+            torch.tensor(_concat(_to_list(sample["end_position_ids"]) for sample in features), dtype=torch.int) + 2
+        )
+
+        batch = {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+        }
+        segment_ids = None
+        if "packed_num_tokens" in first_sample:
+            # The index of the sentence in the packed sample for each text token and marker, and -1 for padding
+            segment_ids = torch.full((len(features), total_size), -1, dtype=torch.int)
+            packed_num_tokens = [_to_list(sample["packed_num_tokens"]) for sample in features]
+            packed_num_spans = [_to_list(sample["packed_num_spans"]) for sample in features]
+            text_segment_ids = _segment_ids(packed_num_tokens)
+            marker_segment_ids = _segment_ids(packed_num_spans)
+            segment_ids[is_text] = text_segment_ids
+            segment_ids[is_start_marker] = marker_segment_ids
+            segment_ids[is_end_marker] = marker_segment_ids
+            # Restart the text position IDs for each sentence, as if the sentences were separate samples
+            sentence_starts = torch.tensor(
+                _concat(_cumulative_starts(num_tokens) for num_tokens in packed_num_tokens), dtype=torch.int
+            )
+            position_ids[is_text] -= sentence_starts.repeat_interleave(torch.tensor(_concat(packed_num_tokens)))
+            batch["segment_ids"] = segment_ids
+        if self.return_attention_mask:
+            batch["attention_mask"] = build_attention_mask(
+                num_tokens, start_marker_indices, num_spans, total_size, segment_ids=segment_ids
             )
-            position_ids[end_marker_idx : end_marker_idx + num_spans] = torch.tensor(sample["end_position_ids"]) + 2
-            # Increase the position_ids by 2, inspired by PL-Marker. The intuition is that these position IDs
-            # better match the circumstances under which the underlying encoders are trained.
-            batch["position_ids"].append(position_ids)
-
-            # Prepare attention mask matrix
-            attention_mask = torch.zeros((total_size, total_size), dtype=torch.bool)
-            # text tokens self-attention
-            attention_mask[:num_tokens, :num_tokens] = 1
-            # let markers attend text tokens
-            attention_mask[start_marker_idx : start_marker_idx + num_spans, :num_tokens] = 1
-            attention_mask[end_marker_idx : end_marker_idx + num_spans, :num_tokens] = 1
-            # self-attentions of start/end markers
-            start_index_list = list(range(start_marker_idx, start_marker_idx + num_spans))
-            end_index_list = list(range(end_marker_idx, end_marker_idx + num_spans))
-            attention_mask[start_index_list, start_index_list] = 1
-            attention_mask[start_index_list, end_index_list] = 1
-            attention_mask[end_index_list, start_index_list] = 1
-            attention_mask[end_index_list, end_index_list] = 1
-            batch["attention_mask"].append(attention_mask)
-
-            # Add start of the markers, so the model knows where the input IDs end and where the markers start
-            start_marker_indices.append(start_marker_idx)
-            num_marker_pairs.append(end_marker_idx - start_marker_idx)
-
-            if "num_words" in sample:
-                num_words.append(sample["num_words"])
-            if "document_id" in sample:
-                document_ids.append(sample["document_id"])
-            if "sentence_id" in sample:
-                sentence_ids.append(sample["sentence_id"])
-            if "labels" in sample:
-                labels = torch.tensor(sample["labels"])
-                labels = F.pad(labels, (0, (total_size // 2) - len(labels)), value=-100)
-                batch["labels"].append(labels)
-
-        batch = {key: torch.stack(value) for key, value in batch.items()}
+        if "labels" in first_sample:
+            labels = torch.full((len(features), total_size // 2), -100, dtype=torch.long)
+            is_label = torch.arange(total_size // 2) < num_spans[:, None]
+            labels[is_label] = torch.tensor(
+                _concat(_to_list(sample["labels"]) for sample in features), dtype=torch.long
+            )
+            batch["labels"] = labels
+
         # Used for evaluation, does not need to be padded/stacked
-        if num_words:
-            batch["num_words"] = torch.tensor(num_words)
-        if document_ids:
-            batch["document_ids"] = torch.tensor(document_ids)
-        if sentence_ids:
-            batch["sentence_ids"] = torch.tensor(sentence_ids)
-        batch["start_marker_indices"] = torch.tensor(start_marker_indices)
-        batch["num_marker_pairs"] = torch.tensor(num_marker_pairs)
+        if "num_words" in first_sample:
+            batch["num_words"] = torch.tensor([sample["num_words"] for sample in features])
+        if "document_id" in first_sample:
+            batch["document_ids"] = torch.tensor([sample["document_id"] for sample in features])
+        if "sentence_id" in first_sample:
+            batch["sentence_ids"] = torch.tensor([sample["sentence_id"] for sample in features])
+        # Add start of the markers, so the model knows where the input IDs end and where the markers start
+        batch["start_marker_indices"] = start_marker_indices
+        batch["num_marker_pairs"] = num_spans
+        # Together with the two above, sufficient to compute the attention mask in the model
+        batch["num_tokens"] = num_tokens
         return batch
+
+    def get_total_size(self, sample_lengths: torch.Tensor) -> int:
+        """Compute the length that all samples in the batch are padded to.
+
+        Args:
+            sample_lengths (torch.Tensor): The number of text tokens plus markers of each sample, i.e.
+                the index directly after the last end marker.
+
+        Returns:
+            int: The padded sequence length of the batch.
+        """
+        max_total_size = self.tokenizer.model_max_length + 2 * self.marker_max_length
+        if not self.dynamic_padding:
+            return max_total_size
+
+        total_size = int(sample_lengths.max())
+        if self.pad_to_multiple_of:
+            total_size = math.ceil(total_size / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        return min(total_size, max_total_size)
+
+
+def get_token_type_masks(
+    num_tokens: torch.Tensor, start_marker_indices: torch.Tensor, num_marker_pairs: torch.Tensor, sequence_length: int
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Compute which positions in each sample are text tokens, start markers and end markers.
+
+    Args:
+        num_tokens (torch.Tensor): The number of text tokens of each sample, with shape ``(batch_size,)``.
+        start_marker_indices (torch.Tensor): The index of the first start marker of each sample.
+        num_marker_pairs (torch.Tensor): The number of start/end marker pairs of each sample.
+        sequence_length (int): The padded length of the samples.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: Three boolean tensors with shape
+            ``(batch_size, sequence_length)``, for the text tokens, start markers and end markers, respectively.
+    """
+    positions = torch.arange(sequence_length, device=num_tokens.device)
+    num_tokens = num_tokens.to(positions.dtype)[:, None]
+    start_marker_indices = start_marker_indices.to(positions.dtype)[:, None]
+    end_marker_indices = start_marker_indices + num_marker_pairs.to(positions.dtype)[:, None]
+    is_text = positions < num_tokens
+    is_start_marker = (positions >= start_marker_indices) & (positions < end_marker_indices)
+    is_end_marker = (positions >= end_marker_indices) & (positions < 2 * end_marker_indices - start_marker_indices)
+    return is_text, is_start_marker, is_end_marker
+
+
+def build_attention_mask(
+    num_tokens: torch.Tensor,
+    start_marker_indices: torch.Tensor,
+    num_marker_pairs: torch.Tensor,
+    sequence_length: int,
+    segment_ids: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Build the block-structured SpanMarker attention mask from compact per-sample vectors:
+
+    * text tokens attend all text tokens,
+    * start/end markers attend all text tokens,
+    * start/end markers attend themselves and their partner end/start marker.
+
+    If ``segment_ids`` are provided, then text tokens and markers only attend the text tokens of their own
+    sentence, i.e. the text attention is block-diagonal for samples with packed sentences.
+
+    Only uses tensor operations on the device of the inputs, so it can be used inside the model and traced for
+    exporting.
+
+    Args:
+        num_tokens (torch.Tensor): The number of text tokens of each sample, with shape ``(batch_size,)``.
+        start_marker_indices (torch.Tensor): The index of the first start marker of each sample.
+        num_marker_pairs (torch.Tensor): The number of start/end marker pairs of each sample.
+        sequence_length (int): The padded length of the samples.
+        segment_ids (Optional[torch.Tensor]): The index of the packed sentence that each text token and marker
+            belongs to, with shape ``(batch_size, sequence_length)``. Defaults to None.
+
+    Returns:
+        torch.Tensor: A boolean attention mask with shape ``(batch_size, sequence_length, sequence_length)``.
+    """
+    is_text, is_start_marker, is_end_marker = get_token_type_masks(
+        num_tokens, start_marker_indices, num_marker_pairs, sequence_length
+    )
+    is_marker = is_start_marker | is_end_marker
+    attention_mask = (is_text | is_marker)[:, :, None] & is_text[:, None, :]
+    # offsets[i, j] = j - i, i.e. the distance from the query position to the key position
+    positions = torch.arange(sequence_length, device=num_tokens.device)
+    offsets = (positions[None, :] - positions[:, None])[None]
+    num_marker_pairs = num_marker_pairs.to(positions.dtype)[:, None, None]
+    attention_mask = attention_mask | (is_marker[:, :, None] & (offsets == 0))
+    attention_mask = attention_mask | (is_start_marker[:, :, None] & (offsets == num_marker_pairs))
+    attention_mask = attention_mask | (is_end_marker[:, :, None] & (offsets == -num_marker_pairs))
+    if segment_ids is not None:
+        attention_mask = attention_mask & (segment_ids[:, :, None] == segment_ids[:, None, :])
+    return attention_mask
+
+
+def _to_list(values: Any) -> List[int]:
+    if isinstance(values, torch.Tensor):
+        return values.tolist()
+    return values
+
+
+def _concat(lists: Any) -> List[int]:
+    return [value for values in lists for value in values]
+
+
+def _cumulative_starts(lengths: List[int]) -> List[int]:
+    starts = [0]
+    for length in lengths[:-1]:
+        starts.append(starts[-1] + length)
+    return starts
+
+
+def _segment_ids(packed_lengths: List[List[int]]) -> torch.Tensor:
+    segment_ids = _concat(range(len(lengths)) for lengths in packed_lengths)
+    return torch.tensor(segment_ids, dtype=torch.int).repeat_interleave(torch.tensor(_concat(packed_lengths)))
@@ -0,0 +1,216 @@
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from transformers import BatchEncoding
+
+
+# Sentences rarely have more than a few hundred words, so this covers all (num_words, entity_max_length) pairs
+# that occur in practice while bounding the memory usage
+@lru_cache(maxsize=4096)
+def get_span_arrays(num_words: int, entity_max_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute the start and end word indices of all valid spans, in the same order as
+    :meth:`~span_marker.tokenizer.SpanMarkerTokenizer.get_all_valid_spans`.
+
+    The spans are computed once for every combination of ``num_words`` and ``entity_max_length``, and are shared
+    between all callers, so the returned arrays are read-only.
+
+    Args:
+        num_words (int): The number of words in the sentence.
+        entity_max_length (int): The maximum number of words in a span.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The inclusive start and exclusive end word indices of each span.
+    """
+    span_starts = np.arange(num_words)
+    spans_per_start = np.minimum(entity_max_length, num_words - span_starts)
+    starts = np.repeat(span_starts, spans_per_start)
+    # The index of each span within the spans with the same start, i.e. its length minus one
+    first_span_indices = np.cumsum(spans_per_start) - spans_per_start
+    span_lengths = np.arange(len(starts)) - np.repeat(first_span_indices, spans_per_start) + 1
+    ends = starts + span_lengths
+    starts.flags.writeable = False
+    ends.flags.writeable = False
+    return starts, ends
+
+
+@lru_cache(maxsize=4096)
+def get_spans(num_words: int, entity_max_length: int) -> Tuple[Tuple[int, int], ...]:
+    """Compute the ``(start, end)`` word indices of all valid spans, like :func:`get_span_arrays`.
+
+    Args:
+        num_words (int): The number of words in the sentence.
+        entity_max_length (int): The maximum number of words in a span.
+
+    Returns:
+        Tuple[Tuple[int, int], ...]: The inclusive start and exclusive end word index of each span.
+    """
+    starts, ends = get_span_arrays(num_words, entity_max_length)
+    return tuple(zip(starts.tolist(), ends.tolist()))
+
+
+def get_word_char_offsets(batch_encoding: BatchEncoding, sentence_idx: int, num_words: int) -> np.ndarray:
+    """Compute the character start and end offsets of all words in a sentence at once.
+
+    Equivalent to calling ``batch_encoding.word_to_chars`` for every word.
+
+    Args:
+        batch_encoding (BatchEncoding): The output of a fast tokenizer.
+        sentence_idx (int): The index of the sentence in the batch encoding.
+        num_words (int): The number of words in the sentence.
+
+    Returns:
+        np.ndarray: An array with shape ``(num_words, 2)`` with the character start and end of each word.
+    """
+    word_ids = np.array([-1 if word_id is None else word_id for word_id in batch_encoding.word_ids(sentence_idx)])
+    token_offsets = np.array(batch_encoding.encodings[sentence_idx].offsets).reshape(-1, 2)
+    is_word = word_ids >= 0
+    word_ids = word_ids[is_word]
+    token_offsets = token_offsets[is_word]
+
+    char_starts = np.full(num_words, np.iinfo(np.int64).max, dtype=np.int64)
+    char_ends = np.zeros(num_words, dtype=np.int64)
+    np.minimum.at(char_starts, word_ids, token_offsets[:, 0])
+    np.maximum.at(char_ends, word_ids, token_offsets[:, 1])
+    # Words without tokens, e.g. '\u2063', are placed directly after the previous word
+    char_ends = np.maximum.accumulate(char_ends)
+    char_starts = np.minimum(char_starts, char_ends)
+    return np.stack((char_starts, char_ends), axis=1)
+
+
+def select_entities(
+    starts: np.ndarray, ends: np.ndarray, scores: np.ndarray, labels: np.ndarray, outside_id: int
+) -> np.ndarray:
+    """Greedily select the non-overlapping spans with the highest scores, ignoring spans labeled as ``outside_id``.
+
+    Rather than visiting the spans one by one in order of their scores, every round selects all remaining spans
+    that do not overlap with any higher scoring remaining span, and discards the spans that overlap with those.
+    This gives the same spans as the one-by-one greedy selection, but only takes as many rounds as the length of
+    the longest chain of overlapping spans.
+
+    Args:
+        starts (np.ndarray): The start word index of each span. Spans of different sentences must not overlap,
+            e.g. by offsetting the word indices of each sentence by the number of preceding words.
+        ends (np.ndarray): The exclusive end word index of each span.
+        scores (np.ndarray): The score of each span.
+        labels (np.ndarray): The label ID of each span.
+        outside_id (int): The label ID of spans that are not entities.
+
+    Returns:
+        np.ndarray: The indices of the selected spans, sorted by their start index.
+    """
+    candidates = np.flatnonzero(labels != outside_id)
+    if len(candidates) == 0:
+        return candidates
+    # Sort the candidates by their start, and rank them by their score. Ties are broken by the original order
+    candidates = candidates[np.argsort(starts[candidates], kind="stable")]
+    starts = starts[candidates]
+    ends = ends[candidates]
+    ranks = np.empty(len(candidates), dtype=np.int64)
+    ranks[np.lexsort((candidates, -scores[candidates]))] = np.arange(len(candidates))
+
+    # All pairs of distinct overlapping candidates (i, j), i.e. j starts before i ends and ends after i starts
+    max_length = int((ends - starts).max())
+    lower = np.searchsorted(starts, starts - max_length, side="right")
+    upper = np.searchsorted(starts, ends, side="left")
+    left = np.repeat(np.arange(len(candidates)), upper - lower)
+    right = np.arange(len(left)) - np.repeat(np.cumsum(upper - lower) - (upper - lower), upper - lower)
+    right = right + np.repeat(lower, upper - lower)
+    is_pair = (left != right) & (ends[right] > starts[left])
+    left = left[is_pair]
+    right = right[is_pair]
+
+    remaining = np.ones(len(candidates), dtype=bool)
+    selected = np.zeros(len(candidates), dtype=bool)
+    while remaining.any():
+        # A remaining candidate is blocked if it overlaps with a remaining candidate with a higher score
+        is_blocking = remaining[left] & remaining[right] & (ranks[right] < ranks[left])
+        blocked = np.zeros(len(candidates), dtype=bool)
+        blocked[left[is_blocking]] = True
+        newly_selected = remaining & ~blocked
+        selected |= newly_selected
+        # Candidates that overlap with a selected candidate can never be selected
+        discarded = np.zeros(len(candidates), dtype=bool)
+        discarded[left[newly_selected[right]]] = True
+        remaining &= ~newly_selected & ~discarded
+    return candidates[selected]
+
+
+def decode_entities(
+    sentences: List[Union[str, List[str]]],
+    all_scores: List[List[float]],
+    all_labels: List[List[int]],
+    all_num_words: List[int],
+    batch_encoding: Optional[BatchEncoding],
+    entity_max_length: int,
+    id2label: Dict[int, str],
+    outside_id: int,
+) -> List[List[Dict[str, Union[str, int, float]]]]:
+    """Convert the span scores and labels of many sentences into entities at once.
+
+    Args:
+        sentences (List[Union[str, List[str]]]): String sentences or pre-tokenized sentences.
+        all_scores (List[List[float]]): The score of each valid span, for each sentence.
+        all_labels (List[List[int]]): The label ID of each valid span, for each sentence.
+        all_num_words (List[int]): The number of words of each sentence.
+        batch_encoding (Optional[BatchEncoding]): The output of the tokenizer, used to compute the character
+            offsets of the entities in string sentences.
+        entity_max_length (int): The maximum number of words in a span.
+        id2label (Dict[int, str]): Mapping of label IDs to labels.
+        outside_id (int): The label ID of spans that are not entities.
+
+    Returns:
+        List[List[Dict[str, Union[str, int, float]]]]: The entities of each sentence, sorted by their position.
+    """
+    span_arrays = [get_span_arrays(int(num_words), entity_max_length) for num_words in all_num_words]
+    for (starts, _ends), scores, labels in zip(span_arrays, all_scores, all_labels):
+        assert len(starts) == len(scores) and len(starts) == len(labels)
+    if not span_arrays:
+        return []
+
+    # Offset the word indices of each sentence, such that spans of different sentences never overlap
+    word_offsets = np.cumsum([0] + list(all_num_words[:-1]))
+    sentence_indices = np.repeat(np.arange(len(sentences)), [len(starts) for starts, _ends in span_arrays])
+    starts = np.concatenate([starts for starts, _ends in span_arrays])
+    ends = np.concatenate([ends for _starts, ends in span_arrays])
+    scores = np.concatenate([np.asarray(scores, dtype=np.float64) for scores in all_scores])
+    labels = np.concatenate([np.asarray(labels, dtype=np.int64) for labels in all_labels])
+    selected = select_entities(
+        starts + word_offsets[sentence_indices], ends + word_offsets[sentence_indices], scores, labels, outside_id
+    )
+
+    all_entities = [[] for _ in sentences]
+    char_offsets = {}
+    for sentence_idx, word_start_index, word_end_index, score, label_id in zip(
+        sentence_indices[selected].tolist(),
+        starts[selected].tolist(),
+        ends[selected].tolist(),
+        scores[selected].tolist(),
+        labels[selected].tolist(),
+    ):
+        sentence = sentences[sentence_idx]
+        if isinstance(sentence, str):
+            # The character offsets are computed once per sentence, rather than once per entity
+            if sentence_idx not in char_offsets:
+                char_offsets[sentence_idx] = get_word_char_offsets(
+                    batch_encoding, sentence_idx, all_num_words[sentence_idx]
+                ).tolist()
+            char_start_index = char_offsets[sentence_idx][word_start_index][0]
+            char_end_index = char_offsets[sentence_idx][word_end_index - 1][1]
+            entity = {
+                "span": sentence[char_start_index:char_end_index],
+                "label": id2label[label_id],
+                "score": score,
+                "char_start_index": char_start_index,
+                "char_end_index": char_end_index,
+            }
+        else:
+            entity = {
+                "span": sentence[word_start_index:word_end_index],
+                "label": id2label[label_id],
+                "score": score,
+                "word_start_index": word_start_index,
+                "word_end_index": word_end_index,
+            }
+        all_entities[sentence_idx].append(entity)
+    return all_entities
@@ -6,6 +6,7 @@ import torch
 from sklearn.exceptions import UndefinedMetricWarning
 from transformers import EvalPrediction
 
+from span_marker.decoding import get_spans
 from span_marker.tokenizer import SpanMarkerTokenizer
 
 
@@ -43,6 +44,8 @@ def compute_f1_via_seqeval(
     sample_list = []
     for sample_idx in range(inputs.shape[0]):
         tokens = inputs[sample_idx]
+        # Batches may be padded to different lengths, in which case the Trainer pads the inputs with -100
+        tokens = tokens[tokens != -100]
         text = tokenizer.decode(tokens, skip_special_tokens=True)
         token_hash = hash(text) if not has_document_context else (document_ids[sample_idx], sentence_ids[sample_idx])
         if (
@@ -51,13 +54,13 @@ def compute_f1_via_seqeval(
             or len(sample_list[-1]["spans"]) == len(sample_list[-1]["gold_labels"])
         ):
             mask = gold_labels[sample_idx] != -100
-            spans = list(tokenizer.get_all_valid_spans(num_words[sample_idx], tokenizer.config.entity_max_length))
+            spans = get_spans(int(num_words[sample_idx]), tokenizer.config.entity_max_length)
             sample_list.append(
                 {
                     "text": text,
                     "gold_labels": gold_labels[sample_idx][mask].tolist(),
                     "pred_labels": pred_labels[sample_idx][mask].tolist(),
-                    "scores": scores[sample_idx].tolist(),
+                    "scores": scores[sample_idx][mask].tolist(),
                     "num_words": num_words[sample_idx],
                     "hash": token_hash,
                     "spans": spans,
@@ -67,7 +70,7 @@ def compute_f1_via_seqeval(
             mask = gold_labels[sample_idx] != -100
             sample_list[-1]["gold_labels"] += gold_labels[sample_idx][mask].tolist()
             sample_list[-1]["pred_labels"] += pred_labels[sample_idx][mask].tolist()
-            sample_list[-1]["scores"] += scores[sample_idx].tolist()
+            sample_list[-1]["scores"] += scores[sample_idx][mask].tolist()
 
     outside_id = tokenizer.config.outside_id
     id2label = tokenizer.config.id2label
@@ -0,0 +1,174 @@
+import logging
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.multiprocessing as mp
+from datasets import Dataset
+from typing_extensions import Self
+
+from span_marker.modeling import SpanMarkerModel
+
+logger = logging.getLogger(__name__)
+
+# The model of a worker process, set once by ``_init_worker`` rather than sent along with every shard
+_worker_model: Optional[SpanMarkerModel] = None
+
+
+def _init_worker(model: SpanMarkerModel, num_threads: int) -> None:
+    global _worker_model
+    # Partition the cores between the workers, rather than letting every worker use all of them
+    torch.set_num_threads(num_threads)
+    _worker_model = model
+
+
+def _predict_shard(
+    shard: Tuple[List[Union[str, List[str]]], Optional[List[int]], Optional[List[int]], Dict[str, Union[int, bool]]]
+) -> List[List[Dict[str, Union[str, int, float]]]]:
+    sentences, document_ids, sentence_ids, predict_kwargs = shard
+    return _worker_model._predict_sentences(
+        sentences, document_ids=document_ids, sentence_ids=sentence_ids, **predict_kwargs
+    )
+
+
+class SpanMarkerInferencePool:
+    """A pool of worker processes that predict named entities on the CPU in parallel.
+
+    The model weights are moved into shared memory once, such that all workers use the same weights rather than
+    a copy each. The inputs are split into shards that keep documents intact, which are predicted by the workers,
+    and the entities are merged back in the order of the inputs. Every worker uses ``num_threads`` threads, such that the workers
+    together use as many threads as the parent process would.
+
+    Example::
+
+        >>> model = SpanMarkerModel.from_pretrained(...)
+        >>> with SpanMarkerInferencePool(model, num_workers=4) as pool:
+        ...     entities = pool.predict(sentences, batch_size=32)
+
+    Args:
+        model (SpanMarkerModel): The model to predict with, which must be on the CPU.
+        num_workers (Optional[int]): The number of worker processes. Defaults to the number of CPUs.
+        num_threads (Optional[int]): The number of threads of each worker. Defaults to the number of threads
+            of the current process divided by ``num_workers``, and at least 1.
+        start_method (str): The multiprocessing start method. Defaults to ``"spawn"``, as forking a process
+            in which torch has already started its thread pools can deadlock the workers. ``"fork"`` starts the workers
+            faster, but is only safe if the current process has not used torch for any computations yet.
+    """
+
+    def __init__(
+        self,
+        model: SpanMarkerModel,
+        num_workers: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        start_method: str = "spawn",
+    ) -> None:
+        if model.device.type != "cpu":
+            raise ValueError(
+                f"`SpanMarkerInferencePool` requires a model on the CPU, but the model is on {model.device}."
+                " Use `model.predict` directly to predict on a GPU."
+            )
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers < 1:
+            raise ValueError(f"`num_workers` must be at least 1, but got {num_workers}.")
+        if num_threads is None:
+            num_threads = max(torch.get_num_threads() // num_workers, 1)
+
+        self.model = model
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        # Disable dropout, etc. before the workers are started
+        self.model.eval()
+        self.model.share_memory()
+        self._pool = mp.get_context(start_method).Pool(
+            num_workers, initializer=_init_worker, initargs=(self.model, num_threads)
+        )
+        logger.info(f"Started {num_workers} SpanMarker inference workers with {num_threads} thread(s) each.")
+
+    def predict(
+        self,
+        inputs: Union[str, List[str], List[List[str]], Dataset],
+        batch_size: int = 4,
+        shard_size: Optional[int] = None,
+        share_text_encoding: bool = False,
+        pack_sentences: bool = False,
+    ) -> Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
+        """Predict named entities from input texts, using all workers.
+
+        Args:
+            inputs (Union[str, List[str], List[List[str]], Dataset]): Input sentences from which to extract entities.
+                See :meth:`~span_marker.modeling.SpanMarkerModel.predict` for the valid datastructures.
+            batch_size (int): The number of samples to include in a batch in each worker. Defaults to 4.
+            shard_size (Optional[int]): The number of sentences that are sent to a worker at once. With document-level
+                context, the sentences are grouped by document before sharding, and shards are only split between
+                documents, so sentences from the same document always share a shard. Defaults to spreading the
+                sentences evenly over the workers.
+            share_text_encoding (bool): See :meth:`~span_marker.modeling.SpanMarkerModel.predict`. Defaults to `False`.
+            pack_sentences (bool): See :meth:`~span_marker.modeling.SpanMarkerModel.predict`. Defaults to `False`.
+
+        Returns:
+            Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
+                The same output as :meth:`~span_marker.modeling.SpanMarkerModel.predict`.
+        """
+        if self._pool is None:
+            raise ValueError("This `SpanMarkerInferencePool` has been closed.")
+        if not inputs:
+            return []
+
+        single_input, sentences, document_ids, sentence_ids = SpanMarkerModel._parse_inputs(inputs)
+        if shard_size is None:
+            shard_size = -(-len(sentences) // self.num_workers)
+        if document_ids is not None:
+            # Group the sentences of each document, as documents may be interleaved or unsorted in the inputs
+            input_order = sorted(
+                range(len(sentences)), key=lambda sentence_idx: (document_ids[sentence_idx], sentence_ids[sentence_idx])
+            )
+            elements = [
+                {
+                    "tokens": sentences[sentence_idx],
+                    "document_id": document_ids[sentence_idx],
+                    "sentence_id": sentence_ids[sentence_idx],
+                }
+                for sentence_idx in input_order
+            ]
+        else:
+            input_order = None
+            elements = sentences
+        predict_kwargs = {
+            "batch_size": batch_size,
+            "share_text_encoding": share_text_encoding,
+            "pack_sentences": pack_sentences,
+        }
+        shards = [
+            (*SpanMarkerModel._split_chunk(chunk), predict_kwargs)
+            for chunk in SpanMarkerModel._iter_chunks(elements, shard_size)
+        ]
+        # ``imap`` returns the shard outputs in the order of the shards, regardless of which worker finishes first
+        all_entities = [
+            entities for shard_entities in self._pool.imap(_predict_shard, shards) for entities in shard_entities
+        ]
+        if input_order is not None:
+            # Restore the order of the inputs
+            ordered_entities = [None] * len(all_entities)
+            for sentence_idx, entities in zip(input_order, all_entities):
+                ordered_entities[sentence_idx] = entities
+            all_entities = ordered_entities
+        if single_input and len(all_entities) == 1:
+            return all_entities[0]
+        return all_entities
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"SpanMarkerInferencePool(num_workers={self.num_workers}, num_threads={self.num_threads})"
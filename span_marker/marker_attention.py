@@ -0,0 +1,177 @@
+import math
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn
+from transformers import PreTrainedModel
+
+KeyValue = Tuple[torch.Tensor, torch.Tensor]
+
+
+def supports_marker_attention(encoder: PreTrainedModel) -> bool:
+    """Whether the encoder has the BERT-like structure required for computing the text and marker attention separately.
+
+    This holds for e.g. BERT, RoBERTa, XLM-RoBERTa and ELECTRA encoders with absolute position embeddings.
+
+    Args:
+        encoder (PreTrainedModel): The underlying encoder of a SpanMarker model.
+
+    Returns:
+        bool: True if the encoder is supported.
+    """
+    if getattr(encoder.config, "position_embedding_type", "absolute") != "absolute":
+        return False
+    if getattr(encoder.config, "is_decoder", False):
+        return False
+    layers = getattr(getattr(encoder, "encoder", None), "layer", None)
+    if getattr(encoder, "embeddings", None) is None or layers is None:
+        return False
+    for layer in layers:
+        attention = getattr(layer, "attention", None)
+        self_attention = getattr(attention, "self", None)
+        if not all(hasattr(self_attention, name) for name in ("query", "key", "value")):
+            return False
+        if not all(hasattr(module, "output") for module in (attention, layer)) or not hasattr(layer, "intermediate"):
+            return False
+    return True
+
+
+def embed(encoder: PreTrainedModel, input_ids: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
+    """Compute the input embeddings of the encoder, which are independent for each token.
+
+    Args:
+        encoder (PreTrainedModel): The underlying encoder of a SpanMarker model.
+        input_ids (torch.Tensor): Input IDs with shape ``(batch_size, num_tokens)``.
+        position_ids (torch.Tensor): Position IDs with shape ``(batch_size, num_tokens)``.
+
+    Returns:
+        torch.Tensor: The embeddings with shape ``(batch_size, num_tokens, hidden_size)``.
+    """
+    embeddings = encoder.embeddings(
+        input_ids=input_ids, position_ids=position_ids, token_type_ids=torch.zeros_like(input_ids)
+    )
+    # e.g. ELECTRA may project the embeddings to the hidden size
+    if getattr(encoder, "embeddings_project", None) is not None:
+        embeddings = encoder.embeddings_project(embeddings)
+    return embeddings
+
+
+def encode_text(
+    encoder: PreTrainedModel, input_ids: torch.Tensor, position_ids: torch.Tensor, num_tokens: torch.Tensor
+) -> Tuple[torch.Tensor, List[KeyValue]]:
+    """Encode only the text tokens, and cache the keys and values of every layer.
+
+    Text tokens never attend the markers, so their hidden states do not depend on the markers in the sample.
+    The cached keys and values can be reused by :func:`encode_markers` for any number of marker chunks.
+
+    Args:
+        encoder (PreTrainedModel): The underlying encoder of a SpanMarker model.
+        input_ids (torch.Tensor): Text input IDs with shape ``(num_texts, max_num_tokens)``.
+        position_ids (torch.Tensor): Text position IDs with shape ``(num_texts, max_num_tokens)``.
+        num_tokens (torch.Tensor): The number of text tokens of each text, with shape ``(num_texts,)``.
+
+    Returns:
+        Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]: The additive text attention bias with shape
+            ``(num_texts, 1, 1, max_num_tokens)``, and the keys and values of each layer with shape
+            ``(num_texts, num_heads, max_num_tokens, head_size)``.
+    """
+    hidden_states = embed(encoder, input_ids, position_ids)
+    is_text = torch.arange(input_ids.size(1), device=input_ids.device) < num_tokens[:, None]
+    text_bias = (~is_text).to(hidden_states.dtype)[:, None, None, :] * torch.finfo(hidden_states.dtype).min
+
+    key_values = []
+    for layer in encoder.encoder.layer:
+        self_attention = layer.attention.self
+        num_heads = encoder.config.num_attention_heads
+        query = _split_heads(self_attention.query(hidden_states), num_heads)
+        key = _split_heads(self_attention.key(hidden_states), num_heads)
+        value = _split_heads(self_attention.value(hidden_states), num_heads)
+        key_values.append((key, value))
+
+        scores = query @ key.transpose(-1, -2) / math.sqrt(query.size(-1)) + text_bias
+        probs = _attention_dropout(self_attention, scores.softmax(dim=-1))
+        hidden_states = _feed_forward(layer, _merge_heads(probs @ value), hidden_states)
+    return text_bias, key_values
+
+
+def encode_markers(
+    encoder: PreTrainedModel,
+    text_bias: torch.Tensor,
+    text_key_values: List[KeyValue],
+    input_ids: torch.Tensor,
+    position_ids: torch.Tensor,
+    text_indices: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Encode only the start and end markers, attending the cached text keys and values from :func:`encode_text`.
+
+    Every marker attends all text tokens, itself and its partner marker, so the attention costs
+    ``O(num_markers * num_tokens)`` rather than ``O((num_tokens + num_markers)^2)``.
+
+    Args:
+        encoder (PreTrainedModel): The underlying encoder of a SpanMarker model.
+        text_bias (torch.Tensor): The additive text attention bias from :func:`encode_text`.
+        text_key_values (List[Tuple[torch.Tensor, torch.Tensor]]): The text keys and values from :func:`encode_text`.
+        input_ids (torch.Tensor): Marker input IDs with shape ``(batch_size, 2 * num_pairs)``, i.e. all start
+            markers followed by all end markers, such that the partner of marker ``i`` is at ``i ± num_pairs``.
+        position_ids (torch.Tensor): Marker position IDs with shape ``(batch_size, 2 * num_pairs)``.
+        text_indices (Optional[torch.Tensor]): For each sample, the index of the text that its markers belong to.
+            Defaults to None, i.e. sample ``i`` belongs to text ``i``.
+
+    Returns:
+        torch.Tensor: The marker hidden states with shape ``(batch_size, 2 * num_pairs, hidden_size)``.
+    """
+    hidden_states = embed(encoder, input_ids, position_ids)
+    num_pairs = input_ids.size(1) // 2
+    if text_indices is not None:
+        text_bias = text_bias[text_indices]
+    num_tokens = text_bias.size(-1)
+
+    for layer, (text_key, text_value) in zip(encoder.encoder.layer, text_key_values):
+        if text_indices is not None:
+            text_key = text_key[text_indices]
+            text_value = text_value[text_indices]
+        self_attention = layer.attention.self
+        num_heads = encoder.config.num_attention_heads
+        query = _split_heads(self_attention.query(hidden_states), num_heads)
+        key = _split_heads(self_attention.key(hidden_states), num_heads)
+        value = _split_heads(self_attention.value(hidden_states), num_heads)
+        # Start marker i and end marker i are each other's partner
+        partner_key = key.roll(num_pairs, dims=2)
+        partner_value = value.roll(num_pairs, dims=2)
+
+        scale = math.sqrt(query.size(-1))
+        text_scores = query @ text_key.transpose(-1, -2) / scale + text_bias
+        self_scores = (query * key).sum(dim=-1, keepdim=True) / scale
+        partner_scores = (query * partner_key).sum(dim=-1, keepdim=True) / scale
+        probs = torch.cat((text_scores, self_scores, partner_scores), dim=-1).softmax(dim=-1)
+        probs = _attention_dropout(self_attention, probs)
+
+        context = (
+            probs[..., :num_tokens] @ text_value
+            + probs[..., num_tokens : num_tokens + 1] * value
+            + probs[..., num_tokens + 1 :] * partner_value
+        )
+        hidden_states = _feed_forward(layer, _merge_heads(context), hidden_states)
+    return hidden_states
+
+
+def _split_heads(hidden_states: torch.Tensor, num_heads: int) -> torch.Tensor:
+    batch_size, sequence_length, _ = hidden_states.shape
+    return hidden_states.view(batch_size, sequence_length, num_heads, -1).transpose(1, 2)
+
+
+def _merge_heads(hidden_states: torch.Tensor) -> torch.Tensor:
+    batch_size, _, sequence_length, _ = hidden_states.shape
+    return hidden_states.transpose(1, 2).reshape(batch_size, sequence_length, -1)
+
+
+def _attention_dropout(self_attention: nn.Module, probs: torch.Tensor) -> torch.Tensor:
+    dropout = getattr(self_attention, "dropout", None)
+    if isinstance(dropout, nn.Module):
+        return dropout(probs)
+    return probs
+
+
+def _feed_forward(layer: nn.Module, context: torch.Tensor, hidden_states: torch.Tensor) -> torch.Tensor:
+    attention_output = layer.attention.output(context, hidden_states)
+    return layer.output(layer.intermediate(attention_output), attention_output)
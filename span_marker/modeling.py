@@ -1,23 +1,56 @@
+import asyncio
+import copy
+import dataclasses
 import logging
 import os
 import re
-from typing import Callable, Dict, List, Optional, Type, TypeVar, Union
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
+import numpy as np
 import torch
 import torch.nn.functional as F
-from datasets import Dataset, disable_progress_bar, enable_progress_bar
+from datasets import Dataset
 from packaging.version import Version, parse
 from torch import device, nn
-from tqdm.autonotebook import trange
-from transformers import AutoConfig, AutoModel, PretrainedConfig, PreTrainedModel
+from tqdm.autonotebook import tqdm
+from transformers import (
+    AutoConfig,
+    AutoModel,
+    BatchEncoding,
+    PretrainedConfig,
+    PreTrainedModel,
+)
 from typing_extensions import Self
-import numpy as np
 
 from span_marker import __version__ as span_marker_version
+from span_marker.batching import SpanMarkerBatcher
 from span_marker.configuration import SpanMarkerConfig
-from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.data_collator import SpanMarkerDataCollator, build_attention_mask
+from span_marker.decoding import decode_entities
+from span_marker.marker_attention import (
+    encode_markers,
+    encode_text,
+    supports_marker_attention,
+)
 from span_marker.model_card import SpanMarkerModelCardData, generate_model_card
 from span_marker.output import SpanMarkerOutput
+from span_marker.prediction_cache import PredictionCache, get_sentence_keys
 from span_marker.tokenizer import SpanMarkerTokenizer
 
 logger = logging.getLogger(__name__)
@@ -25,6 +58,61 @@ logger = logging.getLogger(__name__)
 T = TypeVar("T", bound="SpanMarkerModel")
 
 UNEXPECTED_KEYWORD_PATTERN = re.compile(r"\S+ got an unexpected keyword argument '([^']*)'")
+SDPA_UNSUPPORTED_PATTERN = re.compile(r"does not support .*scaled_dot_product_attention")
+
+
+def gather_marker_states(
+    last_hidden_state: torch.Tensor, start_marker_indices: torch.Tensor, num_marker_pairs: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Gather the start and end marker embeddings of each marker pair slot in the batch.
+
+    Uses a single batched gather rather than a loop over the samples, so it does not synchronize with the host
+    and can be traced for exporting and compiling.
+
+    Args:
+        last_hidden_state (torch.Tensor): The encoder outputs with shape ``(batch_size, sequence_length, hidden_size)``.
+        start_marker_indices (torch.Tensor): The index of the first start marker of each sample.
+        num_marker_pairs (torch.Tensor): The number of start/end marker pairs of each sample.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The start and end marker embeddings, both with shape
+            ``(batch_size, sequence_length // 2, hidden_size)``. The embeddings of marker pairs beyond
+            ``num_marker_pairs`` are arbitrary, and must be masked out.
+    """
+    sequence_length = last_hidden_state.size(1)
+    hidden_size = last_hidden_state.size(2)
+    pair_indices = torch.arange(sequence_length // 2, device=last_hidden_state.device)
+    start_marker_indices = start_marker_indices.to(pair_indices.dtype)[:, None]
+    num_marker_pairs = num_marker_pairs.to(pair_indices.dtype)[:, None]
+    # Clamp the indices of the padded pairs, their embeddings are masked out anyways
+    start_indices = (start_marker_indices + pair_indices).clamp(max=sequence_length - 1)
+    end_indices = (start_indices + num_marker_pairs).clamp(max=sequence_length - 1)
+    start_states = last_hidden_state.gather(1, start_indices[:, :, None].expand(-1, -1, hidden_size))
+    end_states = last_hidden_state.gather(1, end_indices[:, :, None].expand(-1, -1, hidden_size))
+    return start_states, end_states
+
+
+def gather_marker_features(
+    last_hidden_state: torch.Tensor, start_marker_indices: torch.Tensor, num_marker_pairs: torch.Tensor
+) -> torch.Tensor:
+    """Gather the concatenated start and end marker embeddings of each marker pair in the batch.
+
+    See :func:`gather_marker_states`, which this function uses.
+
+    Args:
+        last_hidden_state (torch.Tensor): The encoder outputs with shape ``(batch_size, sequence_length, hidden_size)``.
+        start_marker_indices (torch.Tensor): The index of the first start marker of each sample.
+        num_marker_pairs (torch.Tensor): The number of start/end marker pairs of each sample.
+
+    Returns:
+        torch.Tensor: The feature vector with shape ``(batch_size, sequence_length // 2, 2 * hidden_size)``,
+            which is zero for marker pairs beyond ``num_marker_pairs``.
+    """
+    start_states, end_states = gather_marker_states(last_hidden_state, start_marker_indices, num_marker_pairs)
+    pair_indices = torch.arange(start_states.size(1), device=last_hidden_state.device)
+    is_pair = pair_indices < num_marker_pairs.to(pair_indices.dtype)[:, None]
+    feature_vector = torch.cat((start_states, end_states), dim=-1)
+    return feature_vector.masked_fill(~is_pair[:, :, None], 0.0)
 
 
 class SpanMarkerModel(PreTrainedModel):
@@ -79,8 +167,13 @@ class SpanMarkerModel(PreTrainedModel):
             # could load e.g. all of `roberta-large` from the Hub unnecessarily.
             # However, use the SpanMarkerModel updated vocab_size
             encoder_config = AutoConfig.from_pretrained(self.config.encoder["_name_or_path"], **self.config.encoder)
-            encoder = AutoModel.from_config(encoder_config)
+            encoder = SpanMarkerModel._load_encoder_from_config(encoder_config)
         self.encoder = encoder
+        if self.config.sparse_marker_attention and not supports_marker_attention(self.encoder):
+            logger.warning(
+                "`sparse_marker_attention` is not supported for this encoder architecture: "
+                "the dense attention is used instead."
+            )
 
         dropout_rate = self.config.get(["hidden_dropout_prob", "dropout_rate"], default=0.1)
         if dropout_rate:
@@ -124,56 +217,103 @@ class SpanMarkerModel(PreTrainedModel):
     def forward(
         self,
         input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        position_ids: torch.Tensor,
-        start_marker_indices: torch.Tensor,
-        num_marker_pairs: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        start_marker_indices: Optional[torch.Tensor] = None,
+        num_marker_pairs: Optional[torch.Tensor] = None,
         num_words: Optional[torch.Tensor] = None,
         document_ids: Optional[torch.Tensor] = None,
         sentence_ids: Optional[torch.Tensor] = None,
         labels: Optional[torch.Tensor] = None,
+        num_tokens: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.Tensor] = None,
+        share_text_encoding: bool = False,
         **kwargs,
     ) -> Dict[str, torch.Tensor]:
         """Forward call of the SpanMarkerModel.
         Args:
-            input_ids (~torch.Tensor): Input IDs including start/end markers.
-            attention_mask (~torch.Tensor): Attention mask matrix including one-directional attention for markers.
+            input_ids (~torch.Tensor): Input IDs including start/end markers, with shape ``(batch_size, sequence_length)``.
+                The sequence length may differ between batches, e.g. when the data collator pads dynamically.
+            attention_mask (Optional[~torch.Tensor]): Attention mask matrix including one-directional attention for markers.
+                If not provided, it is computed on the model device from ``num_tokens``, ``start_marker_indices``
+                and ``num_marker_pairs``.
             position_ids (~torch.Tensor): Position IDs including start/end markers.
-        None.
+            start_marker_indices (~torch.Tensor): The index of the first start marker of each sample.
+            num_marker_pairs (~torch.Tensor): The number of start/end marker pairs of each sample.
+            num_tokens (Optional[~torch.Tensor]): The number of text tokens of each sample. Only required if
+                ``attention_mask`` is not provided.
+            segment_ids (Optional[~torch.Tensor]): The index of the sentence that each text token and marker belongs
+                to, for samples with multiple packed sentences. Only used if ``attention_mask`` is not provided.
+            share_text_encoding (bool): Whether to encode the text tokens only once for all samples in the batch
+                with the same text, e.g. when a sentence was spread between multiple samples, and to only encode
+                the markers of each sample against the cached text keys and values. Only used for encoders with a
+                BERT-like architecture, see :func:`~span_marker.marker_attention.supports_marker_attention`.
+                Defaults to False.
+
+        The text tokens and markers are also encoded separately if ``sparse_marker_attention`` is set in the
+        :class:`~span_marker.configuration.SpanMarkerConfig`, in which case no ``hidden_states`` or ``attentions``
+        are returned.
 
         Returns:
             outputs: Encoder outputs
         """
-        token_type_ids = torch.zeros_like(input_ids)
-        outputs = self.encoder(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-        )
-        last_hidden_state = outputs[0]
-        last_hidden_state = self.dropout(last_hidden_state)
-        sequence_length = last_hidden_state.size(1)
-        batch_size = last_hidden_state.size(0)
-        # Get the indices where the end markers start
-        end_marker_indices = start_marker_indices + num_marker_pairs
-        sequence_length_last_hidden_state = last_hidden_state.size(2) * 2
-        #  Pre-allocates the necessary space for feature_vector
-        feature_vector = torch.zeros(batch_size, sequence_length // 2, sequence_length_last_hidden_state, device=self.device)
-        for i in range(batch_size):
-            feature_vector[
-                i, : end_marker_indices[i] - start_marker_indices[i], : last_hidden_state.shape[-1]
-            ] = last_hidden_state[i, start_marker_indices[i] : end_marker_indices[i]]
-            feature_vector[
-                i, : end_marker_indices[i] - start_marker_indices[i], last_hidden_state.shape[-1] :
-            ] = last_hidden_state[i, end_marker_indices[i] : end_marker_indices[i] + num_marker_pairs[i]]
+        batch_size, sequence_length = input_ids.shape
+        # The logits and labels of the padded marker pair slots are masked out. Masking rather than selecting the
+        # real marker pairs avoids synchronizing with the host, such that the forward pass remains traceable
+        pair_indices = torch.arange(sequence_length // 2, device=input_ids.device)
+        pair_mask = pair_indices < num_marker_pairs[:, None]
+
+        if attention_mask is None and num_tokens is None:
+            raise ValueError("Either `attention_mask` or `num_tokens` must be provided to `SpanMarkerModel.forward`.")
+
+        use_marker_attention = share_text_encoding or self.config.sparse_marker_attention
+        # Packed samples require a block-diagonal text attention, so they always use the dense attention
+        if use_marker_attention and segment_ids is None and supports_marker_attention(self.encoder):
+            if num_tokens is None:
+                # The first token attends exactly all text tokens
+                num_tokens = attention_mask[:, 0].sum(dim=-1)
+            outputs = ()
+            start_states, end_states = self.encode_marker_pairs(
+                input_ids,
+                position_ids,
+                start_marker_indices,
+                num_marker_pairs,
+                num_tokens,
+                share_text_encoding=share_text_encoding,
+            )
+            start_states = self.dropout(start_states)
+            end_states = self.dropout(end_states)
+
+        else:
+            if attention_mask is None:
+                attention_mask = build_attention_mask(
+                    num_tokens, start_marker_indices, num_marker_pairs, sequence_length, segment_ids=segment_ids
+                )
+            token_type_ids = torch.zeros_like(input_ids)
+            outputs = self.encoder(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+            )
+            last_hidden_state = outputs[0]
+            last_hidden_state = self.dropout(last_hidden_state)
+
+            start_states, end_states = gather_marker_states(last_hidden_state, start_marker_indices, num_marker_pairs)
 
         # NOTE: This was wrong in the older tests
-        feature_vector = self.dropout(feature_vector)
-        logits = self.classifier(feature_vector)
+        start_states = self.dropout(start_states)
+        end_states = self.dropout(end_states)
+        logits = self.classify_marker_pairs(start_states, end_states)
+        # The marker attention only computes the states of up to the maximum number of marker pairs in the batch,
+        # so pad the logits to shape (batch_size, sequence_length // 2, num_labels), with zeroes for padding
+        logits = F.pad(logits, (0, 0, 0, sequence_length // 2 - logits.size(1)))
+        logits = logits.masked_fill(~pair_mask[:, :, None], 0.0)
 
         if labels is not None:
-            loss = self.loss_func(logits.view(-1, self.config.num_labels), labels.view(-1))
+            # The loss only considers the real marker pairs
+            labels = labels.masked_fill(~pair_mask, self.loss_func.ignore_index)
+            loss = self.loss_func(logits.view(-1, logits.size(-1)), labels.view(-1))
 
         return SpanMarkerOutput(
             loss=loss if labels is not None else None,
@@ -185,6 +325,91 @@ class SpanMarkerModel(PreTrainedModel):
             out_sentence_ids=sentence_ids,
         )
 
+    def encode_marker_pairs(
+        self,
+        input_ids: torch.Tensor,
+        position_ids: torch.Tensor,
+        start_marker_indices: torch.Tensor,
+        num_marker_pairs: torch.Tensor,
+        num_tokens: torch.Tensor,
+        share_text_encoding: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Encode the text tokens and the start/end markers separately, using
+        :func:`~span_marker.marker_attention.encode_text` and :func:`~span_marker.marker_attention.encode_markers`.
+
+        This is equivalent to the encoder with the dense SpanMarker attention mask, but the attention costs
+        ``O(num_tokens^2 + num_markers * num_tokens)`` instead of ``O((num_tokens + num_markers)^2)``.
+
+        Args:
+            input_ids (torch.Tensor): Input IDs including start/end markers, as returned by the data collator.
+            position_ids (torch.Tensor): Position IDs including start/end markers.
+            start_marker_indices (torch.Tensor): The index of the first start marker of each sample.
+            num_marker_pairs (torch.Tensor): The number of start/end marker pairs of each sample.
+            num_tokens (torch.Tensor): The number of text tokens of each sample.
+            share_text_encoding (bool): Whether to only encode each distinct text once. Defaults to False.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The start and end marker hidden states, both with shape
+                ``(batch_size, max_num_marker_pairs, hidden_size)``.
+        """
+        batch_size, sequence_length = input_ids.shape
+        max_num_tokens = int(num_tokens.max())
+        text_input_ids = input_ids[:, :max_num_tokens]
+        text_position_ids = position_ids[:, :max_num_tokens]
+        text_indices = None
+        if share_text_encoding:
+            # Samples with the same number of tokens and the same text tokens share their text encoding
+            is_text = torch.arange(max_num_tokens, device=input_ids.device) < num_tokens[:, None]
+            text_keys = torch.cat((num_tokens.long()[:, None], text_input_ids.long().masked_fill(~is_text, -1)), dim=1)
+            _, text_indices = torch.unique(text_keys, dim=0, return_inverse=True)
+            first_sample_indices = torch.full(
+                (int(text_indices.max()) + 1,), batch_size, dtype=torch.long, device=input_ids.device
+            ).scatter_reduce(0, text_indices, torch.arange(batch_size, device=input_ids.device), reduce="amin")
+            text_input_ids = text_input_ids[first_sample_indices]
+            text_position_ids = text_position_ids[first_sample_indices]
+            num_tokens = num_tokens[first_sample_indices]
+        text_bias, text_key_values = encode_text(self.encoder, text_input_ids, text_position_ids, num_tokens)
+
+        # Lay out all start markers followed by all end markers, clamping the indices of padded pairs
+        max_num_pairs = int(num_marker_pairs.max())
+        pair_indices = torch.arange(max_num_pairs, device=input_ids.device)
+        start_indices = start_marker_indices[:, None] + pair_indices
+        end_indices = start_indices + num_marker_pairs[:, None]
+        marker_indices = torch.cat((start_indices, end_indices), dim=1).clamp(max=sequence_length - 1)
+        marker_states = encode_markers(
+            self.encoder,
+            text_bias,
+            text_key_values,
+            input_ids.gather(1, marker_indices),
+            position_ids.gather(1, marker_indices),
+            text_indices=text_indices,
+        )
+        return marker_states[:, :max_num_pairs], marker_states[:, max_num_pairs:]
+
+    def classify_marker_pairs(self, start_states: torch.Tensor, end_states: torch.Tensor) -> torch.Tensor:
+        """Compute the logits of marker pairs from their start and end marker embeddings.
+
+        The classifier is applied to the concatenation of both embeddings, but as ``W·[h_s; h_e] = W_s·h_s + W_e·h_e``,
+        we can split the classifier weights instead. This avoids creating the concatenated ``2 * hidden_size``
+        wide intermediate tensor, while using the existing ``classifier`` weights of all checkpoints.
+
+        Args:
+            start_states (torch.Tensor): The start marker embeddings with shape ``(..., hidden_size)``.
+            end_states (torch.Tensor): The end marker embeddings with shape ``(..., hidden_size)``.
+
+        Returns:
+            torch.Tensor: The logits with shape ``(..., num_labels)``.
+        """
+        # The weights of e.g. quantized linear layers can't be split, so we fall back to concatenating
+        if type(self.classifier) is not nn.Linear:
+            return self.classifier(torch.cat((start_states, end_states), dim=-1))
+
+        hidden_size = start_states.size(-1)
+        weight = self.classifier.weight
+        return F.linear(start_states, weight[:, :hidden_size]) + F.linear(
+            end_states, weight[:, hidden_size:], self.classifier.bias
+        )
+
     @classmethod
     def from_pretrained(
         cls: Type[T],
@@ -307,6 +532,8 @@ class SpanMarkerModel(PreTrainedModel):
         Returns:
             PreTrainedModel: The loaded encoder.
         """
+        # Prefer the memory-efficient `scaled_dot_product_attention` implementation if the encoder supports it
+        kwargs.setdefault("attn_implementation", "sdpa")
         try:
             return AutoModel.from_pretrained(
                 pretrained_model_name_or_path,
@@ -326,12 +553,42 @@ class SpanMarkerModel(PreTrainedModel):
                     )
             # Otherwise, just raise the exception
             raise exc
+        except ValueError as exc:
+            # If the encoder architecture does not support SDPA, then fall back to the default attention
+            if kwargs.get("attn_implementation") == "sdpa" and SDPA_UNSUPPORTED_PATTERN.search(str(exc)):
+                kwargs["attn_implementation"] = None
+                return SpanMarkerModel._load_encoder_with_kwargs(
+                    pretrained_model_name_or_path, config, *model_args, **kwargs
+                )
+            raise exc
+
+    @classmethod
+    def _load_encoder_from_config(
+        cls, encoder_config: PretrainedConfig, attn_implementation: str = "sdpa"
+    ) -> PreTrainedModel:
+        """Initialize an (empty) underlying encoder from its configuration, preferably using SDPA attention.
+
+        Args:
+            encoder_config (PretrainedConfig): The config corresponding with the encoder.
+            attn_implementation (str): The preferred attention implementation. Defaults to ``"sdpa"``.
+
+        Returns:
+            PreTrainedModel: The initialized encoder.
+        """
+        try:
+            return AutoModel.from_config(encoder_config, attn_implementation=attn_implementation)
+        except (TypeError, ValueError):
+            # Older versions of transformers and some encoder architectures do not support SDPA
+            return AutoModel.from_config(encoder_config)
 
     def predict(
         self,
         inputs: Union[str, List[str], List[List[str]], Dataset],
         batch_size: int = 4,
         show_progress_bar: bool = False,
+        share_text_encoding: bool = False,
+        pack_sentences: bool = False,
+        cache: Optional[PredictionCache] = None,
     ) -> Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
         """Predict named entities from input texts.
 
@@ -363,6 +620,15 @@ class SpanMarkerModel(PreTrainedModel):
             batch_size (int): The number of samples to include in a batch, a higher batch size is faster,
                 but requires more memory. Defaults to 4
             show_progress_bar (bool): Whether to show a progress bar, useful for longer inputs. Defaults to `False`.
+            share_text_encoding (bool): Whether to encode the text of a sentence only once if the sentence has
+                more spans than fit in one sample, rather than once per sample. Only used for encoders with a
+                BERT-like architecture. Defaults to `False`.
+            pack_sentences (bool): Whether to pack multiple short sentences into one sample, such that fewer
+                samples are needed. The sentences in a packed sample cannot attend each other. Defaults to `False`.
+            cache (Optional[PredictionCache]): A cache of previously predicted sentences. Cached sentences skip
+                tokenization and the model entirely, and the predictions of the other sentences are added to the
+                cache. With document-level context, a sentence is only cached together with its context, and all
+                sentences of a document are predicted if any of them is not cached. Defaults to None, i.e. no cache.
 
         Returns:
             Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
@@ -379,8 +645,6 @@ class SpanMarkerModel(PreTrainedModel):
 
                 If the input is multiple sentences, then we return a list containing multiple of the aforementioned lists.
         """
-        from span_marker.trainer import Trainer
-
         if torch.cuda.is_available() and self.device == torch.device("cpu"):
             logger.warning(
                 "SpanMarker model predictions are being computed on the CPU while CUDA is available."
@@ -394,25 +658,59 @@ class SpanMarkerModel(PreTrainedModel):
         if not inputs:
             return []
 
+        single_input, sentences, document_ids, sentence_ids = self._parse_inputs(inputs)
+        predict_kwargs = {
+            "batch_size": batch_size,
+            "show_progress_bar": show_progress_bar,
+            "share_text_encoding": share_text_encoding,
+            "pack_sentences": pack_sentences,
+        }
+        if cache is None:
+            all_entities = self._predict_sentences(
+                sentences, document_ids=document_ids, sentence_ids=sentence_ids, **predict_kwargs
+            )
+        else:
+            all_entities = self._predict_with_cache(
+                cache, sentences, document_ids=document_ids, sentence_ids=sentence_ids, **predict_kwargs
+            )
+        # if the input was a string or a list of tokens, return a list of dictionaries
+        if single_input and len(all_entities) == 1:
+            return all_entities[0]
+        return all_entities
+
+    @staticmethod
+    def _parse_inputs(
+        inputs: Union[str, List[str], List[List[str]], Dataset]
+    ) -> Tuple[bool, List[Union[str, List[str]]], Optional[List[int]], Optional[List[int]]]:
+        """Convert the inputs of :meth:`SpanMarkerModel.predict` into plain lists.
+
+        Returns:
+            Tuple[bool, List[Union[str, List[str]]], Optional[List[int]], Optional[List[int]]]: Whether the input
+                was a single sentence, the sentences, and optionally their document and sentence IDs.
+        """
         # Track whether the input was a string sentence or a list of tokens
         single_input = False
+        document_ids = None
+        sentence_ids = None
         # Check if inputs is a string, i.e. a string sentence, or
         # if it is a list of strings without spaces, i.e. if it's 1 tokenized sentence
         if isinstance(inputs, str) or (
             isinstance(inputs, list) and all(isinstance(element, str) and " " not in element for element in inputs)
         ):
             single_input = True
-            dataset = Dataset.from_dict({"tokens": [inputs]})
+            sentences = [inputs]
 
         # Otherwise, we likely have a list of strings, i.e. a list of string sentences,
         # or a list of lists of strings, i.e. a list of tokenized sentences
-        # if isinstance(inputs, list) and all(isinstance(element, str) and " " not in element for element in inputs):
-        # return [self._predict_one(sentence) for sentence in inputs]
         elif isinstance(inputs, list):
-            dataset = Dataset.from_dict({"tokens": inputs})
+            sentences = inputs
 
+        # Datasets are only converted to lists once, the remainder of the inference works on plain lists
         elif isinstance(inputs, Dataset):
-            dataset = inputs
+            sentences = inputs["tokens"]
+            if {"document_id", "sentence_id"} <= set(inputs.column_names):
+                document_ids = inputs["document_id"]
+                sentence_ids = inputs["sentence_id"]
 
         else:
             raise ValueError(
@@ -425,133 +723,528 @@ class SpanMarkerModel(PreTrainedModel):
                 "    If the optional columns are provided, they will be used to provide document-level context."
             )
 
-        dataset = dataset.remove_columns(set(dataset.column_names) - {"tokens", "document_id", "sentence_id"})
-        num_inputs = len(dataset)
-        dataset: Dataset = dataset.add_column("id", range(num_inputs))
-        results = [
-            {
-                "tokens": tokens,
-                "scores": [],
-                "labels": [],
-                "num_words": None,
-            }
-            for tokens in dataset["tokens"]
-        ]
+        return single_input, sentences, document_ids, sentence_ids
+
+    def predict_iter(
+        self,
+        inputs: Iterable[Union[str, List[str], Dict[str, Any]]],
+        batch_size: int = 4,
+        chunk_size: int = 256,
+        share_text_encoding: bool = False,
+        pack_sentences: bool = False,
+    ) -> Iterator[List[Dict[str, Union[str, int, float]]]]:
+        """Lazily predict named entities from a stream of sentences, yielding the entities of each sentence in order.
+
+        The sentences are consumed in chunks of ``chunk_size`` sentences, and the entities of a chunk are yielded
+        as soon as it is processed, so the memory usage is bounded regardless of the number of input sentences.
+
+        Example::
+
+            >>> model = SpanMarkerModel.from_pretrained(...)
+            >>> with open("corpus.txt") as f:
+            ...     for entities in model.predict_iter((line.strip() for line in f), batch_size=32):
+            ...         print(entities)
+
+        Args:
+            inputs (Iterable[Union[str, List[str], Dict[str, Any]]]): An iterable of sentences, e.g. a generator.
+                Every element is one sentence, either:
+
+                * str: a string sentence.
+                * List[str]: a pre-tokenized string sentence, i.e. a list of words.
+                * Dict[str, Any]: a dictionary with a ``tokens`` key with one of the above, and optionally
+                    ``document_id`` and ``sentence_id`` keys. If these are provided, they will be used to provide
+                    document-level context. The sentences of one document must be consecutive.
+
+                All elements should have the same type.
+            batch_size (int): The number of samples to include in a batch, a higher batch size is faster,
+                but requires more memory. Defaults to 4
+            chunk_size (int): The number of sentences to process at once. Chunks are only split between documents,
+                so sentences from the same document always share a chunk. Defaults to 256.
+            share_text_encoding (bool): See :meth:`SpanMarkerModel.predict`. Defaults to `False`.
+            pack_sentences (bool): See :meth:`SpanMarkerModel.predict`. Defaults to `False`.
+
+        Yields:
+            List[Dict[str, Union[str, int, float]]]: The entities of each sentence, in the order of the inputs.
+                See :meth:`SpanMarkerModel.predict` for the keys of each entity.
+        """
+        # Disable dropout, etc.
+        self.eval()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Tokenize the next chunk in a background thread while the current chunk runs through the model
+            pending = None
+            for chunk in self._iter_chunks(inputs, chunk_size):
+                sentences, document_ids, sentence_ids = self._split_chunk(chunk)
+                prepared_future = executor.submit(
+                    self._prepare_samples,
+                    sentences,
+                    document_ids=document_ids,
+                    sentence_ids=sentence_ids,
+                    pack_sentences=pack_sentences,
+                )
+                if pending is not None:
+                    yield from self._score_and_decode(
+                        pending[0], *pending[1].result(), batch_size=batch_size, share_text_encoding=share_text_encoding
+                    )
+                pending = (sentences, prepared_future)
+            if pending is not None:
+                yield from self._score_and_decode(
+                    pending[0], *pending[1].result(), batch_size=batch_size, share_text_encoding=share_text_encoding
+                )
+
+    async def apredict(
+        self,
+        inputs: Union[str, List[str], List[List[str]], Dataset],
+        timeout: Optional[float] = None,
+    ) -> Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
+        """Predict named entities from input texts without blocking the event loop.
+
+        The sentences are predicted in the background thread of a :class:`~span_marker.batching.SpanMarkerBatcher`,
+        such that the sentences of concurrent ``apredict`` calls share batches, and identical sentences that are
+        predicted concurrently are only predicted once. Use a :class:`~span_marker.batching.SpanMarkerBatcher`
+        directly to configure the batch sizes and wait time.
+
+        Example::
+
+            >>> model = SpanMarkerModel.from_pretrained(...)
+            >>> await model.apredict("Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.")
+            [{'span': 'Amelia Earhart', 'label': 'person-other', 'score': 0.7629689574241638, 'char_start_index': 0, 'char_end_index': 14},
+             ...]
+
+        Args:
+            inputs (Union[str, List[str], List[List[str]], Dataset]): Input sentences from which to extract entities,
+                see :meth:`SpanMarkerModel.predict`. Document-level context is not supported.
+            timeout (Optional[float]): The maximum number of seconds to wait, after which
+                :class:`asyncio.TimeoutError` is raised and the sentences that are still queued are dequeued.
+                Defaults to waiting indefinitely.
+
+        Returns:
+            Union[List[Dict[str, Union[str, int, float]]], List[List[Dict[str, Union[str, int, float]]]]]:
+                The same output as :meth:`SpanMarkerModel.predict`.
+        """
+        if not inputs:
+            return []
+
+        single_input, sentences, document_ids, _sentence_ids = self._parse_inputs(inputs)
+        if document_ids is not None:
+            raise ValueError(
+                "`SpanMarkerModel.apredict` does not support document-level context, as the sentences of a document"
+                " cannot be batched independently. Please use `SpanMarkerModel.predict` instead."
+            )
+        batcher = self._get_batcher()
+        all_entities = await asyncio.wait_for(
+            asyncio.gather(*(batcher.apredict(sentence) for sentence in sentences)), timeout
+        )
+        # if the input was a string or a list of tokens, return a list of dictionaries
+        if single_input and len(all_entities) == 1:
+            return all_entities[0]
+        return all_entities
+
+    async def apredict_iter(
+        self,
+        inputs: Union[Iterable[Union[str, List[str]]], AsyncIterable[Union[str, List[str]]]],
+        max_in_flight: Optional[int] = None,
+    ) -> AsyncIterator[List[Dict[str, Union[str, int, float]]]]:
+        """Predict named entities from a stream of sentences without blocking the event loop, yielding
+        the entities of each sentence in order.
+
+        Example::
+
+            >>> async for entities in model.apredict_iter(sentence_stream):
+            ...     print(entities)
+
+        Args:
+            inputs (Union[Iterable[Union[str, List[str]]], AsyncIterable[Union[str, List[str]]]]): An iterable or
+                asynchronous iterable of string sentences or pre-tokenized sentences.
+            max_in_flight (Optional[int]): See :meth:`~span_marker.batching.SpanMarkerBatcher.apredict_iter`.
+
+        Yields:
+            List[Dict[str, Union[str, int, float]]]: The entities of each sentence, in the order of the inputs.
+        """
+        async for entities in self._get_batcher().apredict_iter(inputs, max_in_flight=max_in_flight):
+            yield entities
+
+    def close_batcher(self) -> None:
+        """Stop the background thread that :meth:`SpanMarkerModel.apredict` and :meth:`SpanMarkerModel.apredict_iter`
+        predict in, after predicting the sentences that are still queued. The next call starts a new thread.
+        """
+        batcher = getattr(self, "_batcher", None)
+        if batcher is not None:
+            self._batcher = None
+            batcher.close()
+
+    def _get_batcher(self) -> SpanMarkerBatcher:
+        # The batcher is created on first use, as it starts a background thread
+        batcher = getattr(self, "_batcher", None)
+        if batcher is None:
+            batcher = self._batcher = SpanMarkerBatcher(self)
+        return batcher
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The batcher holds a thread and a lock, which can be neither pickled nor copied. Pickled or copied models
+        # start their own batcher on their first `apredict` call instead
+        state = super().__getstate__()
+        state.pop("_batcher", None)
+        return state
+
+    @staticmethod
+    def _iter_chunks(
+        inputs: Iterable[Union[str, List[str], Dict[str, Any]]], chunk_size: int
+    ) -> Iterator[List[Union[str, List[str], Dict[str, Any]]]]:
+        chunk = []
+        for element in inputs:
+            # Only split the chunk between documents, such that the document-level context remains intact
+            if len(chunk) >= chunk_size and not (
+                isinstance(element, dict)
+                and "document_id" in element
+                and element["document_id"] == chunk[-1].get("document_id")
+            ):
+                yield chunk
+                chunk = []
+            chunk.append(element)
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _split_chunk(
+        chunk: List[Union[str, List[str], Dict[str, Any]]]
+    ) -> Tuple[List[Union[str, List[str]]], Optional[List[int]], Optional[List[int]]]:
+        if not isinstance(chunk[0], dict):
+            return chunk, None, None
+        sentences = [element["tokens"] for element in chunk]
+        if "document_id" not in chunk[0] or "sentence_id" not in chunk[0]:
+            return sentences, None, None
+        document_ids = [element["document_id"] for element in chunk]
+        sentence_ids = [element["sentence_id"] for element in chunk]
+        return sentences, document_ids, sentence_ids
+
+    def _predict_sentences(
+        self,
+        sentences: List[Union[str, List[str]]],
+        document_ids: Optional[List[int]] = None,
+        sentence_ids: Optional[List[int]] = None,
+        batch_size: int = 4,
+        show_progress_bar: bool = False,
+        share_text_encoding: bool = False,
+        pack_sentences: bool = False,
+    ) -> List[List[Dict[str, Union[str, int, float]]]]:
+        """Predict the entities of each sentence, working on plain lists from tokenization through decoding.
+
+        Args:
+            sentences (List[Union[str, List[str]]]): String sentences or pre-tokenized sentences.
+            document_ids (Optional[List[int]]): The document ID of each sentence, used for document-level context.
+            sentence_ids (Optional[List[int]]): The sentence ID of each sentence, used for document-level context.
+
+        See :meth:`SpanMarkerModel.predict` for the remaining arguments.
+
+        Returns:
+            List[List[Dict[str, Union[str, int, float]]]]: The entities of each sentence.
+        """
+        # Only tokenize, collate and encode each unique input once
+        unique_indices, inverse_indices = self._deduplicate(sentences, document_ids, sentence_ids)
+        if len(unique_indices) < len(sentences):
+            unique_sentences = [sentences[sentence_idx] for sentence_idx in unique_indices]
+            if document_ids is not None:
+                document_ids = [document_ids[sentence_idx] for sentence_idx in unique_indices]
+                sentence_ids = [sentence_ids[sentence_idx] for sentence_idx in unique_indices]
+        else:
+            unique_sentences = sentences
+
+        samples, all_num_words, batch_encoding = self._prepare_samples(
+            unique_sentences,
+            document_ids=document_ids,
+            sentence_ids=sentence_ids,
+            pack_sentences=pack_sentences,
+            show_progress_bar=show_progress_bar,
+        )
+        unique_entities = self._score_and_decode(
+            unique_sentences,
+            samples,
+            all_num_words,
+            batch_encoding,
+            batch_size=batch_size,
+            show_progress_bar=show_progress_bar,
+            share_text_encoding=share_text_encoding,
+        )
+        if len(unique_indices) == len(sentences):
+            return unique_entities
+
+        all_entities = []
+        is_used = [False] * len(unique_entities)
+        for unique_idx in inverse_indices:
+            entities = unique_entities[unique_idx]
+            # The duplicates get their own copy, such that modifying the entities of one sentence is safe
+            all_entities.append(copy.deepcopy(entities) if is_used[unique_idx] else entities)
+            is_used[unique_idx] = True
+        return all_entities
+
+    @staticmethod
+    def _deduplicate(
+        sentences: List[Union[str, List[str]]],
+        document_ids: Optional[List[int]] = None,
+        sentence_ids: Optional[List[int]] = None,
+    ) -> Tuple[List[int], List[int]]:
+        """Find the unique inputs, i.e. the unique sentences, or with document-level context, the unique documents.
+
+        With document-level context, the context of a sentence depends on the other sentences in its document,
+        so identical sentences can only share a prediction if their entire documents are identical.
+
+        Returns:
+            Tuple[List[int], List[int]]: The indices of the sentences that must be predicted, and for every sentence
+                the index of its prediction among the sentences that must be predicted.
+        """
+        if document_ids is None or sentence_ids is None:
+            groups = [[sentence_idx] for sentence_idx in range(len(sentences))]
+        else:
+            documents = defaultdict(list)
+            for sentence_idx, document_id in enumerate(document_ids):
+                documents[document_id].append(sentence_idx)
+            groups = [
+                sorted(document, key=lambda sentence_idx: sentence_ids[sentence_idx]) for document in documents.values()
+            ]
+
+        sentence_keys = get_sentence_keys(sentences)
+        unique_indices = []
+        inverse_indices = [None] * len(sentences)
+        group_offsets = {}
+        for group in groups:
+            group_key = tuple(sentence_keys[sentence_idx] for sentence_idx in group)
+            if group_key not in group_offsets:
+                group_offsets[group_key] = len(unique_indices)
+                unique_indices.extend(group)
+            for position, sentence_idx in enumerate(group):
+                inverse_indices[sentence_idx] = group_offsets[group_key] + position
+        return unique_indices, inverse_indices
+
+    def _predict_with_cache(
+        self,
+        cache: PredictionCache,
+        sentences: List[Union[str, List[str]]],
+        document_ids: Optional[List[int]] = None,
+        sentence_ids: Optional[List[int]] = None,
+        **kwargs,
+    ) -> List[List[Dict[str, Union[str, int, float]]]]:
+        """Look up the entities of each sentence in the cache, and only predict the sentences that are not cached.
+
+        See :meth:`SpanMarkerModel._predict_sentences` for the arguments.
+        """
+        sentence_keys = get_sentence_keys(
+            sentences,
+            document_ids=document_ids,
+            sentence_ids=sentence_ids,
+            max_prev_context=self.config.max_prev_context,
+            max_next_context=self.config.max_next_context,
+        )
+        cache_keys = cache.get_keys(self, sentence_keys)
+        all_entities = cache.get_many(cache_keys)
+        missing_indices = [sentence_idx for sentence_idx, entities in enumerate(all_entities) if entities is None]
+        if document_ids is not None:
+            # The uncached sentences need the other sentences of their document as context
+            missing_document_ids = {document_ids[sentence_idx] for sentence_idx in missing_indices}
+            missing_indices = [
+                sentence_idx
+                for sentence_idx, document_id in enumerate(document_ids)
+                if document_id in missing_document_ids
+            ]
+        if not missing_indices:
+            return all_entities
+
+        predicted_entities = self._predict_sentences(
+            [sentences[sentence_idx] for sentence_idx in missing_indices],
+            document_ids=[document_ids[idx] for idx in missing_indices] if document_ids is not None else None,
+            sentence_ids=[sentence_ids[idx] for idx in missing_indices] if sentence_ids is not None else None,
+            **kwargs,
+        )
+        cache.put_many(
+            (cache_keys[sentence_idx], entities) for sentence_idx, entities in zip(missing_indices, predicted_entities)
+        )
+        for sentence_idx, entities in zip(missing_indices, predicted_entities):
+            all_entities[sentence_idx] = entities
+        return all_entities
+
+    def _score_and_decode(
+        self,
+        sentences: List[Union[str, List[str]]],
+        samples: List[Dict[str, Any]],
+        all_num_words: List[int],
+        batch_encoding: BatchEncoding,
+        batch_size: int = 4,
+        show_progress_bar: bool = False,
+        share_text_encoding: bool = False,
+    ) -> List[List[Dict[str, Union[str, int, float]]]]:
+        """Score the samples from :meth:`SpanMarkerModel._prepare_samples`, and decode them into entities."""
+        sample_scores, sample_labels = self._score_samples(
+            samples, batch_size=batch_size, show_progress_bar=show_progress_bar, share_text_encoding=share_text_encoding
+        )
+
+        # Concatenate the spans of spread samples in order, and split the spans of packed samples between sentences
+        all_scores = [[] for _ in sentences]
+        all_labels = [[] for _ in sentences]
+        for sample, scores, labels in zip(samples, sample_scores, sample_labels):
+            span_start_idx = 0
+            for sentence_idx, num_spans in zip(sample["id"], sample["packed_num_spans"]):
+                all_scores[sentence_idx].extend(scores[span_start_idx : span_start_idx + num_spans])
+                all_labels[sentence_idx].extend(labels[span_start_idx : span_start_idx + num_spans])
+                span_start_idx += num_spans
+
+        return decode_entities(
+            sentences,
+            all_scores,
+            all_labels,
+            all_num_words,
+            batch_encoding,
+            entity_max_length=self.config.entity_max_length,
+            id2label=self.config.id2label,
+            outside_id=self.config.outside_id,
+        )
+
+    def _prepare_samples(
+        self,
+        sentences: List[Union[str, List[str]]],
+        document_ids: Optional[List[int]] = None,
+        sentence_ids: Optional[List[int]] = None,
+        pack_sentences: bool = False,
+        show_progress_bar: bool = False,
+    ) -> Tuple[List[Dict[str, Any]], List[int], BatchEncoding]:
+        """Tokenize the sentences, add document-level context, and spread or pack them into samples.
+
+        Every sample has an ``id`` list with the indices of its sentences and a ``packed_num_spans`` list with
+        the number of spans of each of those sentences, also if the sample is not packed.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], List[int], BatchEncoding]: The samples for the data collator, the number
+                of words of each sentence and the batch encoding of the tokenizer.
+        """
+        from span_marker.trainer import Trainer
 
         # Tokenize & add start/end markers
-        tokenizer_dict = self.tokenizer(
-            {"tokens": dataset["tokens"]}, return_num_words=True, return_batch_encoding=True
+        features = self.tokenizer(
+            {"tokens": sentences},
+            return_num_words=True,
+            return_batch_encoding=True,
+            is_split_into_words=not isinstance(sentences[0], str),
         )
-        batch_encoding = tokenizer_dict.pop("batch_encoding")
-        dataset = dataset.remove_columns("tokens")
-        for key, value in tokenizer_dict.items():
-            dataset = dataset.add_column(key, value)
+        batch_encoding = features.pop("batch_encoding")
+        all_num_words = features.pop("num_words")
+        features["id"] = list(range(len(sentences)))
+
         # Add context if possible
-        if {"document_id", "sentence_id"} <= set(dataset.column_names):
+        if document_ids is not None and sentence_ids is not None:
             if not self.config.trained_with_document_context:
                 logger.warning(
                     "This model was trained without document-level context: "
                     "inference with document-level context may cause decreased performance."
                 )
-            # Add column to be able to revert sorting later
-            dataset = dataset.add_column("__sort_id", range(len(dataset)))
             # Sorting by doc ID and then sentence ID is required for add_context
-            dataset = dataset.sort(column_names=["document_id", "sentence_id"])
-            dataset = Trainer.add_context(
-                dataset,
+            order = sorted(range(len(sentences)), key=lambda idx: (document_ids[idx], sentence_ids[idx]))
+            features = {key: [values[idx] for idx in order] for key, values in features.items()}
+            features["document_id"] = [document_ids[idx] for idx in order]
+            features = Trainer.add_context(
+                features,
                 self.tokenizer.model_max_length,
                 max_prev_context=self.config.max_prev_context,
                 max_next_context=self.config.max_next_context,
                 show_progress_bar=show_progress_bar,
             )
-            dataset = dataset.sort(column_names=["__sort_id"])
-            dataset = dataset.remove_columns("__sort_id")
+            del features["document_id"]
         elif self.config.trained_with_document_context:
             logger.warning(
                 "This model was trained with document-level context: "
                 "inference without document-level context may cause decreased performance."
             )
 
-        if not show_progress_bar:
-            disable_progress_bar()
-        dataset = dataset.map(
-            Trainer.spread_sample,
-            batched=True,
-            desc="Spreading data between multiple samples",
-            fn_kwargs={
-                "model_max_length": self.tokenizer.model_max_length,
-                "marker_max_length": self.config.marker_max_length,
-            },
+        features = Trainer.spread_sample(
+            features,
+            model_max_length=self.tokenizer.model_max_length,
+            marker_max_length=self.config.marker_max_length,
         )
-        if not show_progress_bar:
-            enable_progress_bar()
-        for batch_start_idx in trange(0, len(dataset), batch_size, leave=True, disable=not show_progress_bar):
-            batch = dataset.select(range(batch_start_idx, min(len(dataset), batch_start_idx + batch_size)))
-            # Expanding the small tokenized output into full-scale input_ids, position_ids and attention_mask matrices.
-            batch = self.data_collator(batch)
-            # Moving the inputs to the right device
-            batch = {key: value.to(self.device) for key, value in batch.items()}
-            with torch.no_grad():
-                output = self(**batch)
-            # Computing probabilities based on the logits
-            probs = output.logits.softmax(-1)
-            # Get the labels and the correponding probability scores
-            scores, labels = probs.max(-1)
-            # TODO: Iterate over output.num_marker_pairs instead with enumerate
-            for iter_idx in range(output.out_num_marker_pairs.size(0)):
-                input_id = dataset["id"][batch_start_idx + iter_idx]
-                out_num_marker_pairs = output.out_num_marker_pairs[iter_idx]
-                results[input_id]["scores"].extend(scores[iter_idx, :out_num_marker_pairs].tolist())
-                results[input_id]["labels"].extend(labels[iter_idx, :out_num_marker_pairs].tolist())
-                results[input_id]["num_words"] = output.out_num_words[iter_idx]
+        if pack_sentences:
+            # Pack multiple short sentences into one sample, where `id` becomes a list of the packed sentence IDs
+            features = Trainer.pack_samples(
+                features,
+                model_max_length=self.tokenizer.model_max_length,
+                marker_max_length=self.config.marker_max_length,
+            )
+        else:
+            features["id"] = [[sentence_idx] for sentence_idx in features["id"]]
+            features["packed_num_spans"] = [[num_spans] for num_spans in features["num_spans"]]
+        samples = [dict(zip(features.keys(), values)) for values in zip(*features.values())]
+        return samples, all_num_words, batch_encoding
 
-        all_entities = []
-        id2label = self.config.id2label
-        for sample_idx, sample in enumerate(results):
-            scores = sample["scores"]
-            labels = sample["labels"]
-            num_words = sample["num_words"]
-            sentence = sample["tokens"]
-            # Get all of the valid spans to match with the score and labels
-            spans = list(self.tokenizer.get_all_valid_spans(num_words, self.config.entity_max_length))
-
-            word_selected = [False] * num_words
-            sentence_entities = []
-            assert len(spans) == len(scores) and len(spans) == len(labels)
-            for (word_start_index, word_end_index), score, label_id in sorted(
-                zip(spans, scores, labels), key=lambda tup: tup[1], reverse=True
-            ):
-                if label_id != self.config.outside_id and not any(word_selected[word_start_index:word_end_index]):
-                    char_start_index = batch_encoding.word_to_chars(sample_idx, word_start_index).start
-                    char_end_index = batch_encoding.word_to_chars(sample_idx, word_end_index - 1).end
-                    entity = {
-                        "span": sentence[char_start_index:char_end_index]
-                        if isinstance(sentence, str)
-                        else sentence[word_start_index:word_end_index],
-                        "label": id2label[label_id],
-                        "score": score,
-                    }
-                    if isinstance(sentence, str):
-                        entity["char_start_index"] = char_start_index
-                        entity["char_end_index"] = char_end_index
-                    else:
-                        entity["word_start_index"] = word_start_index
-                        entity["word_end_index"] = word_end_index
-                    sentence_entities.append(entity)
-
-                    word_selected[word_start_index:word_end_index] = [True] * (word_end_index - word_start_index)
-            all_entities.append(
-                sorted(
-                    sentence_entities,
-                    key=lambda entity: entity["char_start_index"]
-                    if isinstance(sentence, str)
-                    else entity["word_start_index"],
-                )
+    def _score_samples(
+        self,
+        samples: List[Dict[str, Any]],
+        batch_size: int = 4,
+        show_progress_bar: bool = False,
+        share_text_encoding: bool = False,
+        num_prefetch_batches: int = 2,
+    ) -> Tuple[List[List[float]], List[List[int]]]:
+        """Compute the score and label of every span in the samples.
+
+        The batches are collated in a background thread, ``num_prefetch_batches`` batches ahead of the batch
+        that is currently passed through the model. If the model is on a GPU, then the batches are collated
+        into pinned memory and copied to the GPU asynchronously.
+
+        Returns:
+            Tuple[List[List[float]], List[List[int]]]: The scores and label IDs of the spans in each sample.
+        """
+        # Sort the sentences by the number of tokens of their longest sample, such that each batch consists of
+        # samples of similar lengths, and dynamic padding only pads each batch as far as required for its longest
+        # sample. The samples of a sentence that was spread between multiple samples stay adjacent, so they can
+        # share their text encoding. The scores and labels are stored per sample index, so the order of the
+        # samples is restored afterwards
+        sentence_lengths = defaultdict(int)
+        for sample in samples:
+            sentence_ids = tuple(sample["id"])
+            sentence_lengths[sentence_ids] = max(sentence_lengths[sentence_ids], len(sample["input_ids"]))
+        sample_order = sorted(
+            range(len(samples)),
+            key=lambda sample_idx: (sentence_lengths[tuple(samples[sample_idx]["id"])], samples[sample_idx]["id"]),
+        )
+        num_prefetch_batches = max(num_prefetch_batches, 1)
+        sample_scores = [None] * len(samples)
+        sample_labels = [None] * len(samples)
+        all_batch_indices = [
+            sample_order[batch_start_idx : batch_start_idx + batch_size]
+            for batch_start_idx in range(0, len(samples), batch_size)
+        ]
+        # Let the model compute the attention mask on its device
+        data_collator = dataclasses.replace(self.data_collator, dynamic_padding=True, return_attention_mask=False)
+        # Pinned memory allows for asynchronous copies from the CPU to the GPU
+        pin_memory = self.device.type == "cuda"
+
+        def collate(batch_indices: List[int]) -> Dict[str, torch.Tensor]:
+            # Expanding the small tokenized output into full-scale input_ids and position_ids matrices.
+            batch = data_collator([samples[sample_idx] for sample_idx in batch_indices])
+            if pin_memory:
+                batch = {key: value.pin_memory() for key, value in batch.items()}
+            return batch
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Collate the upcoming batches in a background thread while the current batch runs through the model
+            batch_futures = deque(
+                executor.submit(collate, batch_indices) for batch_indices in all_batch_indices[:num_prefetch_batches]
             )
-        # if the input was a string or a list of tokens, return a list of dictionaries
-        if single_input and len(all_entities) == 1:
-            return all_entities[0]
-        return all_entities
+            for batch_idx, batch_indices in enumerate(
+                tqdm(all_batch_indices, leave=True, disable=not show_progress_bar)
+            ):
+                batch = batch_futures.popleft().result()
+                if batch_idx + num_prefetch_batches < len(all_batch_indices):
+                    batch_futures.append(executor.submit(collate, all_batch_indices[batch_idx + num_prefetch_batches]))
+                # Moving the inputs to the right device
+                batch = {key: value.to(self.device, non_blocking=pin_memory) for key, value in batch.items()}
+                with torch.no_grad():
+                    output = self(**batch, share_text_encoding=share_text_encoding)
+                # Computing probabilities based on the logits
+                probs = output.logits.softmax(-1)
+                # Get the labels and the correponding probability scores
+                scores, labels = probs.max(-1)
+                for iter_idx, (sample_idx, num_marker_pairs) in enumerate(
+                    zip(batch_indices, output.out_num_marker_pairs.tolist())
+                ):
+                    sample_scores[sample_idx] = scores[iter_idx, :num_marker_pairs].tolist()
+                    sample_labels[sample_idx] = labels[iter_idx, :num_marker_pairs].tolist()
+        return sample_scores, sample_labels
 
     def save_pretrained(
         self,
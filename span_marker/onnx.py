@@ -2,7 +2,9 @@ import multiprocessing
 from tqdm import trange
 from typing import Any, Dict, Optional, Union, List
 from span_marker import SpanMarkerModel, SpanMarkerConfig
-from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.modeling import gather_marker_features
+from span_marker.data_collator import SpanMarkerDataCollator, build_attention_mask
+from span_marker.decoding import decode_entities
 from span_marker.output import SpanMarkerOutput
 from span_marker.tokenizer import SpanMarkerTokenizer
 import onnxruntime as ort
@@ -23,34 +25,51 @@ logger = logging.getLogger(__name__)
 class SpanMarkerEncoderDummyInputenerator:
     SUPPORTED_INPUT_NAMES = [
         "input_ids",
-        "attention_mask",
         "position_ids",
+        "start_marker_indices",
+        "num_marker_pairs",
+        "num_tokens",
     ]
     BATCH_SIZE = 1
 
     @classmethod
-    def generate_dummy_input(cls, vocab_size: int, sequence_length: int, torch_dtype: torch.dtype = torch.int32):
-        dummy_input = {}
-        values = {
-            "input_ids": {"max": vocab_size, "min": 0, "shape": [cls.BATCH_SIZE, sequence_length]},
-            "attention_mask": {
-                "max": 1,
-                "min": 0,
-                "shape": [cls.BATCH_SIZE, sequence_length, sequence_length],
-            },
-            "position_ids": {
-                "max": sequence_length,
-                "min": 0,
-                "shape": [cls.BATCH_SIZE, sequence_length],
-            },
+    def generate_dummy_input(
+        cls, vocab_size: int, model_max_length: int, marker_max_length: int, torch_dtype: torch.dtype = torch.int32
+    ):
+        sequence_length = model_max_length + 2 * marker_max_length
+        # A sample with half of the text tokens and all of the marker pairs
+        num_tokens = model_max_length // 2
+        dummy_input = {
+            "input_ids": torch.randint(low=0, high=vocab_size, size=[cls.BATCH_SIZE, sequence_length]),
+            "position_ids": torch.randint(low=0, high=model_max_length, size=[cls.BATCH_SIZE, sequence_length]),
+            "num_tokens": torch.full([cls.BATCH_SIZE], num_tokens),
+            "start_marker_indices": torch.full([cls.BATCH_SIZE], num_tokens + num_tokens % 2),
+            "num_marker_pairs": torch.full([cls.BATCH_SIZE], marker_max_length),
         }
+        return {key: dummy_input[key].to(torch_dtype) for key in cls.SUPPORTED_INPUT_NAMES}
+
+
+class SpanMarkerEncoderWithMask(torch.nn.Module):
+    """
+    Wraps the encoder of a SpanMarker model such that the block-structured attention mask is computed inside the
+    (exported) graph from compact ``num_tokens``, ``start_marker_indices`` and ``num_marker_pairs`` vectors,
+    rather than being materialized on the host and passed as a ``(batch_size, sequence_length, sequence_length)`` input.
+    """
 
-        for value in cls.SUPPORTED_INPUT_NAMES:
-            min_val = values[value]["min"]
-            max_value = values[value]["max"]
-            shape = values[value]["shape"]
-            dummy_input[value] = torch.randint(low=min_val, high=max_value, size=shape, dtype=torch_dtype)
-        return dummy_input
+    def __init__(self, encoder: torch.nn.Module) -> None:
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        position_ids: torch.Tensor,
+        start_marker_indices: torch.Tensor,
+        num_marker_pairs: torch.Tensor,
+        num_tokens: torch.Tensor,
+    ):
+        attention_mask = build_attention_mask(num_tokens, start_marker_indices, num_marker_pairs, input_ids.size(1))
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids)
 
 
 class SpanMarkerOnnx:
@@ -96,10 +115,12 @@ class SpanMarkerOnnx:
         self.config = config
         self.tokenizer = tokenizer
         self.data_collator = SpanMarkerDataCollator(
-            tokenizer=self.tokenizer, marker_max_length=self.config.marker_max_length
+            tokenizer=self.tokenizer, marker_max_length=self.config.marker_max_length, return_attention_mask=False
         )
 
         self.ort_encoder = self.load_ort_session(onnx_encoder_path, sess_options=onnx_sess_options, providers=providers)
+        # Encoders exported before the attention mask was computed in the graph expect a dense `attention_mask` input
+        self.encoder_input_names = [encoder_input.name for encoder_input in self.ort_encoder.get_inputs()]
         self.ort_classifier = self.load_ort_session(
             onnx_classifier_path, sess_options=onnx_sess_options, providers=providers
         )
@@ -146,43 +167,43 @@ class SpanMarkerOnnx:
             return data.detach().cpu().numpy().astype(np_type)
         return data.detach().cpu().numpy().astype(np.int32)
 
-
     def forward(
         self,
         input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        position_ids: torch.Tensor,
-        start_marker_indices: torch.Tensor,
-        num_marker_pairs: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        start_marker_indices: Optional[torch.Tensor] = None,
+        num_marker_pairs: Optional[torch.Tensor] = None,
         num_words: Optional[torch.Tensor] = None,
         document_ids: Optional[torch.Tensor] = None,
         sentence_ids: Optional[torch.Tensor] = None,
+        *,
+        num_tokens: Optional[torch.Tensor] = None,
     ) -> Dict[str, torch.Tensor]:
-        # Moving the inputs to the device with onnx encoder
-        onnx_input = {
-            "input_ids": self.data_to_device(input_ids),
-            "attention_mask": self.data_to_device(attention_mask),
-            "position_ids": self.data_to_device(position_ids),
+        # `attention_mask` and `num_tokens` are each only required by some exported encoders
+        if "attention_mask" in self.encoder_input_names and attention_mask is None:
+            if num_tokens is None:
+                raise ValueError(
+                    "Either `attention_mask` or `num_tokens` must be provided to `SpanMarkerOnnx.forward`."
+                )
+            attention_mask = build_attention_mask(num_tokens, start_marker_indices, num_marker_pairs, input_ids.size(1))
+        if "num_tokens" in self.encoder_input_names and num_tokens is None:
+            # The first token attends exactly all text tokens
+            num_tokens = attention_mask[:, 0].sum(dim=-1)
+        encoder_inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "start_marker_indices": start_marker_indices,
+            "num_marker_pairs": num_marker_pairs,
+            "num_tokens": num_tokens,
         }
+        # Moving the inputs to the device with onnx encoder
+        onnx_input = {name: self.data_to_device(encoder_inputs[name]) for name in self.encoder_input_names}
 
         onnx_output = self.ort_encoder.run(None, input_feed=onnx_input)
         last_hidden_state = torch.from_numpy(onnx_output[0])
-        sequence_length = last_hidden_state.size(1)
-        batch_size = last_hidden_state.size(0)
-        # Get the indices where the end markers start
-        end_marker_indices = start_marker_indices + num_marker_pairs
-        sequence_length_last_hidden_state = last_hidden_state.size(2) * 2
-
-        # TODO: Solve the dynamic slicing problem when exporting with torchdynamo
-        #  Pre-allocates the necessary space for feature_vector
-        feature_vector = torch.zeros(batch_size, sequence_length // 2, sequence_length_last_hidden_state, device="cpu")
-        for i in range(batch_size):
-            feature_vector[
-                i, : end_marker_indices[i] - start_marker_indices[i], : last_hidden_state.shape[-1]
-            ] = last_hidden_state[i, start_marker_indices[i] : end_marker_indices[i]]
-            feature_vector[
-                i, : end_marker_indices[i] - start_marker_indices[i], last_hidden_state.shape[-1] :
-            ] = last_hidden_state[i, end_marker_indices[i] : end_marker_indices[i] + num_marker_pairs[i]]
+        feature_vector = gather_marker_features(last_hidden_state, start_marker_indices.cpu(), num_marker_pairs.cpu())
 
         # Moving the feature_vector to the device with the onnx classifier
         input_onnx_classifier = {"input": self.data_to_device(feature_vector, classifier=True)}
@@ -368,49 +389,16 @@ class SpanMarkerOnnx:
                 results[input_id]["labels"].extend(labels[iter_idx, :out_num_marker_pairs].tolist())
                 results[input_id]["num_words"] = output.out_num_words[iter_idx]
 
-        all_entities = []
-        id2label = self.config.id2label
-        for sample_idx, sample in enumerate(results):
-            scores = sample["scores"]
-            labels = sample["labels"]
-            num_words = sample["num_words"]
-            sentence = sample["tokens"]
-            # Get all of the valid spans to match with the score and labels
-            spans = list(self.tokenizer.get_all_valid_spans(num_words, self.config.entity_max_length))
-
-            word_selected = [False] * num_words
-            sentence_entities = []
-            assert len(spans) == len(scores) and len(spans) == len(labels)
-            for (word_start_index, word_end_index), score, label_id in sorted(
-                zip(spans, scores, labels), key=lambda tup: tup[1], reverse=True
-            ):
-                if label_id != self.config.outside_id and not any(word_selected[word_start_index:word_end_index]):
-                    char_start_index = batch_encoding.word_to_chars(sample_idx, word_start_index).start
-                    char_end_index = batch_encoding.word_to_chars(sample_idx, word_end_index - 1).end
-                    entity = {
-                        "span": sentence[char_start_index:char_end_index]
-                        if isinstance(sentence, str)
-                        else sentence[word_start_index:word_end_index],
-                        "label": id2label[label_id],
-                        "score": score,
-                    }
-                    if isinstance(sentence, str):
-                        entity["char_start_index"] = char_start_index
-                        entity["char_end_index"] = char_end_index
-                    else:
-                        entity["word_start_index"] = word_start_index
-                        entity["word_end_index"] = word_end_index
-                    sentence_entities.append(entity)
-
-                    word_selected[word_start_index:word_end_index] = [True] * (word_end_index - word_start_index)
-            all_entities.append(
-                sorted(
-                    sentence_entities,
-                    key=lambda entity: entity["char_start_index"]
-                    if isinstance(sentence, str)
-                    else entity["word_start_index"],
-                )
-            )
+        all_entities = decode_entities(
+            [sample["tokens"] for sample in results],
+            [sample["scores"] for sample in results],
+            [sample["labels"] for sample in results],
+            [int(sample["num_words"]) for sample in results],
+            batch_encoding,
+            entity_max_length=self.config.entity_max_length,
+            id2label=self.config.id2label,
+            outside_id=self.config.outside_id,
+        )
         # if the input was a string or a list of tokens, return a list of dictionaries
         if single_input and len(all_entities) == 1:
             return all_entities[0]
@@ -454,14 +442,26 @@ def export_spanmarker_to_onnx(
 
     base_model = SpanMarkerModel.from_pretrained(pretrained_model_name_or_path)
     config = SpanMarkerConfig.from_pretrained(pretrained_model_name_or_path)
-    encoder = base_model.encoder.eval()
+    encoder = base_model.encoder
+    if getattr(encoder.config, "_attn_implementation", None) == "sdpa":
+        # The ONNX exporter only supports `scaled_dot_product_attention` from opset 14 onwards,
+        # so the weights are copied into an encoder with the eager attention implementation
+        eager_encoder = SpanMarkerModel._load_encoder_from_config(encoder.config, attn_implementation="eager")
+        eager_encoder.load_state_dict(encoder.state_dict())
+        encoder = eager_encoder
+    encoder = encoder.eval()
     classifier = base_model.classifier.eval()
 
+    encoder = SpanMarkerEncoderWithMask(encoder)
+
     # Dummy input for encoder and classifier
+    model_max_length = base_model.tokenizer.model_max_length
     encoder_dummy_input = SpanMarkerEncoderDummyInputenerator.generate_dummy_input(
-        vocab_size=config.vocab_size, sequence_length=config.model_max_length_default
+        vocab_size=config.vocab_size, model_max_length=model_max_length, marker_max_length=config.marker_max_length
+    )
+    classifier_dummy_input = torch.randn(
+        1, (model_max_length + 2 * config.marker_max_length) // 2, base_model.classifier.in_features
     )
-    classifier_dummy_input = torch.randn(1, 256, 1536)
 
     # Moving to device
     encoder_dummy_input = {key: value.to(device=torch.device(device)) for key, value in encoder_dummy_input.items()}
@@ -485,18 +485,16 @@ def export_spanmarker_to_onnx(
     # Export Onnx encoder
     torch.onnx.export(
         encoder,
-        encoder_dummy_input,
+        tuple(encoder_dummy_input.values()),
         onnx_encoder_path,
-        input_names=[
-            "input_ids",
-            "attention_mask",
-            "position_ids",
-        ],
+        input_names=list(encoder_dummy_input.keys()),
         output_names=["last_hidden_state", "pooler_output"],
         dynamic_axes={
             "input_ids": {0: "batch_size"},
-            "attention_mask": {0: "batch_size"},
             "position_ids": {0: "batch_size"},
+            "num_tokens": {0: "batch_size"},
+            "start_marker_indices": {0: "batch_size"},
+            "num_marker_pairs": {0: "batch_size"},
             "last_hidden_state": {0: "batch_size"},
             "pooler_output": {0: "batch_size"},
         },
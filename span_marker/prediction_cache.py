@@ -0,0 +1,295 @@
+import copy
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+from typing import TYPE_CHECKING, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+import torch
+
+if TYPE_CHECKING:
+    from span_marker.modeling import SpanMarkerModel
+
+Entities = List[Dict[str, Union[str, int, float]]]
+
+
+def get_sentence_keys(
+    sentences: List[Union[str, List[str]]],
+    document_ids: Optional[List[int]] = None,
+    sentence_ids: Optional[List[int]] = None,
+    max_prev_context: Optional[int] = None,
+    max_next_context: Optional[int] = None,
+) -> List[Hashable]:
+    """Compute a key for each sentence, such that two sentences have the same key if and only if the model
+    predicts the same entities for them.
+
+    Without document-level context, the key of a sentence only depends on the sentence itself. With document-level
+    context, the key also contains the previous and next sentences of the same document that may be added as context.
+
+    Args:
+        sentences (List[Union[str, List[str]]]): String sentences or pre-tokenized sentences.
+        document_ids (Optional[List[int]]): The document ID of each sentence, used for document-level context.
+        sentence_ids (Optional[List[int]]): The sentence ID of each sentence, used for document-level context.
+        max_prev_context (Optional[int]): The maximum number of previous sentences that are added as context.
+            Defaults to None, representing all previous sentences in the document.
+        max_next_context (Optional[int]): The maximum number of next sentences that are added as context.
+            Defaults to None, representing all next sentences in the document.
+
+    Returns:
+        List[Hashable]: A hashable and JSON serializable key for each sentence.
+    """
+    # Strings and lists of words are distinct inputs, even if they consist of the same characters
+    sentence_keys = [sentence if isinstance(sentence, str) else tuple(sentence) for sentence in sentences]
+    if document_ids is None or sentence_ids is None:
+        return sentence_keys
+
+    documents = defaultdict(list)
+    for sentence_idx, document_id in enumerate(document_ids):
+        documents[document_id].append(sentence_idx)
+    keys = [None] * len(sentences)
+    for document in documents.values():
+        document.sort(key=lambda sentence_idx: sentence_ids[sentence_idx])
+        for position, sentence_idx in enumerate(document):
+            prev_start = 0 if max_prev_context is None else max(position - max_prev_context, 0)
+            next_end = len(document) if max_next_context is None else position + 1 + max_next_context
+            keys[sentence_idx] = (
+                sentence_keys[sentence_idx],
+                tuple(sentence_keys[idx] for idx in document[prev_start:position]),
+                tuple(sentence_keys[idx] for idx in document[position + 1 : next_end]),
+            )
+    return keys
+
+
+def get_model_fingerprint(model: "SpanMarkerModel") -> str:
+    """Compute a hash of the configuration, tokenizer settings and weights of a model.
+
+    Args:
+        model (SpanMarkerModel): The model to fingerprint.
+
+    Returns:
+        str: A hexadecimal SHA-256 hash.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(model.config.to_json_string(use_diff=False).encode())
+    fingerprint.update(str(model.tokenizer.model_max_length).encode())
+    for name, tensor in model.state_dict().items():
+        fingerprint.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        fingerprint.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return fingerprint.hexdigest()
+
+
+class PredictionCache:
+    """A content-addressed cache of predicted entities, which allows repeated sentences to skip tokenization
+    and the model entirely.
+
+    The entities are stored in an in-memory LRU cache, and optionally in an SQLite database on disk, which persists
+    between processes. Entries are keyed by a hash of the sentence, its document-level context, and a fingerprint
+    of the model weights and configuration, so the cache can be shared between models.
+
+    Example::
+
+        >>> cache = PredictionCache(max_memory_entries=100_000, path="predictions.sqlite")
+        >>> model.predict(sentences, cache=cache)
+        >>> cache.stats()
+        {'hits': 1630, 'misses': 370, 'memory_hits': 1630, 'disk_hits': 0, 'hit_rate': 0.815, ...}
+
+    Note:
+        The fingerprint of a model is computed once, when the model is first used with this cache. Call
+        :meth:`PredictionCache.forget_model` after modifying the weights of a model, e.g. by training it further.
+
+    Args:
+        max_memory_entries (int): The maximum number of sentences in the in-memory cache, after which the least
+            recently used entries are evicted. Defaults to 100,000.
+        path (Optional[str]): The path of an SQLite database to use as the on-disk cache. Defaults to None,
+            i.e. no on-disk cache.
+        max_disk_bytes (Optional[int]): The maximum total size of the serialized entities in the on-disk cache,
+            after which the least recently used entries are evicted. Defaults to None, i.e. no size limit.
+    """
+
+    def __init__(
+        self, max_memory_entries: int = 100_000, path: Optional[str] = None, max_disk_bytes: Optional[int] = None
+    ) -> None:
+        self.max_memory_entries = max_memory_entries
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, Entities]" = OrderedDict()
+        self._fingerprints: "weakref.WeakKeyDictionary[SpanMarkerModel, str]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+        self._connection = None
+        self._disk_bytes = 0
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions "
+                "(key TEXT PRIMARY KEY, entities TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS last_access_index ON predictions (last_access)")
+            self._connection.commit()
+            (self._disk_bytes,) = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()
+
+    def get_keys(self, model: "SpanMarkerModel", sentence_keys: Iterable[Hashable]) -> List[str]:
+        """Compute the cache keys of sentences for a model.
+
+        Args:
+            model (SpanMarkerModel): The model that predicts the sentences.
+            sentence_keys (Iterable[Hashable]): The keys of the sentences, see :func:`get_sentence_keys`.
+
+        Returns:
+            List[str]: A hexadecimal SHA-256 cache key for each sentence.
+        """
+        with self._lock:
+            if model not in self._fingerprints:
+                self._fingerprints[model] = get_model_fingerprint(model)
+            fingerprint = self._fingerprints[model]
+        return [
+            hashlib.sha256(json.dumps([fingerprint, sentence_key], ensure_ascii=False).encode()).hexdigest()
+            for sentence_key in sentence_keys
+        ]
+
+    def get_many(self, keys: List[str]) -> List[Optional[Entities]]:
+        """Look up the entities of multiple sentences, first in memory and then on disk.
+
+        Args:
+            keys (List[str]): The cache keys of the sentences.
+
+        Returns:
+            List[Optional[Entities]]: A copy of the cached entities of each sentence, or None if a sentence
+                is not cached.
+        """
+        with self._lock:
+            all_entities = [None] * len(keys)
+            disk_keys = []
+            for idx, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    all_entities[idx] = self._memory[key]
+                    self._memory_hits += 1
+                else:
+                    disk_keys.append(key)
+
+            if disk_keys and self._connection is not None:
+                disk_entities = {}
+                for key, entities in self._select("entities", disk_keys):
+                    disk_entities[key] = json.loads(entities)
+                self._connection.executemany(
+                    "UPDATE predictions SET last_access = ? WHERE key = ?",
+                    [(time.time(), key) for key in disk_entities],
+                )
+                self._connection.commit()
+                for idx, key in enumerate(keys):
+                    if all_entities[idx] is None and key in disk_entities:
+                        all_entities[idx] = disk_entities[key]
+                        self._disk_hits += 1
+                        self._set_memory(key, disk_entities[key])
+            self._misses += sum(entities is None for entities in all_entities)
+        # The cached entities must not be affected if the caller modifies the returned entities
+        return [copy.deepcopy(entities) for entities in all_entities]
+
+    def put_many(self, items: Iterable[Tuple[str, Entities]]) -> None:
+        """Store the entities of multiple sentences, both in memory and on disk.
+
+        Args:
+            items (Iterable[Tuple[str, Entities]]): Pairs of cache keys and entities.
+        """
+        # Duplicate sentences share a key, which must only be stored and counted once
+        items = {key: copy.deepcopy(entities) for key, entities in items}
+        with self._lock:
+            for key, entities in items.items():
+                self._set_memory(key, entities)
+            if self._connection is not None:
+                rows = []
+                for key, entities in items.items():
+                    serialized = json.dumps(entities, ensure_ascii=False)
+                    rows.append((key, serialized, len(serialized.encode()), time.time()))
+                # Replaced rows must not be counted twice
+                self._disk_bytes -= sum(size for _key, size in self._select("size", [row[0] for row in rows]))
+                self._connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)", rows)
+                self._disk_bytes += sum(row[2] for row in rows)
+                self._evict_disk()
+                self._connection.commit()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Report the cache statistics.
+
+        Returns:
+            Dict[str, Union[int, float]]: A dictionary with the number of ``hits``, ``misses``, ``memory_hits``
+                and ``disk_hits``, the ``hit_rate``, the number of ``memory_entries`` and ``disk_entries``, and
+                the ``disk_bytes`` of the serialized entities on disk.
+        """
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            disk_entries = 0
+            if self._connection is not None:
+                (disk_entries,) = self._connection.execute("SELECT COUNT(*) FROM predictions").fetchone()
+            return {
+                "hits": hits,
+                "misses": self._misses,
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "hit_rate": hits / (hits + self._misses) if hits + self._misses else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def forget_model(self, model: "SpanMarkerModel") -> None:
+        """Recompute the fingerprint of a model on its next use, e.g. after its weights have been modified.
+
+        Args:
+            model (SpanMarkerModel): The model to forget.
+        """
+        with self._lock:
+            self._fingerprints.pop(model, None)
+
+    def clear(self) -> None:
+        """Remove all entries from the in-memory and on-disk cache, and reset the statistics."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_hits = self._disk_hits = self._misses = 0
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM predictions")
+                self._connection.commit()
+                self._disk_bytes = 0
+
+    def close(self) -> None:
+        """Close the connection to the on-disk cache."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _set_memory(self, key: str, entities: Entities) -> None:
+        self._memory[key] = entities
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _select(self, column: str, keys: List[str]) -> List[Tuple[str, Union[str, int]]]:
+        rows = []
+        # SQLite limits the number of parameters of a query
+        for start_idx in range(0, len(keys), 500):
+            chunk = keys[start_idx : start_idx + 500]
+            rows += self._connection.execute(
+                f"SELECT key, {column} FROM predictions WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall()
+        return rows
+
+    def _evict_disk(self) -> None:
+        if self.max_disk_bytes is None or self._disk_bytes <= self.max_disk_bytes:
+            return
+        # Evict the least recently used entries until the cache is at most 90% full, to avoid evicting on every put
+        target_bytes = int(self.max_disk_bytes * 0.9)
+        evicted_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM predictions ORDER BY last_access"):
+            if self._disk_bytes <= target_bytes:
+                break
+            evicted_keys.append((key,))
+            self._disk_bytes -= size
+        self._connection.executemany("DELETE FROM predictions WHERE key = ?", evicted_keys)
@@ -6,9 +6,15 @@ from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 from tokenizers.pre_tokenizers import Punctuation, Sequence
-from transformers import AutoTokenizer, PreTrainedTokenizer, XLMRobertaTokenizerFast
+from transformers import (
+    AutoTokenizer,
+    BatchEncoding,
+    PreTrainedTokenizer,
+    XLMRobertaTokenizerFast,
+)
 
 from span_marker.configuration import SpanMarkerConfig
+from span_marker.decoding import get_span_arrays, get_spans
 
 logger = logging.getLogger(__name__)
 
@@ -132,6 +138,17 @@ class EntityTracker:
         """
         self.skipped_entities[length] += 1
 
+    def merge(self, total_num_entities: int, skipped_entities: Dict[int, int]) -> None:
+        """Merge partial counts into this tracker, e.g. counts from tokenizing in multiple processes.
+
+        Args:
+            total_num_entities (int): The number of entities in the partial counts.
+            skipped_entities (Dict[int, int]): The number of missed entities per entity length.
+        """
+        self.total_num_entities += total_num_entities
+        for length, freq in skipped_entities.items():
+            self.skipped_entities[length] += freq
+
     def reset(self) -> None:
         """Reset to defaults, stops tracking."""
         self.total_num_entities = 0
@@ -159,9 +176,8 @@ class SpanMarkerTokenizer:
         self.entity_tracker = EntityTracker(self.config.entity_max_length, self.model_max_length)
 
     def get_all_valid_spans(self, num_words: int, entity_max_length: int) -> Iterator[Tuple[int, int]]:
-        for start_idx in range(num_words):
-            for end_idx in range(start_idx + 1, min(num_words + 1, start_idx + 1 + entity_max_length)):
-                yield (start_idx, end_idx)
+        # The spans are memoized per (num_words, entity_max_length)
+        return iter(get_spans(int(num_words), entity_max_length))
 
     def get_all_valid_spans_and_labels(
         self, num_words: int, span_to_label: Dict[Tuple[int, int], int], entity_max_length: int, outside_id: int
@@ -169,6 +185,38 @@ class SpanMarkerTokenizer:
         for span in self.get_all_valid_spans(num_words, entity_max_length):
             yield span, span_to_label.pop(span, outside_id)
 
+    def get_word_token_positions(
+        self, batch_encoding: BatchEncoding, sample_idx: int
+    ) -> Tuple[int, np.ndarray, np.ndarray]:
+        """Compute the number of words of a sample, and the position of the first and last token of each word.
+
+        Equivalent to calling ``batch_encoding.word_to_tokens`` for every word, but at once.
+
+        Args:
+            batch_encoding (BatchEncoding): The output of a fast tokenizer.
+            sample_idx (int): The index of the sample in the batch encoding.
+
+        Returns:
+            Tuple[int, np.ndarray, np.ndarray]: The number of words, and the position of the first and of the last
+                token of each word. Words without tokens, e.g. '\\u2063', have position 0.
+        """
+        word_ids = batch_encoding.word_ids(sample_idx)
+        word_ids = np.fromiter((-1 if word_id is None else word_id for word_id in word_ids), np.int64, len(word_ids))
+        token_positions = np.flatnonzero(word_ids >= 0)
+        if len(token_positions) == 0:
+            raise ValueError("The `SpanMarkerTokenizer` detected an empty sentence, please remove it.")
+        word_ids = word_ids[token_positions]
+        num_words = int(word_ids.max()) + 1
+
+        word_start_positions = np.full(num_words, np.iinfo(np.int64).max, dtype=np.int64)
+        word_end_positions = np.full(num_words, -1, dtype=np.int64)
+        np.minimum.at(word_start_positions, word_ids, token_positions)
+        np.maximum.at(word_end_positions, word_ids, token_positions)
+        has_no_tokens = word_end_positions < 0
+        word_start_positions[has_no_tokens] = 0
+        word_end_positions[has_no_tokens] = 0
+        return num_words, word_start_positions, word_end_positions
+
     def __getattribute__(self, key: str) -> Any:
         try:
             return super().__getattribute__(key)
@@ -176,27 +224,39 @@ class SpanMarkerTokenizer:
             return super().__getattribute__("tokenizer").__getattribute__(key)
 
     def __call__(
-        self, batch: Dict[str, List[Any]], return_num_words: bool = False, return_batch_encoding=False, **kwargs
+        self,
+        batch: Dict[str, List[Any]],
+        return_num_words: bool = False,
+        return_batch_encoding=False,
+        is_split_into_words: Optional[bool] = None,
+        return_entity_counts: bool = False,
+        **kwargs,
     ) -> Dict[str, List]:
         tokens = batch["tokens"]
         labels = batch.get("ner_tags", None)
-        is_split_into_words = True
-        if isinstance(tokens, str):
-            is_split_into_words = False
-        elif tokens:
-            for token in tokens:
-                if " " in token:
-                    is_split_into_words = False
-                    break
-
+        # Infer whether the sentences are pre-tokenized if not specified
+        if is_split_into_words is None:
+            is_split_into_words = True
+            if isinstance(tokens, str):
+                is_split_into_words = False
+            elif tokens:
+                for token in tokens:
+                    if " " in token:
+                        is_split_into_words = False
+                        break
+
+        # A single sentence is tokenized as a batch with one sentence
+        if isinstance(tokens, str) or (is_split_into_words and tokens and isinstance(tokens[0], str)):
+            tokens = [tokens]
+
+        # The sentences are not padded, as only the tokens themselves are stored, and the data collator pads
+        # each batch. This also avoids converting all sentences to tensors of `model_max_length` tokens
         batch_encoding = self.tokenizer(
             tokens,
             **kwargs,
             is_split_into_words=is_split_into_words,
-            padding="max_length",
             truncation=True,
             max_length=self.model_max_length,
-            return_tensors="pt",
         )
 
         all_input_ids = []
@@ -205,50 +265,47 @@ class SpanMarkerTokenizer:
         all_end_position_ids = []
         all_labels = []
         all_num_words = []
+        all_num_entities = []
+        all_missed_entity_lengths = []
+        entity_max_length = self.config.entity_max_length
         for sample_idx, input_ids in enumerate(batch_encoding["input_ids"]):
-            max_word_ids = np.nanmax(np.array(batch_encoding.word_ids(sample_idx), dtype=float))
-            if np.isnan(max_word_ids):
-                raise ValueError("The `SpanMarkerTokenizer` detected an empty sentence, please remove it.")
-            num_words = int(max_word_ids) + 1
-            if self.tokenizer.pad_token_id in input_ids:
-                num_tokens = list(input_ids).index(self.tokenizer.pad_token_id)
-            else:
-                num_tokens = len(input_ids)
+            num_words, word_start_positions, word_end_positions = self.get_word_token_positions(
+                batch_encoding, sample_idx
+            )
+
+            span_starts, span_ends = get_span_arrays(num_words, entity_max_length)
             if labels:
                 span_to_label = {(start_idx, end_idx): label for label, start_idx, end_idx in labels[sample_idx]}
-                if self.entity_tracker.enabled:
+                missed_entity_lengths = []
+                span_labels = np.full(len(span_starts), self.config.outside_id, dtype=np.int64)
+                # The index of the first span that starts at each word
+                first_span_indices = np.searchsorted(span_starts, np.arange(num_words))
+                for (start_idx, end_idx), label in span_to_label.items():
+                    if 0 <= start_idx < end_idx <= num_words and end_idx - start_idx <= entity_max_length:
+                        span_labels[first_span_indices[start_idx] + end_idx - start_idx - 1] = label
+                    else:
+                        # This entity can not be represented by a span, so we track it for a useful warning
+                        missed_entity_lengths.append(end_idx - start_idx)
+
+                if return_entity_counts:
+                    # Returned rather than tracked, e.g. as the tracker of a worker process is lost after mapping
+                    all_num_entities.append(len(span_to_label))
+                    all_missed_entity_lengths.append(missed_entity_lengths)
+                elif self.entity_tracker.enabled:
                     self.entity_tracker.add(len(span_to_label))
-                spans, span_labels = zip(
-                    *list(
-                        self.get_all_valid_spans_and_labels(
-                            num_words, span_to_label, self.config.entity_max_length, self.config.outside_id
-                        )
-                    )
-                )
-                # `self.get_all_valid_spans_and_labels` popped `span_to_label`, so if it's non-empty, then that
-                # entity was ignored, and we may want to track it for a useful warning
-                if self.entity_tracker.enabled:
-                    for start, end in span_to_label.keys():
-                        self.entity_tracker.missed(end - start)
-            else:
-                spans = list(self.get_all_valid_spans(num_words, self.config.entity_max_length))
-
-            start_position_ids, end_position_ids = [], []
-            for start_word_i, end_word_i in spans:
-                start_token_span = batch_encoding.word_to_tokens(sample_idx, word_index=start_word_i)
-                # The if ... else 0 exists because of words like '\u2063'
-                start_position_ids.append(start_token_span.start if start_token_span else 0)
+                    for length in missed_entity_lengths:
+                        self.entity_tracker.missed(length)
 
-                end_token_span = batch_encoding.word_to_tokens(sample_idx, word_index=end_word_i - 1)
-                end_position_ids.append(end_token_span.end - 1 if end_token_span else 0)
+            start_position_ids = word_start_positions[span_starts].tolist()
+            end_position_ids = word_end_positions[span_ends - 1].tolist()
 
-            all_input_ids.append(input_ids[:num_tokens].tolist())
-            all_num_spans.append(len(spans))
+            all_input_ids.append(input_ids)
+            all_num_spans.append(len(span_starts))
             all_start_position_ids.append(start_position_ids)
             all_end_position_ids.append(end_position_ids)
 
             if labels:
-                all_labels.append(span_labels)
+                all_labels.append(span_labels.tolist())
 
             if return_num_words:
                 all_num_words.append(num_words)
@@ -264,6 +321,10 @@ class SpanMarkerTokenizer:
         if return_num_words:
             # Store the number of words, useful for computing the spans in the evaluation and model.predict() method
             output["num_words"] = all_num_words
+        if labels and return_entity_counts:
+            # The number of entities and the lengths of the missed entities, to be merged into the entity tracker
+            output["num_entities"] = all_num_entities
+            output["missed_entity_lengths"] = all_missed_entity_lengths
         if return_batch_encoding:
             # Store the batch encoding, useful for converting word IDs to characters in the model.predict() method
             output["batch_encoding"] = batch_encoding
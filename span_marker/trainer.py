@@ -2,10 +2,14 @@ import dataclasses
 import logging
 import math
 import os
-from typing import Any, Callable, Dict, List, Optional, Tuple
+import shutil
+import weakref
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from datasets import Dataset
+from datasets.fingerprint import Hasher
 from torch.utils.data import DataLoader
 from tqdm.autonotebook import tqdm
 from transformers import (
@@ -16,6 +20,7 @@ from transformers import (
 from transformers import Trainer as TransformersTrainer
 from transformers.trainer_utils import PredictionOutput
 
+from span_marker import __version__ as span_marker_version
 from span_marker.evaluation import compute_f1_via_seqeval
 from span_marker.label_normalizer import AutoLabelNormalizer, LabelNormalizer
 from span_marker.model_card import ModelCardCallback
@@ -66,6 +71,15 @@ class Trainer(TransformersTrainer):
             by this function will be reflected in the predictions received by ``compute_metrics``.
 
             Note that the labels (second parameter) will be ``None`` if the dataset does not have them.
+        pack_sentences (bool): Whether to pack multiple short training sentences into one sample, such that
+            fewer samples are needed for training. The sentences in a packed sample cannot attend each other.
+            Evaluation samples are never packed. Defaults to False.
+        preprocessing_cache_dir (Optional[str]): The directory in which to store the preprocessed datasets, such that
+            later runs with the same datasets, tokenizer and configuration skip preprocessing. The preprocessed
+            datasets are always cached on the Trainer itself, such that repeated evaluations only preprocess the
+            evaluation dataset once. Defaults to None, i.e. no on-disk cache.
+        num_proc (Optional[int]): The number of processes used to preprocess the datasets. Defaults to None,
+            i.e. preprocessing in the main process.
 
     Important attributes:
 
@@ -97,6 +111,9 @@ class Trainer(TransformersTrainer):
         callbacks: Optional[List[TrainerCallback]] = None,
         optimizers: Tuple[Optional[torch.optim.Optimizer], Optional[torch.optim.lr_scheduler.LambdaLR]] = (None, None),
         preprocess_logits_for_metrics: Optional[Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = None,
+        pack_sentences: bool = False,
+        preprocessing_cache_dir: Optional[str] = None,
+        num_proc: Optional[int] = None,
     ) -> None:
         # Extract the model from an initializer function
         if model_init:
@@ -155,6 +172,13 @@ class Trainer(TransformersTrainer):
         # and the Transformers Trainer would complain if we provide both a model and a model_init
         # in its __init__.
         self.model_init = model_init
+        self.pack_sentences = pack_sentences
+        self.preprocessing_cache_dir = preprocessing_cache_dir
+        self.num_proc = num_proc
+        self._preprocessed_datasets: Dict[str, Dataset] = {}
+        self._tokenizer_fingerprints: "weakref.WeakKeyDictionary[SpanMarkerTokenizer, str]" = (
+            weakref.WeakKeyDictionary()
+        )
 
         # Override the type hint
         self.model: SpanMarkerModel
@@ -173,6 +197,9 @@ class Trainer(TransformersTrainer):
     ) -> Dataset:
         """Normalize the ``ner_tags`` labels and call tokenizer on ``tokens``.
 
+        The preprocessed dataset is cached based on the fingerprint of ``dataset``, the tokenizer and the relevant
+        configuration, so preprocessing the same dataset again returns the cached dataset.
+
         Args:
             dataset (~datasets.Dataset): A Hugging Face dataset with ``tokens`` and ``ner_tags`` columns.
             label_normalizer (LabelNormalizer): A callable that normalizes ``ner_tags`` into start-end-label tuples.
@@ -192,56 +219,45 @@ class Trainer(TransformersTrainer):
             if column not in dataset.column_names:
                 raise ValueError(f"The {dataset_name} dataset must contain a {column!r} column.")
 
+        cache_key = self.get_preprocessing_cache_key(dataset, tokenizer, is_evaluate=is_evaluate)
+        preprocessed_dataset = self._load_preprocessed_dataset(cache_key)
+        if preprocessed_dataset is not None:
+            logger.info(f"Loaded the preprocessed {dataset_name} dataset from the cache.")
+            # Only normalize the labels if the model card data is missing, e.g. when loading from disk in a new run
+            if self._is_model_card_data_missing(is_evaluate):
+                self._set_model_card_data(self._normalize_labels(dataset, label_normalizer, dataset_name), is_evaluate)
+            self._check_document_context(dataset, is_evaluate)
+            return preprocessed_dataset
+
         # Drop all unused columns, only keep "tokens", "ner_tags", "document_id", "sentence_id"
         dataset = dataset.remove_columns(
             set(dataset.column_names) - set(self.OPTIONAL_COLUMNS) - set(self.REQUIRED_COLUMNS)
         )
-        # Normalize the labels to a common format (list of label-start-end tuples)
-        # Also add "entity_count" and "word_count" labels
-        dataset = dataset.map(
-            label_normalizer,
-            input_columns=("tokens", "ner_tags"),
-            desc=f"Label normalizing the {dataset_name} dataset",
-            batched=True,
-        )
-
-        # Setting model card data based on training data
-        if not is_evaluate:
-            # Pick some example entities from each entity class for the model card.
-            if not self.model.model_card_data.label_example_list:
-                self.model.model_card_data.set_label_examples(
-                    dataset, self.model.config.id2label, self.model.config.outside_id
-                )
-            if not self.model.model_card_data.train_set_metrics_list:
-                self.model.model_card_data.set_train_set_metrics(dataset)
-
-        # Set some example sentences for the model card widget
-        if is_evaluate and not self.model.model_card_data.widget:
-            self.model.model_card_data.set_widget_examples(dataset)
+        dataset = self._normalize_labels(dataset, label_normalizer, dataset_name)
+        self._set_model_card_data(dataset, is_evaluate)
 
         # Remove dataset columns that are only used for model card
         dataset = dataset.remove_columns(("entity_count", "word_count"))
 
         # Tokenize and add start/end markers
-        with tokenizer.entity_tracker(split=dataset_name):
+        with tokenizer.entity_tracker(split=dataset_name) as entity_tracker:
             dataset = dataset.map(
                 tokenizer,
                 batched=True,
                 remove_columns=set(dataset.column_names) - set(self.OPTIONAL_COLUMNS),
                 desc=f"Tokenizing the {dataset_name} dataset",
-                fn_kwargs={"return_num_words": is_evaluate},
+                fn_kwargs={"return_num_words": is_evaluate, "return_entity_counts": True},
+                num_proc=self.num_proc,
             )
-        # If "document_id" AND "sentence_id" exist in the training dataset
-        if {"document_id", "sentence_id"} <= set(dataset.column_names):
-            # If training, set the config flag that this model is trained with document context
-            if not is_evaluate:
-                self.model.config.trained_with_document_context = True
-            # If evaluating and the model was not trained with document context, warn
-            elif not self.model.config.trained_with_document_context:
-                logger.warning(
-                    "This model was trained without document-level context: "
-                    "evaluation with document-level context may cause decreased performance."
+            # The entity counts are returned as columns, as the entity tracker of worker processes is not shared
+            if "num_entities" in dataset.column_names:
+                entity_tracker.merge(
+                    sum(dataset["num_entities"]),
+                    Counter(length for lengths in dataset["missed_entity_lengths"] for length in lengths),
                 )
+                dataset = dataset.remove_columns(("num_entities", "missed_entity_lengths"))
+        # If "document_id" AND "sentence_id" exist in the training dataset
+        if self._check_document_context(dataset, is_evaluate):
             dataset = dataset.sort(column_names=["document_id", "sentence_id"])
             dataset = self.add_context(
                 dataset,
@@ -249,11 +265,6 @@ class Trainer(TransformersTrainer):
                 max_prev_context=self.model.config.max_prev_context,
                 max_next_context=self.model.config.max_next_context,
             )
-        elif is_evaluate and self.model.config.trained_with_document_context:
-            logger.warning(
-                "This model was trained with document-level context: "
-                "evaluation without document-level context may cause decreased performance."
-            )
 
         # Spread between multiple samples where needed
         original_length = len(dataset)
@@ -261,6 +272,7 @@ class Trainer(TransformersTrainer):
             Trainer.spread_sample,
             batched=True,
             desc="Spreading data between multiple samples",
+            num_proc=self.num_proc,
             fn_kwargs={
                 "model_max_length": tokenizer.model_max_length,
                 "marker_max_length": self.model.config.marker_max_length,
@@ -273,20 +285,171 @@ class Trainer(TransformersTrainer):
             "`model_max_length` or `marker_max_length` to decrease the number of samples, "
             "but recognize that longer samples are slower."
         )
+
+        # Pack multiple short training sentences into one sample
+        if self.pack_sentences and not is_evaluate:
+            dataset = dataset.remove_columns(set(dataset.column_names) & set(self.OPTIONAL_COLUMNS))
+            dataset = dataset.map(
+                Trainer.pack_samples,
+                batched=True,
+                desc="Packing multiple sentences into samples",
+                num_proc=self.num_proc,
+                fn_kwargs={
+                    "model_max_length": tokenizer.model_max_length,
+                    "marker_max_length": self.model.config.marker_max_length,
+                },
+            )
+            logger.info(f"Packed {new_length} samples into {len(dataset)} samples.")
+
+        self._store_preprocessed_dataset(cache_key, dataset)
         return dataset
 
+    def get_preprocessing_cache_key(
+        self, dataset: Dataset, tokenizer: SpanMarkerTokenizer, is_evaluate: bool = False
+    ) -> str:
+        """Compute the key under which the preprocessed version of a dataset is cached.
+
+        The key covers the fingerprint of the dataset, the vocabulary and maximum length of the tokenizer, the
+        labels and the span, marker and document-level context settings of the configuration, and whether the
+        sentences are packed.
+
+        Args:
+            dataset (~datasets.Dataset): A Hugging Face dataset with ``tokens`` and ``ner_tags`` columns.
+            tokenizer (SpanMarkerTokenizer): The tokenizer used to preprocess the dataset.
+            is_evaluate (bool, optional): Whether the dataset is preprocessed for evaluation. Defaults to False.
+
+        Returns:
+            str: A hexadecimal hash.
+        """
+        config = self.model.config
+        # Hashing the vocabulary is expensive, so it is only done once per tokenizer
+        if tokenizer not in self._tokenizer_fingerprints:
+            # The vocabulary rather than the tokenizer itself is hashed, as calling a tokenizer modifies its state
+            self._tokenizer_fingerprints[tokenizer] = Hasher.hash(
+                (
+                    tokenizer.tokenizer.__class__.__name__,
+                    tokenizer.tokenizer.name_or_path,
+                    sorted(tokenizer.tokenizer.get_vocab().items()),
+                )
+            )
+        return Hasher.hash(
+            {
+                "span_marker_version": span_marker_version,
+                "dataset": dataset._fingerprint,
+                # The vocabulary size and maximum length are cheap to include, and catch tokens added later on
+                "tokenizer": (self._tokenizer_fingerprints[tokenizer], len(tokenizer), tokenizer.model_max_length),
+                "config": {
+                    key: getattr(config, key, None)
+                    for key in (
+                        "id2label",
+                        "id2reduced_id",
+                        "entity_max_length",
+                        "marker_max_length",
+                        "max_prev_context",
+                        "max_next_context",
+                    )
+                },
+                "is_evaluate": is_evaluate,
+                "pack_sentences": self.pack_sentences and not is_evaluate,
+            }
+        )
+
+    def _load_preprocessed_dataset(self, cache_key: str) -> Optional[Dataset]:
+        if cache_key in self._preprocessed_datasets:
+            return self._preprocessed_datasets[cache_key]
+        if self.preprocessing_cache_dir is not None:
+            path = os.path.join(self.preprocessing_cache_dir, cache_key)
+            if os.path.isdir(path):
+                self._preprocessed_datasets[cache_key] = Dataset.load_from_disk(path)
+                return self._preprocessed_datasets[cache_key]
+        return None
+
+    def _store_preprocessed_dataset(self, cache_key: str, dataset: Dataset) -> None:
+        self._preprocessed_datasets[cache_key] = dataset
+        if self.preprocessing_cache_dir is None:
+            return
+        path = os.path.join(self.preprocessing_cache_dir, cache_key)
+        if os.path.isdir(path):
+            return
+        # Save to a temporary directory first, such that other processes never load a partially saved dataset
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            dataset.save_to_disk(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another process may have saved the same dataset in the meantime
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _normalize_labels(self, dataset: Dataset, label_normalizer: LabelNormalizer, dataset_name: str) -> Dataset:
+        # Normalize the labels to a common format (list of label-start-end tuples)
+        # Also add "entity_count" and "word_count" labels
+        return dataset.map(
+            label_normalizer,
+            input_columns=("tokens", "ner_tags"),
+            desc=f"Label normalizing the {dataset_name} dataset",
+            batched=True,
+            num_proc=self.num_proc,
+        )
+
+    def _is_model_card_data_missing(self, is_evaluate: bool) -> bool:
+        model_card_data = self.model.model_card_data
+        if is_evaluate:
+            return not model_card_data.widget
+        return not model_card_data.label_example_list or not model_card_data.train_set_metrics_list
+
+    def _set_model_card_data(self, dataset: Dataset, is_evaluate: bool) -> None:
+        # Setting model card data based on training data
+        if not is_evaluate:
+            # Pick some example entities from each entity class for the model card.
+            if not self.model.model_card_data.label_example_list:
+                self.model.model_card_data.set_label_examples(
+                    dataset, self.model.config.id2label, self.model.config.outside_id
+                )
+            if not self.model.model_card_data.train_set_metrics_list:
+                self.model.model_card_data.set_train_set_metrics(dataset)
+
+        # Set some example sentences for the model card widget
+        if is_evaluate and not self.model.model_card_data.widget:
+            self.model.model_card_data.set_widget_examples(dataset)
+
+    def _check_document_context(self, dataset: Dataset, is_evaluate: bool) -> bool:
+        """Set or check whether the model is trained with document-level context, and return whether
+        ``dataset`` contains both ``document_id`` and ``sentence_id`` columns."""
+        if {"document_id", "sentence_id"} <= set(dataset.column_names):
+            # If training, set the config flag that this model is trained with document context
+            if not is_evaluate:
+                self.model.config.trained_with_document_context = True
+            # If evaluating and the model was not trained with document context, warn
+            elif not self.model.config.trained_with_document_context:
+                logger.warning(
+                    "This model was trained without document-level context: "
+                    "evaluation with document-level context may cause decreased performance."
+                )
+            return True
+
+        if is_evaluate and self.model.config.trained_with_document_context:
+            logger.warning(
+                "This model was trained with document-level context: "
+                "evaluation without document-level context may cause decreased performance."
+            )
+        return False
+
     @staticmethod
     def add_context(
-        dataset: Dataset,
+        dataset: Union[Dataset, Dict[str, List[Any]]],
         model_max_length: int,
         max_prev_context: Optional[int] = None,
         max_next_context: Optional[int] = None,
         show_progress_bar: bool = True,
-    ) -> Dataset:
+    ) -> Union[Dataset, Dict[str, List[Any]]]:
         """Add document-level context from previous and next sentences in the same document.
 
         Args:
-            dataset (`Dataset`): The partially processed dataset, containing `"input_ids"`, `"start_position_ids"`,
+            dataset (`Union[Dataset, Dict[str, List[Any]]]`): The partially processed dataset, or a dictionary of
+                column names to lists of values, containing `"input_ids"`, `"start_position_ids"`,
                 `"end_position_ids"`, `"document_id"` and `"sentence_id"` columns.
             model_max_length (`int`): The total number of tokens that can be processed before
                 truncation.
@@ -297,23 +460,25 @@ class Trainer(TransformersTrainer):
             show_progress_bar (`bool`): Whether to show a progress bar. Defaults to `True`.
 
         Returns:
-            Dataset: A copy of the Dataset with additional previous and next sentences added to input_ids.
+            Union[Dataset, Dict[str, List[Any]]]: A copy of the input with additional previous and next sentences
+                added to input_ids.
         """
+        # Read the columns once, as indexing a Dataset row by row is slow
+        input_ids = dataset["input_ids"]
+        document_ids = dataset["document_id"]
         all_input_ids = []
         all_start_position_ids = []
         all_end_position_ids = []
-        for sample_idx, sample in tqdm(
-            enumerate(dataset),
+        for sample_idx, (start_position_ids, end_position_ids) in tqdm(
+            enumerate(zip(dataset["start_position_ids"], dataset["end_position_ids"])),
             desc="Adding document-level context",
-            total=len(dataset),
+            total=len(input_ids),
             leave=False,
             disable=not show_progress_bar,
         ):
             # Sequentially add next context, previous context, next context, previous context, etc. until
             # max token length or max_prev/next_context
-            tokens = sample["input_ids"][1:-1]
-            start_position_ids = sample["start_position_ids"]
-            end_position_ids = sample["end_position_ids"]
+            tokens = input_ids[sample_idx][1:-1]
 
             next_context_added = 0
             prev_context_added = 0
@@ -322,12 +487,12 @@ class Trainer(TransformersTrainer):
                 next_context_index = sample_idx + next_context_added + 1
                 should_add_next = (
                     (max_next_context is None or next_context_added < max_next_context)
-                    and next_context_index < len(dataset)
-                    and dataset[next_context_index]["document_id"] == sample["document_id"]
+                    and next_context_index < len(input_ids)
+                    and document_ids[next_context_index] == document_ids[sample_idx]
                 )
                 if should_add_next:
                     # TODO: [1:-1][:remaining_space] is not efficient
-                    tokens += dataset[next_context_index]["input_ids"][1:-1][:remaining_space]
+                    tokens += input_ids[next_context_index][1:-1][:remaining_space]
                     next_context_added += 1
 
                 remaining_space = model_max_length - len(tokens) - 2
@@ -338,11 +503,11 @@ class Trainer(TransformersTrainer):
                 should_add_prev = (
                     (max_prev_context is None or prev_context_added < max_prev_context)
                     and prev_context_index >= 0
-                    and dataset[prev_context_index]["document_id"] == sample["document_id"]
+                    and document_ids[prev_context_index] == document_ids[sample_idx]
                 )
                 if should_add_prev:
                     # TODO: [1:-1][remaining_space:] is not efficient
-                    prepended_tokens = dataset[prev_context_index]["input_ids"][1:-1][-remaining_space:]
+                    prepended_tokens = input_ids[prev_context_index][1:-1][-remaining_space:]
                     tokens = prepended_tokens + tokens
                     # TODO: Use numpy? np.array(sample["start_position_ids"]) + len(prepended_tokens)
                     start_position_ids = [index + len(prepended_tokens) for index in start_position_ids]
@@ -354,10 +519,18 @@ class Trainer(TransformersTrainer):
 
                 remaining_space = model_max_length - len(tokens) - 2
 
-            all_input_ids.append([sample["input_ids"][0]] + tokens + [sample["input_ids"][-1]])
+            all_input_ids.append([input_ids[sample_idx][0]] + tokens + [input_ids[sample_idx][-1]])
             all_start_position_ids.append(start_position_ids)
             all_end_position_ids.append(end_position_ids)
 
+        if not isinstance(dataset, Dataset):
+            return {
+                **dataset,
+                "input_ids": all_input_ids,
+                "start_position_ids": all_start_position_ids,
+                "end_position_ids": all_end_position_ids,
+            }
+
         dataset = dataset.remove_columns(("input_ids", "start_position_ids", "end_position_ids"))
         dataset = dataset.add_column("input_ids", all_input_ids)
         dataset = dataset.add_column("start_position_ids", all_start_position_ids)
@@ -404,6 +577,70 @@ class Trainer(TransformersTrainer):
                     batch_samples[key].append(value)
         return batch_samples
 
+    @staticmethod
+    def pack_samples(
+        batch: Dict[str, List[Any]], model_max_length: int, marker_max_length: int
+    ) -> Dict[str, List[Any]]:
+        """Pack consecutive short samples into single samples, as long as their tokens and markers fit.
+
+        The input IDs, start/end position IDs and labels of the packed samples are concatenated, while the
+        start/end position IDs remain relative to their own sentence. The ``packed_num_tokens`` and
+        ``packed_num_spans`` columns are used by the :class:`~span_marker.data_collator.SpanMarkerDataCollator`
+        to prevent the sentences from attending each other, and to split the predictions per sentence.
+        All other columns are converted into lists with the values of the packed samples.
+
+        Args:
+            batch (`Dict[str, List[Any]]`): A dictionary of dataset keys to lists of values, after spreading.
+            model_max_length (`int`): The total number of tokens that can be processed before
+                truncation.
+            marker_max_length (`int`): The maximum length for each of the span markers.
+
+        Returns:
+            Dict[str, List[Any]]: A dictionary of dataset keys to lists of values.
+        """
+        keys = batch.keys()
+        # These columns are concatenated, whereas all other columns become lists with one value per sentence
+        concatenated_keys = {"input_ids", "start_position_ids", "end_position_ids", "labels"} & keys
+        total_sample_length = model_max_length + 2 * marker_max_length
+
+        packed_samples = []
+        for sample in zip(*batch.values()):
+            sample = dict(zip(keys, sample))
+            num_tokens = len(sample["input_ids"])
+            num_spans = sample["num_spans"]
+            if packed_samples:
+                packed_sample = packed_samples[-1]
+                packed_num_tokens = len(packed_sample["input_ids"]) + num_tokens
+                packed_num_spans = packed_sample["num_spans"] + num_spans
+                # The markers start at the first even index after the text tokens
+                if (
+                    packed_num_tokens <= model_max_length
+                    and packed_num_spans <= marker_max_length
+                    and packed_num_tokens + packed_num_tokens % 2 + 2 * packed_num_spans <= total_sample_length
+                ):
+                    for key, value in sample.items():
+                        if key in concatenated_keys:
+                            packed_sample[key] = packed_sample[key] + value
+                        elif key != "num_spans":
+                            packed_sample[key].append(value)
+                    packed_sample["num_spans"] = packed_num_spans
+                    packed_sample["packed_num_tokens"].append(num_tokens)
+                    packed_sample["packed_num_spans"].append(num_spans)
+                    continue
+
+            packed_sample = {
+                key: value if key in concatenated_keys or key == "num_spans" else [value]
+                for key, value in sample.items()
+            }
+            packed_sample["packed_num_tokens"] = [num_tokens]
+            packed_sample["packed_num_spans"] = [num_spans]
+            packed_samples.append(packed_sample)
+
+        return {
+            key: [packed_sample[key] for packed_sample in packed_samples]
+            for key in [*keys, "packed_num_tokens", "packed_num_spans"]
+        }
+
     def get_train_dataloader(self) -> DataLoader:
         """Return the preprocessed training DataLoader."""
         self.train_dataset = self.preprocess_dataset(self.train_dataset, self.label_normalizer, self.tokenizer)
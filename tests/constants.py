@@ -123,5 +123,6 @@ FABNER_LABELS = [
     "S-BIOP",
 ]
 TINY_BERT = "prajjwal1/bert-tiny"
+TINY_ROBERTA = "hf-internal-testing/tiny-random-RobertaModel"
 
 DEFAULT_ARGS = TrainingArguments(output_dir="models/my_span_marker_model", report_to="none", num_train_epochs=1)
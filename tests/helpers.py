@@ -1,5 +1,7 @@
 from typing import Dict, List, Union
 
+from datasets import Dataset, DatasetDict
+
 
 def compare_entities(
     pred_entities: List[Dict[str, Union[str, float, int]]],
@@ -19,3 +21,25 @@ def compare_entities(
         for key, value in gold.items():
             # ... and values
             assert pred[key] == value
+
+
+def build_documents(dataset_dict: DatasetDict, num_copies: int = 3) -> Dataset:
+    """Build a dataset with multiple documents from a dataset dictionary with document-level context.
+
+    Every split of the tiny test datasets only contains a single document, so the sentences of all splits are
+    repeated ``num_copies`` times, with a new document ID for every split and copy.
+
+    Args:
+        dataset_dict (DatasetDict): Dataset dictionary with `tokens`, `document_id` and `sentence_id` columns.
+        num_copies (int): The number of copies of every split. Defaults to 3.
+
+    Returns:
+        Dataset: Dataset with `tokens`, `document_id` and `sentence_id` columns, sorted by document.
+    """
+    columns = {"tokens": [], "document_id": [], "sentence_id": []}
+    for copy_idx in range(num_copies):
+        for split_idx, dataset in enumerate(dataset_dict.values()):
+            columns["tokens"] += dataset["tokens"]
+            columns["document_id"] += [copy_idx * len(dataset_dict) + split_idx] * len(dataset)
+            columns["sentence_id"] += dataset["sentence_id"]
+    return Dataset.from_dict(columns)
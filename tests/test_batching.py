@@ -0,0 +1,255 @@
+import asyncio
+import copy
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import pytest
+
+from span_marker import SpanMarkerBatcher, SpanMarkerModel
+from tests.helpers import compare_entities
+
+SENTENCES = [
+    "I'm living in the Netherlands, but I work in Spain.",
+    "Tom.",
+    "My name is Tom and I live in London.",
+    "Paris is the capital of France.",
+    "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    ["Caesar", "led", "the", "Roman", "armies", "in", "the", "Gallic", "Wars"],
+    ["Tom", "."],
+]
+
+
+@pytest.mark.parametrize("max_num_tokens", [None, 20])
+def test_batcher(finetuned_conll_span_marker_model: SpanMarkerModel, max_num_tokens: Optional[int]) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_batch_size=4, max_num_tokens=max_num_tokens, max_wait_time=0.1) as batcher:
+        # Requests from concurrent clients are batched together
+        with ThreadPoolExecutor(max_workers=len(SENTENCES)) as executor:
+            all_entities = list(executor.map(batcher.predict, SENTENCES))
+        metrics = batcher.metrics()
+
+    assert len(all_entities) == len(SENTENCES)
+    for entities, sentence in zip(all_entities, SENTENCES):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
+
+    assert metrics["queue_depth"] == 0
+    assert metrics["num_requests"] == len(SENTENCES)
+    assert sum(size * count for size, count in metrics["batch_sizes"].items()) == len(SENTENCES)
+    assert max(metrics["batch_sizes"]) <= 4
+    if max_num_tokens is None:
+        assert metrics["num_batches"] < len(SENTENCES)
+
+    with pytest.raises(ValueError, match="has been closed"):
+        batcher.submit(SENTENCES[0])
+
+
+def test_batcher_max_num_tokens_concurrent(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    # Unique string sentences, whereas the pre-tokenized sentences are repeated
+    sentences = [
+        f"{sentence} ({idx})" if isinstance(sentence, str) else sentence for idx, sentence in enumerate(SENTENCES * 8)
+    ]
+    with SpanMarkerBatcher(model, max_batch_size=8, max_num_tokens=40, max_wait_time=0.01) as batcher:
+        # Many threads submit at once while the batcher thread tokenizes and predicts, which must not
+        # use the tokenizer from multiple threads at the same time
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            all_entities = list(executor.map(batcher.predict, sentences))
+        metrics = batcher.metrics()
+
+    assert len(all_entities) == len(sentences)
+    for entities, sentence in zip(all_entities, sentences):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
+    assert sum(size * count for size, count in metrics["batch_sizes"].items()) + metrics["num_deduplicated"] == len(
+        sentences
+    )
+
+
+def test_batcher_tokenizes_outside_lock(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_num_tokens=1000, max_wait_time=0.01) as batcher:
+        count_tokens = batcher._count_tokens
+        is_counting = threading.Event()
+        is_submitted = threading.Event()
+
+        def blocking_count_tokens(sentence):
+            if sentence == SENTENCES[0]:
+                is_counting.set()
+                # Another sentence can only be submitted while tokenizing if the lock of the batcher is released
+                assert is_submitted.wait(timeout=10)
+            return count_tokens(sentence)
+
+        batcher._count_tokens = blocking_count_tokens
+        future = batcher.submit(SENTENCES[0])
+        assert is_counting.wait(timeout=10)
+        other_future = batcher.submit(SENTENCES[1])
+        is_submitted.set()
+        assert future.result(timeout=10) == model.predict(SENTENCES[0])
+        assert other_future.result(timeout=10) == model.predict(SENTENCES[1])
+
+
+def test_batcher_exceptions(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_num_tokens=1000, max_wait_time=0.01) as batcher:
+        count_tokens = batcher._count_tokens
+
+        def failing_count_tokens(sentence):
+            if sentence == SENTENCES[1]:
+                raise ValueError("Tokenization failed")
+            return count_tokens(sentence)
+
+        # Only the request whose sentence cannot be tokenized fails
+        batcher._count_tokens = failing_count_tokens
+        futures = [batcher.submit(sentence) for sentence in SENTENCES[:3]]
+        with pytest.raises(ValueError, match="Tokenization failed"):
+            futures[1].result(timeout=10)
+        assert futures[0].result(timeout=10) == model.predict(SENTENCES[0])
+        assert futures[2].result(timeout=10) == model.predict(SENTENCES[2])
+
+        # Unexpected exceptions fail the queued requests, rather than stopping the batcher thread
+        batch_length = batcher._batch_length
+        has_failed = False
+
+        def failing_batch_length():
+            nonlocal has_failed
+            if not has_failed:
+                has_failed = True
+                raise RuntimeError("Batching failed")
+            return batch_length()
+
+        batcher._batch_length = failing_batch_length
+        with pytest.raises(RuntimeError, match="Batching failed"):
+            batcher.predict(SENTENCES[3], timeout=10)
+        assert batcher.predict(SENTENCES[3], timeout=10) == model.predict(SENTENCES[3])
+        assert batcher.metrics()["queue_depth"] == 0
+
+
+def test_batcher_without_dataset(
+    finetuned_conll_span_marker_model: SpanMarkerModel, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    # The sentences of a SpanMarkerModel batch are predicted as plain lists, without building a Dataset
+    monkeypatch.setattr("span_marker.batching.Dataset", None)
+    with SpanMarkerBatcher(model, max_batch_size=4, max_wait_time=0.01) as batcher:
+        # A batch with a single pre-tokenized sentence, and a batch with single-word string sentences
+        pretokenized_entities = batcher.predict(["Tom", "lives", "in", "Amsterdam", "."])
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            string_entities = list(executor.map(batcher.predict, ["Paris", "Amsterdam"]))
+
+    compare_entities(
+        pretokenized_entities,
+        [
+            {key: value for key, value in entity.items() if key != "score"}
+            for entity in model.predict(["Tom", "lives", "in", "Amsterdam", "."])
+        ],
+    )
+    assert len(string_entities) == 2
+    for entities in string_entities:
+        assert isinstance(entities, list)
+
+
+def test_batcher_cancel(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_batch_size=4, max_wait_time=1.0) as batcher:
+        future = batcher.submit(SENTENCES[0])
+        cancelled_future = batcher.submit(SENTENCES[1])
+        # The batch is not formed before the max wait time, so the request can still be cancelled
+        assert cancelled_future.cancel()
+        assert isinstance(future.result(), list)
+    assert batcher.metrics()["batch_sizes"] == {1: 1}
+
+
+def test_batcher_cancel_burst(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_batch_size=4, max_wait_time=1.0) as batcher:
+        for idx in range(8):
+            cancelled_future = batcher.submit(f"Tom lives in Amsterdam ({idx}).")
+            assert cancelled_future.cancel()
+        # Cancelled requests are dequeued immediately, rather than when their batch is formed
+        assert batcher.metrics()["queue_depth"] == 0
+        futures = [batcher.submit(sentence) for sentence in SENTENCES[:4]]
+        for future in futures:
+            assert isinstance(future.result(), list)
+    # The cancelled requests did not take up space in the batch
+    assert batcher.metrics()["batch_sizes"] == {4: 1}
+
+
+def test_apredict(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+
+    async def predict_concurrently():
+        # Every sentence is awaited twice, by separate concurrent awaiters
+        return await asyncio.gather(*(model.apredict(sentence) for sentence in SENTENCES + SENTENCES))
+
+    all_entities = asyncio.run(predict_concurrently())
+    assert len(all_entities) == 2 * len(SENTENCES)
+    for entities, sentence in zip(all_entities, SENTENCES + SENTENCES):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
+    # The duplicate sentences were deduplicated rather than predicted twice
+    metrics = model._get_batcher().metrics()
+    assert metrics["num_deduplicated"] >= 1
+    assert metrics["num_batches"] < 2 * len(SENTENCES)
+
+    # Multiple sentences in one call
+    all_entities = asyncio.run(model.apredict(SENTENCES[:2]))
+    assert len(all_entities) == 2
+
+
+def test_apredict_model_can_be_copied(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    expected_entities = asyncio.run(model.apredict(SENTENCES[0]))
+    batcher = model._get_batcher()
+    # The batcher with its background thread is not pickled or copied along with the model
+    for model_copy in (copy.deepcopy(model), pickle.loads(pickle.dumps(model))):
+        assert getattr(model_copy, "_batcher", None) is None
+        assert model_copy.predict(SENTENCES[0]) == model.predict(SENTENCES[0])
+
+    model.close_batcher()
+    assert not batcher._thread.is_alive()
+    with pytest.raises(ValueError, match="has been closed"):
+        batcher.submit(SENTENCES[0])
+    # The next call starts a new batcher
+    compare_entities(
+        asyncio.run(model.apredict(SENTENCES[0])),
+        [{key: value for key, value in entity.items() if key != "score"} for entity in expected_entities],
+    )
+    assert model._get_batcher() is not batcher
+    model.close_batcher()
+
+
+def test_apredict_timeout(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    with SpanMarkerBatcher(model, max_wait_time=1.0) as batcher:
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(batcher.apredict(SENTENCES[0], timeout=0.01))
+    # The timed out sentence was dequeued before it was predicted
+    assert batcher.metrics()["num_batches"] == 0
+
+
+def test_apredict_iter(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+
+    async def sentence_stream():
+        for sentence in SENTENCES:
+            yield sentence
+
+    async def collect():
+        return [entities async for entities in model.apredict_iter(sentence_stream(), max_in_flight=3)]
+
+    all_entities = asyncio.run(collect())
+    assert len(all_entities) == len(SENTENCES)
+    for entities, sentence in zip(all_entities, SENTENCES):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from datasets import Dataset
+
+from span_marker.data_collator import SpanMarkerDataCollator
+
+PAD_ID = 0
+START_MARKER_ID = 1001
+END_MARKER_ID = 1002
+
+FEATURES = [
+    {
+        "input_ids": [101, 7, 8, 102],
+        "num_spans": 2,
+        "start_position_ids": [1, 2],
+        "end_position_ids": [1, 2],
+        "labels": [0, 3],
+    },
+    {
+        "input_ids": [101, 9, 102],
+        "num_spans": 1,
+        "start_position_ids": [1],
+        "end_position_ids": [1],
+        "labels": [2],
+    },
+]
+
+
+@pytest.fixture()
+def collator() -> SpanMarkerDataCollator:
+    tokenizer = SimpleNamespace(
+        model_max_length=6, pad_token_id=PAD_ID, start_marker_id=START_MARKER_ID, end_marker_id=END_MARKER_ID
+    )
+    return SpanMarkerDataCollator(tokenizer=tokenizer, marker_max_length=2)
+
+
+def expected_attention_mask(num_tokens: int, start_marker_idx: int, num_spans: int, total_size: int) -> torch.Tensor:
+    attention_mask = torch.zeros((total_size, total_size), dtype=torch.bool)
+    attention_mask[:num_tokens, :num_tokens] = 1
+    for offset in range(num_spans):
+        start_idx = start_marker_idx + offset
+        end_idx = start_marker_idx + num_spans + offset
+        attention_mask[start_idx, :num_tokens] = 1
+        attention_mask[end_idx, :num_tokens] = 1
+        for query_idx in (start_idx, end_idx):
+            for key_idx in (start_idx, end_idx):
+                attention_mask[query_idx, key_idx] = 1
+    return attention_mask
+
+
+@pytest.mark.parametrize("as_dataset", [False, True])
+def test_data_collator(collator: SpanMarkerDataCollator, as_dataset: bool) -> None:
+    features = Dataset.from_list(FEATURES) if as_dataset else FEATURES
+    batch = collator(features)
+
+    assert batch["input_ids"].tolist() == [
+        [101, 7, 8, 102, START_MARKER_ID, START_MARKER_ID, END_MARKER_ID, END_MARKER_ID, PAD_ID, PAD_ID],
+        [101, 9, 102, PAD_ID, START_MARKER_ID, END_MARKER_ID, PAD_ID, PAD_ID, PAD_ID, PAD_ID],
+    ]
+    assert batch["input_ids"].dtype == torch.int
+    assert batch["position_ids"].tolist() == [
+        [2, 3, 4, 5, 3, 4, 3, 4, 1, 1],
+        [2, 3, 4, 1, 3, 3, 1, 1, 1, 1],
+    ]
+    assert batch["position_ids"].dtype == torch.int
+    assert batch["labels"].tolist() == [[0, 3, -100, -100, -100], [2, -100, -100, -100, -100]]
+    assert batch["start_marker_indices"].tolist() == [4, 4]
+    assert batch["num_marker_pairs"].tolist() == [2, 1]
+
+    assert batch["attention_mask"].dtype == torch.bool
+    assert torch.equal(batch["attention_mask"][0], expected_attention_mask(4, 4, 2, 10))
+    assert torch.equal(batch["attention_mask"][1], expected_attention_mask(3, 4, 1, 10))
+
+
+@pytest.mark.parametrize(("pad_to_multiple_of", "total_size"), [(None, 8), (1, 8), (3, 9), (8, 8), (16, 10)])
+def test_data_collator_dynamic_padding(
+    collator: SpanMarkerDataCollator, pad_to_multiple_of: int, total_size: int
+) -> None:
+    collator.dynamic_padding = True
+    collator.pad_to_multiple_of = pad_to_multiple_of
+    batch = collator(FEATURES)
+
+    # The longest sample ends after its last end marker at index 8, and we never exceed the maximum size of 10
+    assert batch["input_ids"].shape == (2, total_size)
+    assert batch["position_ids"].shape == (2, total_size)
+    assert batch["attention_mask"].shape == (2, total_size, total_size)
+    assert batch["labels"].shape == (2, total_size // 2)
+    assert batch["input_ids"][0, :8].tolist() == [
+        101,
+        7,
+        8,
+        102,
+        START_MARKER_ID,
+        START_MARKER_ID,
+        END_MARKER_ID,
+        END_MARKER_ID,
+    ]
+    assert torch.equal(batch["attention_mask"][0], expected_attention_mask(4, 4, 2, total_size))
+    assert torch.equal(batch["attention_mask"][1], expected_attention_mask(3, 4, 1, total_size))
+
+
+def test_data_collator_packed_sentences() -> None:
+    tokenizer = SimpleNamespace(
+        model_max_length=8, pad_token_id=PAD_ID, start_marker_id=START_MARKER_ID, end_marker_id=END_MARKER_ID
+    )
+    collator = SpanMarkerDataCollator(tokenizer=tokenizer, marker_max_length=3)
+    packed_sample = {
+        "input_ids": [101, 7, 8, 102, 101, 9, 102],
+        "num_spans": 3,
+        "start_position_ids": [1, 2, 1],
+        "end_position_ids": [1, 2, 1],
+        "labels": [0, 3, 2],
+        "packed_num_tokens": [4, 3],
+        "packed_num_spans": [2, 1],
+    }
+    batch = collator([packed_sample])
+
+    markers = [START_MARKER_ID] * 3 + [END_MARKER_ID] * 3
+    assert batch["input_ids"].tolist() == [[101, 7, 8, 102, 101, 9, 102, PAD_ID] + markers]
+    # The text position IDs restart for every sentence
+    assert batch["position_ids"].tolist() == [[2, 3, 4, 5, 2, 3, 4, 1, 3, 4, 3, 3, 4, 3]]
+    assert batch["segment_ids"].tolist() == [[0, 0, 0, 0, 1, 1, 1, -1, 0, 0, 1, 0, 0, 1]]
+    assert batch["labels"].tolist() == [[0, 3, 2, -100, -100, -100, -100]]
+
+    # The sentences only attend their own text tokens, and the markers only the text of their own sentence
+    attention_mask = torch.zeros((14, 14), dtype=torch.bool)
+    attention_mask[:4, :4] = 1
+    attention_mask[4:7, 4:7] = 1
+    for start_idx, end_idx, text_slice in ((8, 11, slice(0, 4)), (9, 12, slice(0, 4)), (10, 13, slice(4, 7))):
+        for query_idx in (start_idx, end_idx):
+            attention_mask[query_idx, text_slice] = 1
+            attention_mask[query_idx, start_idx] = 1
+            attention_mask[query_idx, end_idx] = 1
+    assert torch.equal(batch["attention_mask"][0], attention_mask)
@@ -0,0 +1,93 @@
+from typing import List, Tuple
+
+import numpy as np
+import pytest
+
+from span_marker.decoding import (
+    decode_entities,
+    get_span_arrays,
+    get_spans,
+    select_entities,
+)
+
+
+def greedy_select(
+    spans: List[Tuple[int, int]], scores: List[float], labels: List[int], outside_id: int
+) -> List[Tuple[int, int]]:
+    """The one-by-one greedy selection, used as the reference."""
+    num_words = max((end for _start, end in spans), default=0)
+    word_selected = [False] * num_words
+    selected = []
+    for (start, end), _score, label in sorted(zip(spans, scores, labels), key=lambda tup: tup[1], reverse=True):
+        if label != outside_id and not any(word_selected[start:end]):
+            selected.append((start, end))
+            word_selected[start:end] = [True] * (end - start)
+    return sorted(selected)
+
+
+@pytest.mark.parametrize(("num_words", "entity_max_length"), [(0, 8), (1, 8), (5, 2), (10, 8), (12, 1)])
+def test_get_span_arrays(num_words: int, entity_max_length: int) -> None:
+    starts, ends = get_span_arrays(num_words, entity_max_length)
+    expected = [
+        (start_idx, end_idx)
+        for start_idx in range(num_words)
+        for end_idx in range(start_idx + 1, min(num_words + 1, start_idx + 1 + entity_max_length))
+    ]
+    assert list(zip(starts.tolist(), ends.tolist())) == expected
+    assert list(get_spans(num_words, entity_max_length)) == expected
+
+
+def test_get_span_arrays_is_memoized() -> None:
+    starts, ends = get_span_arrays(7, 3)
+    # The same read-only arrays are shared between all callers
+    assert get_span_arrays(7, 3)[0] is starts
+    assert get_span_arrays(np.int64(7), 3)[1] is ends
+    with pytest.raises(ValueError):
+        starts[0] = 1
+    assert get_spans(7, 3) is get_spans(7, 3)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_select_entities(seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    starts, ends = get_span_arrays(30, 6)
+    # Include ties between scores, which are broken by the original span order
+    scores = rng.integers(0, 20, size=len(starts)) / 20
+    labels = rng.choice([0, 0, 0, 1, 2], size=len(starts))
+
+    selected = select_entities(starts, ends, scores, labels, outside_id=0)
+    spans = list(zip(starts.tolist(), ends.tolist()))
+    expected = greedy_select(spans, scores.tolist(), labels.tolist(), outside_id=0)
+    assert list(zip(starts[selected].tolist(), ends[selected].tolist())) == expected
+
+
+def test_decode_entities_pretokenized() -> None:
+    sentences = [["Tom", "lives", "in", "New", "York"], ["Hello"]]
+    spans = list(zip(*(array.tolist() for array in get_span_arrays(5, 2))))
+    scores = [0.5] * len(spans)
+    labels = [0] * len(spans)
+    # "Tom" as PER, "New York" as LOC, and the overlapping "York" with a lower score
+    labels[spans.index((0, 1))] = 1
+    scores[spans.index((0, 1))] = 0.9
+    labels[spans.index((3, 5))] = 2
+    scores[spans.index((3, 5))] = 0.8
+    labels[spans.index((4, 5))] = 2
+    scores[spans.index((4, 5))] = 0.7
+
+    all_entities = decode_entities(
+        sentences,
+        [scores, [0.9]],
+        [labels, [0]],
+        [5, 1],
+        batch_encoding=None,
+        entity_max_length=2,
+        id2label={0: "O", 1: "PER", 2: "LOC"},
+        outside_id=0,
+    )
+    assert all_entities == [
+        [
+            {"span": ["Tom"], "label": "PER", "score": 0.9, "word_start_index": 0, "word_end_index": 1},
+            {"span": ["New", "York"], "label": "LOC", "score": 0.8, "word_start_index": 3, "word_end_index": 5},
+        ],
+        [],
+    ]
@@ -0,0 +1,66 @@
+import pytest
+from datasets import DatasetDict
+
+from span_marker import SpanMarkerInferencePool, SpanMarkerModel
+from tests.helpers import build_documents, compare_entities
+
+
+def test_inference_pool(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        "My name is Tom and I live in London.",
+        "Paris is the capital of France.",
+        "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    ]
+    gold_entities = model.predict(sentences, batch_size=2)
+    with SpanMarkerInferencePool(model, num_workers=2, num_threads=1) as pool:
+        # The entities of all shards are merged in the order of the inputs
+        all_entities = pool.predict(sentences, batch_size=2, shard_size=1)
+        assert len(all_entities) == len(sentences)
+        for entities, gold in zip(all_entities, gold_entities):
+            compare_entities(
+                entities, [{key: value for key, value in entity.items() if key != "score"} for entity in gold]
+            )
+
+        # A single sentence still gives a list of entities
+        entities = pool.predict(sentences[0])
+        compare_entities(
+            entities, [{key: value for key, value in entity.items() if key != "score"} for entity in gold_entities[0]]
+        )
+        assert pool.predict([]) == []
+
+    with pytest.raises(ValueError, match="has been closed"):
+        pool.predict(sentences)
+
+
+def test_inference_pool_with_document_level_context(
+    finetuned_conll_span_marker_model: SpanMarkerModel, document_context_conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model
+    dataset = build_documents(document_context_conll_dataset_dict)
+    gold_entities = model.predict(dataset)
+    with SpanMarkerInferencePool(model, num_workers=2, num_threads=1) as pool:
+        # Shards are only split between documents, so the document-level context is unchanged
+        all_entities = pool.predict(dataset, shard_size=3)
+    assert len(all_entities) == len(dataset)
+    for entities, gold in zip(all_entities, gold_entities):
+        compare_entities(entities, [{key: value for key, value in entity.items() if key != "score"} for entity in gold])
+
+
+def test_inference_pool_with_interleaved_documents(
+    finetuned_conll_span_marker_model: SpanMarkerModel, document_context_conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model
+    dataset = build_documents(document_context_conll_dataset_dict)
+    assert len(set(dataset["document_id"])) > 1
+    # Interleave the sentences of the documents, such that consecutive sentences are from different documents
+    dataset = dataset.select(list(range(0, len(dataset), 2)) + list(range(1, len(dataset), 2))[::-1])
+    gold_entities = model.predict(dataset)
+    with SpanMarkerInferencePool(model, num_workers=2, num_threads=1) as pool:
+        # The sentences are grouped by document before sharding, so the document-level context is unchanged
+        all_entities = pool.predict(dataset, shard_size=3)
+    assert len(all_entities) == len(dataset)
+    for entities, gold in zip(all_entities, gold_entities):
+        compare_entities(entities, [{key: value for key, value in entity.items() if key != "score"} for entity in gold])
@@ -1,16 +1,19 @@
+import dataclasses
 import logging
 import re
 from typing import Dict, List, Optional, Union
 
 import pytest
 import torch
-from datasets import Dataset
+from datasets import Dataset, DatasetDict
 
 from span_marker.configuration import SpanMarkerConfig
-from span_marker.modeling import SpanMarkerModel
+from span_marker.data_collator import SpanMarkerDataCollator
+from span_marker.modeling import SpanMarkerModel, gather_marker_features
 from span_marker.tokenizer import SpanMarkerTokenizer
-from tests.constants import CONLL_LABELS, FEWNERD_COARSE_LABELS, TINY_BERT
-from tests.helpers import compare_entities
+from span_marker.trainer import Trainer
+from tests.constants import CONLL_LABELS, FEWNERD_COARSE_LABELS, TINY_BERT, TINY_ROBERTA
+from tests.helpers import build_documents, compare_entities
 
 
 @pytest.mark.parametrize(
@@ -242,3 +245,361 @@ def test_try_cuda(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
     finetuned_conll_span_marker_model.try_cuda()
     # The model is on CUDA if CUDA is available, and not on CUDA if CUDA is not available.
     assert (finetuned_conll_span_marker_model.device.type == "cuda") == torch.cuda.is_available()
+
+
+def test_dynamic_padding(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda().eval()
+    tokenized = model.tokenizer(
+        {"tokens": ["I'm living in the Netherlands, but I work in Spain.", "My name is Tom."]}, return_num_words=True
+    )
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+
+    fixed_batch = model.data_collator(features)
+    dynamic_collator = dataclasses.replace(model.data_collator, dynamic_padding=True)
+    dynamic_batch = dynamic_collator(features)
+    assert dynamic_batch["input_ids"].size(1) < fixed_batch["input_ids"].size(1)
+
+    with torch.no_grad():
+        fixed_output = model(**{key: value.to(model.device) for key, value in fixed_batch.items()})
+        dynamic_output = model(**{key: value.to(model.device) for key, value in dynamic_batch.items()})
+    for sample_idx, num_marker_pairs in enumerate(fixed_batch["num_marker_pairs"].tolist()):
+        assert torch.allclose(
+            fixed_output.logits[sample_idx, :num_marker_pairs],
+            dynamic_output.logits[sample_idx, :num_marker_pairs],
+            atol=1e-5,
+        )
+
+
+def test_attention_mask_on_device(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda().eval()
+    tokenized = model.tokenizer({"tokens": ["I'm living in the Netherlands, but I work in Spain.", "My name is Tom ."]})
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+
+    batch = {key: value.to(model.device) for key, value in model.data_collator(features).items()}
+    attention_mask = batch.pop("attention_mask")
+    with torch.no_grad():
+        output_with_mask = model(**batch, attention_mask=attention_mask)
+        output_without_mask = model(**batch)
+    assert torch.allclose(output_with_mask.logits, output_without_mask.logits)
+
+    with pytest.raises(ValueError, match="Either `attention_mask` or `num_tokens` must be provided"):
+        batch.pop("num_tokens")
+        model(**batch)
+
+
+def test_gather_marker_features() -> None:
+    last_hidden_state = torch.randn(3, 12, 4)
+    start_marker_indices = torch.tensor([4, 2, 6])
+    num_marker_pairs = torch.tensor([3, 5, 0])
+    feature_vector = gather_marker_features(last_hidden_state, start_marker_indices, num_marker_pairs)
+
+    assert feature_vector.shape == (3, 6, 8)
+    for sample_idx, (start_idx, num_pairs) in enumerate(zip(start_marker_indices, num_marker_pairs)):
+        end_idx = start_idx + num_pairs
+        assert torch.equal(feature_vector[sample_idx, :num_pairs, :4], last_hidden_state[sample_idx, start_idx:end_idx])
+        assert torch.equal(
+            feature_vector[sample_idx, :num_pairs, 4:], last_hidden_state[sample_idx, end_idx : end_idx + num_pairs]
+        )
+        assert not feature_vector[sample_idx, num_pairs:].any()
+
+
+def test_forward_only_classifies_marker_pairs(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda().eval()
+    tokenized = model.tokenizer(
+        {
+            "tokens": [["I", "'m", "living", "in", "the", "Netherlands", "."], ["My", "name", "is", "Tom", "."]],
+            # Normalized (label, start, end) tuples, i.e. "Netherlands" as LOC and "Tom" as PER
+            "ner_tags": [[(1, 5, 6)], [(4, 3, 4)]],
+        }
+    )
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+    batch = {key: value.to(model.device) for key, value in model.data_collator(features).items()}
+    with torch.no_grad():
+        output = model(**batch)
+
+    # The logits of padded marker pair slots are masked out, and the loss only considers the real marker pairs
+    for sample_idx, num_marker_pairs in enumerate(batch["num_marker_pairs"].tolist()):
+        assert not output.logits[sample_idx, num_marker_pairs:].any()
+    expected_loss = torch.nn.functional.cross_entropy(
+        output.logits.view(-1, model.config.num_labels), batch["labels"].view(-1), ignore_index=-100
+    )
+    assert torch.allclose(output.loss, expected_loss)
+
+
+def test_classify_marker_pairs(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model
+    hidden_size = model.classifier.in_features // 2
+    start_states = torch.randn(10, hidden_size)
+    end_states = torch.randn(10, hidden_size)
+    with torch.no_grad():
+        split_logits = model.classify_marker_pairs(start_states, end_states)
+        concat_logits = model.classifier(torch.cat((start_states, end_states), dim=-1))
+    assert split_logits.shape == (10, model.config.num_labels)
+    assert torch.allclose(split_logits, concat_logits, atol=1e-6)
+
+
+@pytest.mark.parametrize("model_name", [TINY_BERT, TINY_ROBERTA])
+def test_sdpa_attention(model_name: str) -> None:
+    sdpa_model = SpanMarkerModel.from_pretrained(model_name, labels=CONLL_LABELS).try_cuda()
+    if getattr(sdpa_model.encoder.config, "_attn_implementation", None) != "sdpa":
+        pytest.skip("This version of transformers does not support SDPA for this encoder.")
+    eager_model = SpanMarkerModel.from_pretrained(model_name, labels=CONLL_LABELS, attn_implementation="eager")
+    eager_model = eager_model.try_cuda()
+    assert eager_model.encoder.config._attn_implementation == "eager"
+    eager_model.load_state_dict(sdpa_model.state_dict())
+
+    sentences = ["I'm living in the Netherlands, but I work in Spain.", "My name is Tom and this is a test."]
+    tokenized = sdpa_model.tokenizer({"tokens": sentences})
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+    batch = {key: value.to(sdpa_model.device) for key, value in sdpa_model.data_collator(features).items()}
+    with torch.no_grad():
+        sdpa_logits = sdpa_model.eval()(**batch).logits
+        eager_logits = eager_model.eval()(**batch).logits
+    assert torch.allclose(sdpa_logits, eager_logits, atol=1e-5)
+    for sdpa_entities, eager_entities in zip(sdpa_model.predict(sentences), eager_model.predict(sentences)):
+        gold_entities = [{key: value for key, value in entity.items() if key != "score"} for entity in eager_entities]
+        compare_entities(sdpa_entities, gold_entities)
+
+
+@pytest.mark.parametrize("model_name", [TINY_BERT, TINY_ROBERTA])
+def test_share_text_encoding(model_name: str) -> None:
+    model = SpanMarkerModel.from_pretrained(
+        model_name, labels=CONLL_LABELS, model_max_length=32, marker_max_length=16, entity_max_length=4
+    )
+    model = model.try_cuda().eval()
+    tokenized = model.tokenizer(
+        {"tokens": ["I'm living in the Netherlands, but I work in Spain.", "My name is Tom."]}, return_num_words=True
+    )
+    # Spread the sentences between multiple samples, such that samples share the same text tokens
+    spread = Trainer.spread_sample(tokenized, model.tokenizer.model_max_length, model.config.marker_max_length)
+    assert len(spread["input_ids"]) > 2
+    features = [dict(zip(spread.keys(), values)) for values in zip(*spread.values())]
+    batch = {key: value.to(model.device) for key, value in model.data_collator(features).items()}
+
+    with torch.no_grad():
+        dense_logits = model(**batch).logits
+        shared_logits = model(**batch, share_text_encoding=True).logits
+        # The text tokens can also be derived from the attention mask
+        batch.pop("num_tokens")
+        mask_logits = model(**batch, share_text_encoding=True).logits
+        batch.pop("attention_mask")
+        with pytest.raises(ValueError, match="Either `attention_mask` or `num_tokens` must be provided"):
+            model(**batch, share_text_encoding=True)
+    assert torch.allclose(dense_logits, shared_logits, atol=1e-5)
+    assert torch.allclose(dense_logits, mask_logits, atol=1e-5)
+
+    sentences = ["I'm living in the Netherlands, but I work in Spain.", "My name is Tom and this is a test."]
+    for shared_entities, dense_entities in zip(
+        model.predict(sentences, share_text_encoding=True), model.predict(sentences, share_text_encoding=False)
+    ):
+        gold_entities = [{key: value for key, value in entity.items() if key != "score"} for entity in dense_entities]
+        compare_entities(shared_entities, gold_entities)
+
+
+@pytest.mark.parametrize("model_name", [TINY_BERT, TINY_ROBERTA])
+def test_sparse_marker_attention(model_name: str) -> None:
+    model = SpanMarkerModel.from_pretrained(model_name, labels=CONLL_LABELS, sparse_marker_attention=True)
+    model = model.try_cuda().eval()
+    assert model.config.sparse_marker_attention
+    tokenized = model.tokenizer(
+        {
+            "tokens": [["I", "'m", "living", "in", "the", "Netherlands", "."], ["My", "name", "is", "Tom", "."]],
+            "ner_tags": [[(1, 5, 6)], [(4, 3, 4)]],
+        }
+    )
+    features = [dict(zip(tokenized.keys(), values)) for values in zip(*tokenized.values())]
+    batch = {key: value.to(model.device) for key, value in model.data_collator(features).items()}
+
+    sparse_output = model(**batch)
+    sparse_output.loss.backward()
+    sparse_grads = [param.grad.clone() for param in model.encoder.parameters() if param.grad is not None]
+    model.zero_grad()
+
+    model.config.sparse_marker_attention = False
+    dense_output = model(**batch)
+    dense_output.loss.backward()
+    dense_grads = [param.grad.clone() for param in model.encoder.parameters() if param.grad is not None]
+
+    assert torch.allclose(sparse_output.logits, dense_output.logits, atol=1e-5)
+    assert torch.allclose(sparse_output.loss, dense_output.loss, atol=1e-5)
+    assert len(sparse_grads) == len(dense_grads)
+    for sparse_grad, dense_grad in zip(sparse_grads, dense_grads):
+        assert torch.allclose(sparse_grad, dense_grad, atol=1e-5)
+
+
+def test_predict_length_bucketing(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        "Paris is the capital of France, whereas Berlin is the capital of Germany and Madrid of Spain.",
+        "My name is Tom and I live in London.",
+    ]
+    # Batches are formed from samples of similar lengths, but the predictions are returned in the input order
+    batch_entities = model.predict(sentences, batch_size=2)
+    for sentence, entities in zip(sentences, batch_entities):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
+
+
+def test_predict_keeps_spread_samples_together(
+    finetuned_conll_span_marker_model: SpanMarkerModel, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        " ".join(["Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris."] * 4),
+        "Tom.",
+        "My name is Tom and I live in London.",
+    ]
+    samples, _, _ = model._prepare_samples(sentences)
+    assert sum(sample["id"] == [1] for sample in samples) > 1
+
+    collated_ids = []
+    collate = SpanMarkerDataCollator.__call__
+
+    def spy_collate(data_collator, features):
+        collated_ids.extend(feature["id"] for feature in features)
+        return collate(data_collator, features)
+
+    monkeypatch.setattr(SpanMarkerDataCollator, "__call__", spy_collate)
+    model._score_samples(samples, batch_size=2, share_text_encoding=False)
+    # The samples of the spread sentence are adjacent, so they can share their text encoding
+    spread_positions = [position for position, sample_ids in enumerate(collated_ids) if sample_ids == [1]]
+    assert spread_positions == list(range(spread_positions[0], spread_positions[0] + len(spread_positions)))
+
+
+def test_predict_pack_sentences(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        "My name is Tom and I live in London.",
+        "Paris is the capital of France.",
+    ]
+    # Packed sentences cannot attend each other, so the predictions are identical to unpacked predictions
+    for packed_entities, entities in zip(
+        model.predict(sentences, pack_sentences=True), model.predict(sentences, pack_sentences=False)
+    ):
+        gold_entities = [{key: value for key, value in entity.items() if key != "score"} for entity in entities]
+        compare_entities(packed_entities, gold_entities)
+
+
+def test_predict_iter(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        "My name is Tom and I live in London.",
+        "Paris is the capital of France.",
+        "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    ]
+    # The inputs are consumed lazily, in chunks of at most 2 sentences
+    entities_iter = model.predict_iter((sentence for sentence in sentences), batch_size=2, chunk_size=2)
+    assert not isinstance(entities_iter, list)
+    all_entities = list(entities_iter)
+    assert len(all_entities) == len(sentences)
+    for entities, sentence in zip(all_entities, sentences):
+        gold_entities = [
+            {key: value for key, value in entity.items() if key != "score"} for entity in model.predict(sentence)
+        ]
+        compare_entities(entities, gold_entities)
+
+
+def test_predict_iter_with_document_level_context(
+    finetuned_conll_span_marker_model: SpanMarkerModel, document_context_conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    dataset = build_documents(document_context_conll_dataset_dict)
+    assert len(set(dataset["document_id"])) > 1
+    elements = [
+        {"tokens": tokens, "document_id": document_id, "sentence_id": sentence_id}
+        for tokens, document_id, sentence_id in zip(dataset["tokens"], dataset["document_id"], dataset["sentence_id"])
+    ]
+    # Chunks are only split between documents, so the document-level context is identical
+    all_entities = list(model.predict_iter(iter(elements), chunk_size=3))
+    assert len(all_entities) == len(dataset)
+    for entities, dataset_entities in zip(all_entities, model.predict(dataset)):
+        gold_entities = [{key: value for key, value in entity.items() if key != "score"} for entity in dataset_entities]
+        compare_entities(entities, gold_entities)
+
+
+def test_predict_iter_is_lazy(finetuned_conll_span_marker_model: SpanMarkerModel) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    num_consumed = 0
+
+    def sentences():
+        nonlocal num_consumed
+        for _ in range(20):
+            num_consumed += 1
+            yield "I'm living in the Netherlands, but I work in Spain."
+
+    entities_iter = model.predict_iter(sentences(), chunk_size=2)
+    next(entities_iter)
+    # At most the first chunk, the prefetched next chunk and the first sentence of the chunk after that
+    assert num_consumed <= 5
+    assert len(list(entities_iter)) == 19
+
+
+def test_predict_deduplicates_sentences(
+    finetuned_conll_span_marker_model: SpanMarkerModel, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Tom.",
+        ["Tom", "."],
+    ]
+    expected_entities = [model.predict(sentence) for sentence in sentences]
+
+    prepared_sentences = []
+    prepare_samples = model._prepare_samples
+
+    def spy_prepare_samples(sentences, *args, **kwargs):
+        prepared_sentences.extend(sentences)
+        return prepare_samples(sentences, *args, **kwargs)
+
+    monkeypatch.setattr(model, "_prepare_samples", spy_prepare_samples)
+    all_entities = model.predict(sentences)
+    # Only the unique sentences are tokenized and encoded
+    assert prepared_sentences == [sentences[0], sentences[1], sentences[4]]
+    assert len(all_entities) == len(sentences)
+    for entities, expected in zip(all_entities, expected_entities):
+        compare_entities(
+            entities, [{key: value for key, value in entity.items() if key != "score"} for entity in expected]
+        )
+    # The duplicates do not share the same objects
+    assert all_entities[0] is not all_entities[2]
+
+
+def test_predict_deduplicates_documents(
+    finetuned_conll_span_marker_model: SpanMarkerModel, document_context_conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    dataset = document_context_conll_dataset_dict["test"]
+    expected_entities = model.predict(dataset)
+    # A second copy of every document, with different document IDs
+    document_ids = dataset["document_id"]
+    num_documents = max(document_ids) + 1
+    duplicated = Dataset.from_dict(
+        {
+            "tokens": dataset["tokens"] * 2,
+            "document_id": document_ids + [document_id + num_documents for document_id in document_ids],
+            "sentence_id": dataset["sentence_id"] * 2,
+        }
+    )
+    unique_indices, inverse_indices = SpanMarkerModel._deduplicate(
+        duplicated["tokens"], duplicated["document_id"], duplicated["sentence_id"]
+    )
+    assert len(unique_indices) == len(dataset)
+    assert inverse_indices[: len(dataset)] == inverse_indices[len(dataset) :]
+    all_entities = model.predict(duplicated)
+    assert len(all_entities) == 2 * len(dataset)
+    for entities, expected in zip(all_entities, expected_entities + expected_entities):
+        compare_entities(
+            entities, [{key: value for key, value in entity.items() if key != "score"} for entity in expected]
+        )
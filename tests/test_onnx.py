@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from span_marker import SpanMarkerModel
+from span_marker.onnx import SpanMarkerOnnx, export_spanmarker_to_onnx
+from tests.helpers import compare_entities
+
+FINETUNED_CONLL = "tomaarsen/span-marker-bert-tiny-conll03"
+
+
+def test_export_to_onnx(finetuned_conll_span_marker_model: SpanMarkerModel, tmp_path: Path) -> None:
+    model = finetuned_conll_span_marker_model
+    # The default opset version does not support the SDPA attention that the encoder is loaded with
+    export_spanmarker_to_onnx(FINETUNED_CONLL, output_folder=str(tmp_path))
+    onnx_model = SpanMarkerOnnx(
+        onnx_encoder_path=tmp_path / "spanmarker_encoder.onnx",
+        onnx_classifier_path=tmp_path / "spanmarker_classifier.onnx",
+        config=model.config,
+        tokenizer=model.tokenizer,
+    )
+    sentences = [
+        "I'm living in the Netherlands, but I work in Spain.",
+        "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic to Paris.",
+    ]
+    for entities, gold in zip(onnx_model.predict(sentences), model.predict(sentences)):
+        compare_entities(entities, [{key: value for key, value in entity.items() if key != "score"} for entity in gold])
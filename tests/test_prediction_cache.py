@@ -0,0 +1,92 @@
+from pathlib import Path
+
+from datasets import DatasetDict
+
+from span_marker import PredictionCache, SpanMarkerModel
+from span_marker.prediction_cache import get_sentence_keys
+from tests.helpers import build_documents
+
+SENTENCES = [
+    "I'm living in the Netherlands, but I work in Spain.",
+    "Tom.",
+    "I'm living in the Netherlands, but I work in Spain.",
+    "Paris is the capital of France.",
+]
+TOKENIZED_SENTENCES = [
+    ["Caesar", "led", "the", "Roman", "armies", "in", "the", "Gallic", "Wars"],
+    ["Tom", "."],
+]
+
+
+def test_prediction_cache(finetuned_conll_span_marker_model: SpanMarkerModel, tmp_path: Path) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    expected_entities = model.predict(SENTENCES)
+
+    cache = PredictionCache(max_memory_entries=2, path=str(tmp_path / "cache.sqlite"))
+    assert model.predict(SENTENCES, cache=cache) == expected_entities
+    assert cache.stats()["misses"] == len(SENTENCES)
+    # The second call is served from memory and, for the evicted sentences, from disk
+    assert model.predict(SENTENCES, cache=cache) == expected_entities
+    stats = cache.stats()
+    assert stats["hits"] == len(SENTENCES)
+    assert stats["memory_hits"] > 0 and stats["disk_hits"] > 0
+    assert stats["memory_entries"] == 2
+    # The duplicate sentence shares one entry
+    assert stats["disk_entries"] == len(SENTENCES) - 1
+
+    # Pre-tokenized sentences are predicted separately, and do not share entries with string sentences
+    expected_tokenized_entities = model.predict(TOKENIZED_SENTENCES)
+    assert model.predict(TOKENIZED_SENTENCES, cache=cache) == expected_tokenized_entities
+    assert model.predict(TOKENIZED_SENTENCES, cache=cache) == expected_tokenized_entities
+    assert cache.stats()["disk_entries"] == len(SENTENCES) - 1 + len(TOKENIZED_SENTENCES)
+
+    # The on-disk cache persists between caches, and the duplicate sentence is only counted once
+    disk_bytes = cache.stats()["disk_bytes"]
+    cache.close()
+    cache = PredictionCache(path=str(tmp_path / "cache.sqlite"))
+    assert cache.stats()["disk_bytes"] == disk_bytes
+    assert model.predict(SENTENCES[0], cache=cache) == expected_entities[0]
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_prediction_cache_disk_eviction(finetuned_conll_span_marker_model: SpanMarkerModel, tmp_path: Path) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    sentences = [f"Tom lives in Paris, and his {idx}th friend lives in Berlin." for idx in range(10)]
+    cache = PredictionCache(path=str(tmp_path / "unbounded.sqlite"))
+    model.predict(sentences, cache=cache)
+    total_bytes = cache.stats()["disk_bytes"]
+
+    # With half the space, the least recently used entries are evicted
+    cache = PredictionCache(max_memory_entries=1, path=str(tmp_path / "cache.sqlite"), max_disk_bytes=total_bytes // 2)
+    model.predict(sentences, cache=cache)
+    stats = cache.stats()
+    assert 0 < stats["disk_bytes"] <= total_bytes // 2
+    assert 0 < stats["disk_entries"] < len(sentences)
+
+
+def test_prediction_cache_with_document_level_context(
+    finetuned_conll_span_marker_model: SpanMarkerModel, document_context_conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model.try_cuda()
+    dataset = build_documents(document_context_conll_dataset_dict)
+    expected_entities = model.predict(dataset)
+    cache = PredictionCache()
+    assert model.predict(dataset, cache=cache) == expected_entities
+    assert model.predict(dataset, cache=cache) == expected_entities
+    assert cache.stats()["hits"] == len(dataset)
+
+
+def test_get_sentence_keys() -> None:
+    # Pre-tokenized and string sentences have distinct keys
+    assert len(set(get_sentence_keys(["Tom", ["Tom"]]))) == 2
+    # With document-level context, identical sentences only share a key if their context is identical
+    keys = get_sentence_keys(
+        ["Hello", "Tom", "Hello", "Tom", "Hello"],
+        document_ids=[0, 0, 1, 1, 2],
+        sentence_ids=[0, 1, 0, 1, 0],
+        max_prev_context=1,
+        max_next_context=1,
+    )
+    assert keys[0] == keys[2]
+    assert keys[1] == keys[3]
+    assert keys[0] != keys[4]
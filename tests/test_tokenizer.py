@@ -0,0 +1,80 @@
+from span_marker.modeling import SpanMarkerModel
+
+
+def test_tokenizer_span_positions(fresh_conll_span_marker_model: SpanMarkerModel) -> None:
+    tokenizer = fresh_conll_span_marker_model.tokenizer
+    entity_max_length = fresh_conll_span_marker_model.config.entity_max_length
+    sentences = [
+        ["Amelia", "Earhart", "flew", "her", "single", "engine", "Lockheed", "Vega", "5B", "."],
+        ["Tokenization", "⁣", "is", "hard"],
+    ]
+    output = tokenizer({"tokens": sentences}, return_num_words=True, return_batch_encoding=True)
+    batch_encoding = output["batch_encoding"]
+    for sample_idx, sentence in enumerate(sentences):
+        assert output["num_words"][sample_idx] == len(sentence)
+        # The positions of all spans match the positions of the first and last tokens of their words
+        expected_start_position_ids = []
+        expected_end_position_ids = []
+        for start_idx, end_idx in tokenizer.get_all_valid_spans(len(sentence), entity_max_length):
+            start_token_span = batch_encoding.word_to_tokens(sample_idx, word_index=start_idx)
+            expected_start_position_ids.append(start_token_span.start if start_token_span else 0)
+            end_token_span = batch_encoding.word_to_tokens(sample_idx, word_index=end_idx - 1)
+            expected_end_position_ids.append(end_token_span.end - 1 if end_token_span else 0)
+        assert output["start_position_ids"][sample_idx] == expected_start_position_ids
+        assert output["end_position_ids"][sample_idx] == expected_end_position_ids
+        assert output["num_spans"][sample_idx] == len(expected_start_position_ids)
+
+
+def test_tokenizer_labels(fresh_conll_span_marker_model: SpanMarkerModel) -> None:
+    tokenizer = fresh_conll_span_marker_model.tokenizer
+    config = fresh_conll_span_marker_model.config
+    sentence = ["Amelia", "Earhart", "flew", "to", "Paris", "."]
+    # (label, start, end), including an entity that is longer than the maximum entity length
+    ner_tags = [(1, 0, 2), (3, 4, 5), (2, 0, config.entity_max_length + 1)]
+    with tokenizer.entity_tracker(split="train"):
+        output = tokenizer({"tokens": [sentence + ["word"] * config.entity_max_length], "ner_tags": [ner_tags]})
+        assert dict(tokenizer.entity_tracker.skipped_entities) == {config.entity_max_length + 1: 1}
+
+    spans = list(tokenizer.get_all_valid_spans(len(sentence) + config.entity_max_length, config.entity_max_length))
+    labels = output["labels"][0]
+    assert len(labels) == len(spans)
+    assert labels[spans.index((0, 2))] == 1
+    assert labels[spans.index((4, 5))] == 3
+    assert sum(label != config.outside_id for label in labels) == 2
+
+
+def test_tokenizer_does_not_pad(fresh_conll_span_marker_model: SpanMarkerModel) -> None:
+    tokenizer = fresh_conll_span_marker_model.tokenizer
+    sentences = [
+        "Tom lives in Amsterdam.",
+        "Amelia Earhart flew her single engine Lockheed Vega 5B across the Atlantic.",
+    ]
+    output = tokenizer({"tokens": sentences}, return_batch_encoding=True, is_split_into_words=False)
+    for input_ids, sentence in zip(output["input_ids"], sentences):
+        assert isinstance(input_ids, list)
+        assert input_ids == tokenizer.tokenizer(sentence)["input_ids"]
+        assert tokenizer.tokenizer.pad_token_id not in input_ids
+
+    # A single sentence is tokenized as a batch of one sentence
+    output = tokenizer({"tokens": sentences[0]})
+    assert len(output["input_ids"]) == 1
+    assert output["input_ids"][0] == tokenizer.tokenizer(sentences[0])["input_ids"]
+
+
+def test_tokenizer_return_entity_counts(fresh_conll_span_marker_model: SpanMarkerModel) -> None:
+    tokenizer = fresh_conll_span_marker_model.tokenizer
+    config = fresh_conll_span_marker_model.config
+    sentences = [["Amelia", "Earhart", "flew", "to", "Paris", "."], ["word"] * (config.entity_max_length + 2)]
+    ner_tags = [[(1, 0, 2), (3, 4, 5)], [(2, 0, config.entity_max_length + 1)]]
+    with tokenizer.entity_tracker(split="train") as entity_tracker:
+        output = tokenizer({"tokens": sentences, "ner_tags": ner_tags}, return_entity_counts=True)
+        # The counts are returned rather than tracked
+        assert entity_tracker.total_num_entities == 0
+        assert output["num_entities"] == [2, 1]
+        assert output["missed_entity_lengths"] == [[], [config.entity_max_length + 1]]
+
+        # Partial counts, e.g. from multiple processes, are merged into the tracker
+        entity_tracker.merge(2, {config.entity_max_length + 1: 1})
+        entity_tracker.merge(1, {config.entity_max_length + 1: 1, 8: 2})
+        assert entity_tracker.total_num_entities == 3
+        assert dict(entity_tracker.skipped_entities) == {config.entity_max_length + 1: 2, 8: 2}
@@ -250,3 +250,134 @@ def test_trainer_create_model_card(finetuned_conll_span_marker_model: SpanMarker
     trainer = Trainer(model=model, args=args)
     trainer.create_model_card()
     assert (tmp_path / "README.md").exists()
+
+
+def test_trainer_pack_samples() -> None:
+    batch = {
+        "input_ids": [[101, 7, 8, 102], [101, 9, 102], [101, 10, 11, 12, 13, 102]],
+        "num_spans": [2, 1, 3],
+        "start_position_ids": [[1, 2], [1], [1, 2, 3]],
+        "end_position_ids": [[2, 3], [2], [2, 3, 4]],
+        "labels": [[0, 3], [2], [0, 0, 1]],
+        "id": [0, 1, 2],
+    }
+    packed = Trainer.pack_samples(batch, model_max_length=8, marker_max_length=4)
+    # The third sentence does not fit in the first sample anymore
+    assert packed == {
+        "input_ids": [[101, 7, 8, 102, 101, 9, 102], [101, 10, 11, 12, 13, 102]],
+        "num_spans": [3, 3],
+        "start_position_ids": [[1, 2, 1], [1, 2, 3]],
+        "end_position_ids": [[2, 3, 2], [2, 3, 4]],
+        "labels": [[0, 3, 2], [0, 0, 1]],
+        "id": [[0, 1], [2]],
+        "packed_num_tokens": [[4, 3], [6]],
+        "packed_num_spans": [[2, 1], [3]],
+    }
+
+
+def test_trainer_pack_sentences(
+    finetuned_conll_span_marker_model: SpanMarkerModel, conll_dataset_dict: DatasetDict
+) -> None:
+    model = finetuned_conll_span_marker_model
+    trainer = Trainer(
+        model,
+        args=DEFAULT_ARGS,
+        train_dataset=conll_dataset_dict["train"],
+        eval_dataset=conll_dataset_dict["test"],
+        pack_sentences=True,
+    )
+    train_dataset = trainer.preprocess_dataset(conll_dataset_dict["train"], trainer.label_normalizer, model.tokenizer)
+    assert "packed_num_tokens" in train_dataset.column_names
+    assert len(train_dataset) < len(conll_dataset_dict["train"])
+    trainer.train()
+    metrics = trainer.evaluate()
+    assert isinstance(metrics, dict)
+
+
+def test_trainer_add_context_without_dataset() -> None:
+    columns = {
+        "input_ids": [[101, 7, 8, 102], [101, 9, 102], [101, 10, 11, 102]],
+        "start_position_ids": [[1, 2], [1], [1, 2]],
+        "end_position_ids": [[1, 2], [1], [1, 2]],
+        "document_id": [0, 0, 1],
+    }
+    with_context = Trainer.add_context(columns, model_max_length=8, show_progress_bar=False)
+    # The same context is added to plain lists and to Datasets
+    dataset_with_context = Trainer.add_context(Dataset.from_dict(columns), model_max_length=8, show_progress_bar=False)
+    for column in ("input_ids", "start_position_ids", "end_position_ids"):
+        assert with_context[column] == dataset_with_context[column]
+    assert with_context["input_ids"] == [[101, 7, 8, 9, 102], [101, 7, 8, 9, 102], [101, 10, 11, 102]]
+    assert with_context["start_position_ids"] == [[1, 2], [3], [1, 2]]
+
+
+def test_trainer_preprocessing_cache(
+    finetuned_conll_span_marker_model: SpanMarkerModel, conll_dataset_dict: DatasetDict, tmp_path: Path
+) -> None:
+    model = finetuned_conll_span_marker_model
+    eval_dataset = conll_dataset_dict["test"]
+    trainer = Trainer(model, args=DEFAULT_ARGS, eval_dataset=eval_dataset, preprocessing_cache_dir=str(tmp_path))
+
+    def preprocess() -> Dataset:
+        return trainer.preprocess_dataset(
+            eval_dataset, trainer.label_normalizer, model.tokenizer, dataset_name="evaluation", is_evaluate=True
+        )
+
+    # Preprocessing the same dataset again returns the cached dataset
+    preprocessed = preprocess()
+    assert preprocess() is preprocessed
+    assert len(list(tmp_path.iterdir())) == 1
+    # Training and evaluation samples are cached separately
+    train_key = trainer.get_preprocessing_cache_key(eval_dataset, model.tokenizer)
+    assert train_key != trainer.get_preprocessing_cache_key(eval_dataset, model.tokenizer, is_evaluate=True)
+
+    # A new Trainer loads the preprocessed dataset from disk
+    trainer = Trainer(model, args=DEFAULT_ARGS, eval_dataset=eval_dataset, preprocessing_cache_dir=str(tmp_path))
+    loaded = preprocess()
+    assert loaded is not preprocessed
+    assert loaded.to_dict() == preprocessed.to_dict()
+    metrics = trainer.evaluate()
+    assert isinstance(metrics, dict)
+
+    # Changing the configuration invalidates the cache
+    model.config.entity_max_length -= 1
+    assert trainer.get_preprocessing_cache_key(eval_dataset, model.tokenizer) != train_key
+    model.config.entity_max_length += 1
+
+
+def test_trainer_num_proc(conll_dataset_dict: DatasetDict, caplog: LogCaptureFixture) -> None:
+    model = SpanMarkerModel.from_pretrained(TINY_BERT, labels=CONLL_LABELS, entity_max_length=1)
+    train_dataset = conll_dataset_dict["train"]
+    trainer = Trainer(model, args=DEFAULT_ARGS, train_dataset=train_dataset)
+    preprocessed = trainer.preprocess_dataset(train_dataset, trainer.label_normalizer, model.tokenizer)
+    messages = [record.msg for record in caplog.records if "will ignore" in record.msg]
+    assert len(messages) == 1
+
+    # Preprocessing in multiple processes gives the same samples and the same entity tracker warning
+    caplog.clear()
+    trainer = Trainer(model, args=DEFAULT_ARGS, train_dataset=train_dataset, num_proc=2)
+    preprocessed_in_parallel = trainer.preprocess_dataset(train_dataset, trainer.label_normalizer, model.tokenizer)
+    assert preprocessed_in_parallel.to_dict() == preprocessed.to_dict()
+    assert [record.msg for record in caplog.records if "will ignore" in record.msg] == messages
+
+
+def test_trainer_preprocessing_cache_key_hashes_vocabulary_once(
+    finetuned_conll_span_marker_model: SpanMarkerModel, conll_dataset_dict: DatasetDict, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    model = finetuned_conll_span_marker_model
+    eval_dataset = conll_dataset_dict["test"]
+    trainer = Trainer(model, args=DEFAULT_ARGS, eval_dataset=eval_dataset)
+
+    get_vocab = model.tokenizer.tokenizer.get_vocab
+    num_calls = 0
+
+    def counting_get_vocab():
+        nonlocal num_calls
+        num_calls += 1
+        return get_vocab()
+
+    monkeypatch.setattr(model.tokenizer.tokenizer, "get_vocab", counting_get_vocab)
+    key = trainer.get_preprocessing_cache_key(eval_dataset, model.tokenizer, is_evaluate=True)
+    assert trainer.get_preprocessing_cache_key(eval_dataset, model.tokenizer, is_evaluate=True) == key
+    trainer.evaluate()
+    trainer.evaluate()
+    assert num_calls == 1